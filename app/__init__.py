@@ -20,6 +20,43 @@ def create_app(config_class=Config):
     db.init_app(app)
     migrate.init_app(app, db)
 
+    from app.http_client import http_client
+    http_client.init_app(app)
+    from app.telegram_notifier import telegram_notifier
+    telegram_notifier.init_app(app)
+    from app.whatsapp_sender import whatsapp_sender
+    whatsapp_sender.init_app(app)
+
+    from app.dispatcher import chat_dispatcher
+    chat_dispatcher.init_app(app)
+
+    from app.message_dedup import message_dedup
+    message_dedup.init_app(app)
+
+    from app.rate_limit import chat_rate_limiter
+    chat_rate_limiter.init_app(app)
+
+    from app.spool import webhook_spool
+    webhook_spool.init_app(app)
+
+    from app.scheduler import message_scheduler
+    message_scheduler.init_app(app)
+
+    from app.amocrm_outbox import amocrm_outbox
+    amocrm_outbox.init_app(app)
+
+    from app.sheets_sync import sheets_sync
+    sheets_sync.init_app(app)
+
+    from app.counters import counter_aggregator
+    counter_aggregator.init_app(app)
+
+    from app.dashboard_stats import dashboard_stats
+    dashboard_stats.init_app(app)
+
+    from app.funnel import funnel_rollup
+    funnel_rollup.init_app(app)
+
     # Регистрация blueprint'ов
     from app.routes import bp as routes_bp
     app.register_blueprint(routes_bp)
@@ -0,0 +1,72 @@
+import base64
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import current_app, request
+from sqlalchemy import tuple_
+
+# Сортируемый столбец списка: выражение для ORDER BY и получение его значения из строки
+SortColumn = Tuple[Any, Callable[[Any], Any]]
+
+
+def encode_cursor(value, key) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, key]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[Any, Any]]:
+    if not cursor:
+        return None
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    return value, key
+
+
+class KeysetPage:
+    """Страница списка, выбранная по ключу (keyset/seek): без OFFSET и без подсчета всех строк.
+
+    Строки упорядочиваются по выбранному столбцу и первичному ключу, следующая страница
+    начинается после последней строки текущей (курсор after), предыдущая заканчивается
+    перед первой (курсор before). Поэтому стоимость страницы не зависит от ее номера
+    и от размера таблицы.
+    """
+
+    def __init__(self, query, sorts: Dict[str, SortColumn], key_column, key: Callable[[Any], Any],
+                 default_sort: str, default_direction: str = 'asc'):
+        self.sort = request.args.get('sort') if request.args.get('sort') in sorts else default_sort
+        self.direction = request.args.get('direction') if request.args.get('direction') in ('asc', 'desc') \
+            else default_direction
+        default_per_page = current_app.config.get('ADMIN_PAGE_SIZE', 50)
+        self.per_page = min(max(request.args.get('per_page', default_per_page, type=int), 1), 500)
+
+        expression, value = sorts[self.sort]
+        before = decode_cursor(request.args.get('before'))
+        after = decode_cursor(request.args.get('after')) if before is None else None
+        cursor = before or after
+        # При переходе назад строки выбираются в обратном порядке и затем переворачиваются
+        descending = (self.direction == 'desc') != (before is not None)
+        if cursor is not None:
+            row, bound = tuple_(expression, key_column), tuple_(*cursor)
+            query = query.filter(row < bound if descending else row > bound)
+        order = (expression.desc(), key_column.desc()) if descending else (expression.asc(), key_column.asc())
+        items = query.order_by(*order).limit(self.per_page + 1).all()
+
+        has_more = len(items) > self.per_page
+        self.items: List[Any] = items[:self.per_page]
+        if before is not None:
+            self.items.reverse()
+            self.has_prev, self.has_next = has_more, True
+        else:
+            self.has_prev, self.has_next = after is not None, has_more
+        self.next_cursor = encode_cursor(value(self.items[-1]), key(self.items[-1])) if self.items else None
+        self.prev_cursor = encode_cursor(value(self.items[0]), key(self.items[0])) if self.items else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def url_args(self, **overrides) -> dict:
+        """Возвращает параметры ссылки на список с текущими сортировкой и размером страницы."""
+        args = {'sort': self.sort, 'direction': self.direction, 'per_page': self.per_page}
+        args.update(overrides)
+        return args
@@ -1,9 +1,28 @@
 from functools import wraps
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required, current_user, login_user, logout_user
-from app.models import PartnerInfo, MessageTemplate, Partner, User, DiscountWeightSettings, ClientsData, Category, City
+from app.models import PartnerInfo, MessageTemplate, Partner, User, DiscountWeightSettings, ClientsData, Category, City, SalonSyncState, SyncJob
 from app.admin.forms import SalonForm, PartnerForm, MessageTemplateForm, DiscountWeightSettingsForm, CategoryForm, AdminLoginForm
 from app import db
+from app.admin.pagination import KeysetPage
+from app.offer_catalog import offer_catalog, reset_client_exclusions
+from app.message_templates import template_registry
+from app.spool import webhook_spool
+from app.dispatcher import chat_dispatcher
+from app.message_dedup import message_dedup
+from app.rate_limit import chat_rate_limiter
+from app.scheduler import message_scheduler
+from app.http_client import http_client
+from app.amocrm_outbox import amocrm_outbox
+from app.telegram_notifier import telegram_notifier
+from app.whatsapp_sender import whatsapp_sender
+from app.sheets_sync import sheets_sync
+from app.counters import PARTNER_COUNTER_FIELDS, counter_aggregator
+from app.dashboard_stats import dashboard_stats
+from app.funnel import funnel_by_city, funnel_by_salon, funnel_rollup
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 from urllib.parse import urlparse
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -42,10 +61,66 @@ def logout():
 @bp.route('/')
 @admin_required
 def index():
-    salon_count = PartnerInfo.query.count()
-    partner_count = Partner.query.count()
-    client_count = ClientsData.query.count()
-    return render_template('admin/dashboard.html', salon_count=salon_count, partner_count=partner_count, client_count=client_count)
+    # Показатели предрассчитаны в dashboard_stats, COUNT(*) по большим таблицам не выполняется
+    stats = dashboard_stats.get()
+    return render_template(
+        'admin/dashboard.html',
+        salon_count=stats.get('salons', 0),
+        partner_count=stats.get('partners', 0),
+        client_count=stats.get('clients', 0),
+        claims_today=stats.get('claims_today', 0),
+        active_cities=stats.get('active_cities', 0)
+    )
+
+@bp.route('/runtime_stats')
+@admin_required
+def runtime_stats():
+    """Возвращает состояние фоновых очередей и воркеров в формате JSON."""
+    return jsonify({
+        'webhook_spool': webhook_spool.stats(),
+        'chat_dispatcher': chat_dispatcher.stats(),
+        'message_dedup': message_dedup.stats(),
+        'chat_rate_limiter': chat_rate_limiter.stats(),
+        'message_scheduler': message_scheduler.stats(),
+        'http_client': http_client.stats(),
+        'amocrm_outbox': amocrm_outbox.stats(),
+        'telegram_notifier': telegram_notifier.stats(),
+        'whatsapp_sender': whatsapp_sender.stats(),
+        'sheets_sync': sheets_sync.stats(),
+        'counters': counter_aggregator.stats(),
+        'dashboard_stats': dashboard_stats.stats(),
+        'funnel_rollup': funnel_rollup.stats(),
+    })
+
+@bp.route('/funnel')
+@admin_required
+def funnel():
+    """Воронка по городам и салонам за последние дни (по дневным итогам funnel_daily)."""
+    days = min(max(request.args.get('days', 7, type=int), 1), 365)
+    city_id = request.args.get('city_id', type=int)
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    return render_template(
+        'admin/funnel.html',
+        days=days,
+        city_id=city_id,
+        cities=funnel_by_city(since),
+        salons=funnel_by_salon(since, city_id)
+    )
+
+@bp.route('/sync_jobs')
+@admin_required
+def sync_jobs():
+    """Возвращает последние запуски синхронизации с Google Sheets в формате JSON."""
+    jobs = SyncJob.query.order_by(SyncJob.id.desc()).limit(20).all()
+    return jsonify([job.to_dict() for job in jobs])
+
+@bp.route('/sync_jobs/run', methods=['POST'])
+@admin_required
+def run_sync_job():
+    """Ставит синхронизацию с Google Sheets в очередь."""
+    job_id = sheets_sync.trigger('admin')
+    db.session.commit()
+    return jsonify({'job_id': job_id}), 202
 
 @bp.route('/salons')
 @admin_required
@@ -53,7 +128,17 @@ def salons():
     if current_user.username != 'admin':
         flash('У вас нет доступа к этой странице.', 'error')
         return redirect(url_for('admin.login'))
-    salons = PartnerInfo.query.all()
+    # Категории и город каждой строки загружаются вместе со страницей, а не отдельным запросом на строку
+    salons = KeysetPage(
+        PartnerInfo.query.options(selectinload(PartnerInfo.categories), joinedload(PartnerInfo.city)),
+        {
+            'id': (PartnerInfo.id, lambda salon: salon.id),
+            'name': (PartnerInfo.name, lambda salon: salon.name),
+            'clients_brought': (func.coalesce(PartnerInfo.clients_brought, 0), lambda salon: salon.clients_brought or 0),
+            'clients_received': (func.coalesce(PartnerInfo.clients_received, 0), lambda salon: salon.clients_received or 0),
+        },
+        PartnerInfo.id, lambda salon: salon.id, default_sort='id'
+    )
     return render_template('admin/salons.html', salons=salons)
 
 @bp.route('/salons/create', methods=['GET', 'POST'])
@@ -69,6 +154,7 @@ def create_salon():
         salon.city_id = form.city.data.id
         db.session.add(salon)
         db.session.commit()
+        offer_catalog.invalidate(salon.city_id)
         flash('Партнер успешно добавлен!', 'success')
         return redirect(url_for('admin.salons'))
     return render_template('admin/edit_salon.html', form=form, title='Добавить партнера')
@@ -84,14 +170,20 @@ def edit_salon(salon_id):
     if form.validate_on_submit():
         try:
             with db.session.begin_nested():
+                category_ids = {category.id for category in salon.categories}
                 form.populate_obj(salon)
                 salon.categories = form.categories.data
+                if {category.id for category in salon.categories} != category_ids:
+                    reset_client_exclusions([salon_id])
                 salon.city_id = form.city.data.id
                 partner = Partner.query.filter_by(salon_id=salon_id).first()
                 if partner:
                     partner.salon_id = form.id.data
                     partner.telegram_chat_id = form.telegram_chat_id.data
+                # Следующая синхронизация с Google Sheets снова применит строку салона
+                SalonSyncState.query.filter_by(salon_id=salon_id).delete()
             db.session.commit()
+            offer_catalog.invalidate()
             flash('Партнер успешно обновлен!', 'success')
         except Exception as e:
             db.session.rollback()
@@ -107,7 +199,9 @@ def delete_salon(salon_id):
         return redirect(url_for('admin.login'))
     salon = PartnerInfo.query.get_or_404(salon_id) 
     db.session.delete(salon)
+    SalonSyncState.query.filter_by(salon_id=salon_id).delete()
     db.session.commit()
+    offer_catalog.invalidate(salon.city_id)
     flash('Партнер успешно удален!', 'success')
     return redirect(url_for('admin.salons'))
 
@@ -117,7 +211,16 @@ def partners():
     if current_user.username != 'admin':
         flash('У вас нет доступа к этой странице.', 'error')
         return redirect(url_for('admin.login'))
-    partners = Partner.query.all()
+    partners = KeysetPage(
+        Partner.query.options(joinedload(Partner.user), joinedload(Partner.salon)),
+        {
+            'id': (Partner.id, lambda partner: partner.id),
+            'clients_brought': (func.coalesce(Partner.clients_brought, 0), lambda partner: partner.clients_brought or 0),
+            'clients_received': (func.coalesce(Partner.clients_received, 0), lambda partner: partner.clients_received or 0),
+            'partners_invited': (func.coalesce(Partner.partners_invited, 0), lambda partner: partner.partners_invited or 0),
+        },
+        Partner.id, lambda partner: partner.id, default_sort='id'
+    )
     return render_template('admin/partners.html', partners=partners)
 
 @bp.route('/partners/create', methods=['GET', 'POST'])
@@ -147,6 +250,7 @@ def create_partner():
         )
         db.session.add(partner)
         db.session.commit()
+        offer_catalog.invalidate()
         flash('Партнер успешно добавлен!', 'success')
         return redirect(url_for('admin.partners'))
     return render_template('admin/edit_partner.html', form=form, title='Добавить партнера')
@@ -160,6 +264,10 @@ def edit_partner(partner_id):
     partner = Partner.query.get_or_404(partner_id)
     user = User.query.get(partner.user_id)
     form = PartnerForm(obj=partner)
+    # Счетчики меняются только атомарными приращениями (app/counters.py): значение
+    # из формы устарело бы к моменту сохранения и затерло бы параллельные приращения
+    for field in PARTNER_COUNTER_FIELDS:
+        delattr(form, field)
     form.salon_id.choices = [(str(salon.id), salon.name) for salon in PartnerInfo.query.all()]
     if form.validate_on_submit():
         user.username = form.login.data
@@ -169,12 +277,8 @@ def edit_partner(partner_id):
         form.populate_obj(partner)
         partner.telegram_chat_id = form.telegram_chat_id.data
 
-        # Обновляем данные салона
-        salon = PartnerInfo.query.get(partner.salon_id)
-        salon.clients_brought = partner.clients_brought
-        salon.clients_received = partner.clients_received
-
         db.session.commit()  # Сохраняем все изменения
+        offer_catalog.invalidate()
         flash('Партнер успешно обновлен!', 'success')
         return redirect(url_for('admin.partners'))
     return render_template('admin/edit_partner.html', form=form, user=user, title='Редактировать партнера')
@@ -190,6 +294,7 @@ def delete_partner(partner_id):
     db.session.delete(partner)
     db.session.delete(user)
     db.session.commit()
+    offer_catalog.invalidate()
     flash('Партнер успешно удален!', 'success')
     return redirect(url_for('admin.partners'))    
 
@@ -199,7 +304,14 @@ def message_templates():
     if current_user.username != 'admin':
         flash('У вас нет доступа к этой странице.', 'error')
         return redirect(url_for('admin.login'))
-    message_templates = MessageTemplate.query.all()
+    message_templates = KeysetPage(
+        MessageTemplate.query,
+        {
+            'id': (MessageTemplate.id, lambda template: template.id),
+            'name': (MessageTemplate.name, lambda template: template.name),
+        },
+        MessageTemplate.id, lambda template: template.id, default_sort='id'
+    )
     return render_template('admin/message_templates.html', message_templates=message_templates)
 
 @bp.route('/message_templates/create', methods=['GET', 'POST'])
@@ -216,6 +328,7 @@ def create_message_template():
         )
         db.session.add(template)
         db.session.commit()
+        template_registry.invalidate()
         flash('Шаблон сообщения успешно добавлен!', 'success')
         return redirect(url_for('admin.message_templates'))
     return render_template('admin/edit_message_template.html', form=form, title='Добавить шаблон сообщения')
@@ -231,6 +344,7 @@ def edit_message_template(template_id):
     if form.validate_on_submit():
         form.populate_obj(template)
         db.session.commit()
+        template_registry.invalidate()
         flash('Шаблон сообщения успешно обновлен!', 'success')
         return redirect(url_for('admin.message_templates'))
     return render_template('admin/edit_message_template.html', form=form, title='Редактировать шаблон сообщения')
@@ -244,6 +358,7 @@ def delete_message_template(template_id):
     template = MessageTemplate.query.get_or_404(template_id)
     db.session.delete(template)
     db.session.commit()
+    template_registry.invalidate()
     flash('Шаблон сообщения успешно удален!', 'success')
     return redirect(url_for('admin.message_templates'))
 
@@ -258,6 +373,7 @@ def discount_weight_settings():
     if form.validate_on_submit():
         form.populate_obj(settings)
         db.session.commit()
+        offer_catalog.invalidate()
         flash('Настройки весов успешно сохранены!', 'success')
         return redirect(url_for('admin.discount_weight_settings'))
     return render_template('admin/edit_discount_weight_settings.html', form=form, title='Настройки весов скидок')   
@@ -268,7 +384,14 @@ def categories():
     if current_user.username != 'admin':
         flash('У вас нет доступа к этой странице.', 'error')
         return redirect(url_for('admin.login'))
-    categories = Category.query.all()
+    categories = KeysetPage(
+        Category.query,
+        {
+            'id': (Category.id, lambda category: category.id),
+            'name': (Category.name, lambda category: category.name),
+        },
+        Category.id, lambda category: category.id, default_sort='id'
+    )
     return render_template('admin/categories.html', categories=categories)
 
 @bp.route('/categories/create', methods=['GET', 'POST'])
@@ -310,5 +433,6 @@ def delete_category(category_id):
     category = Category.query.get_or_404(category_id)
     db.session.delete(category)
     db.session.commit()
+    offer_catalog.invalidate()
     flash('Категория успешно удалена!', 'success')
     return redirect(url_for('admin.categories'))    
\ No newline at end of file
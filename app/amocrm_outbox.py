@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from flask import current_app
+from sqlalchemy import delete, or_, select, update
+
+from app import db
+from app.models import AmoCrmOutbox, ClientsData
+from app.upsert import upsert_rows
+from app.services import (
+    create_amocrm_contact,
+    create_or_update_amocrm_lead,
+    get_amocrm_contact_id,
+    create_amocrm_contacts,
+    get_amocrm_contacts_lead_ids,
+    get_amocrm_leads,
+    find_salon_lead_id,
+    save_amocrm_leads,
+    get_known_amocrm_lead_id,
+    remember_amocrm_lead,
+    forget_amocrm_lead,
+    forget_amocrm_contact
+)
+
+# Поля клиента, которые попадают в контакт и сделку AmoCRM
+SYNC_FIELDS = (
+    'chat_id', 'client_name', 'initial_salon_name', 'initial_salon_id',
+    'claimed_salon_name', 'claimed_salon_id', 'city'
+)
+
+
+async def sync_amocrm_client(client_data: ClientsData):
+    """Синхронизирует контакт и сделку клиента с AmoCRM.
+
+    В режиме 'outbox' изменения только записываются в очередь и отправляются
+    фоновым процессом пачками, в режиме 'inline' - сразу в обработчике.
+    """
+    if current_app.config.get('AMOCRM_SYNC_MODE', 'outbox') == 'outbox':
+        enqueue_amocrm_sync(client_data)
+        return
+
+    contact_id = await create_amocrm_contact(client_data)
+    if contact_id:
+        await create_or_update_amocrm_lead(client_data, contact_id)
+
+
+def enqueue_amocrm_sync(client_data: ClientsData):
+    """Записывает текущее состояние клиента в очередь синхронизации с AmoCRM.
+
+    Запись выполняется одним INSERT ... ON CONFLICT по (клиент, исходный салон)
+    с увеличением версии и фиксируется вместе с изменениями клиента, поэтому
+    в очередь не попадает состояние, которое затем было откачено.
+    """
+    payload = {field: getattr(client_data, field) for field in SYNC_FIELDS}
+    table = AmoCrmOutbox.__table__
+    upsert_rows(
+        table,
+        [{
+            'client_id': client_data.id,
+            'initial_salon_id': client_data.initial_salon_id,
+            'payload': payload,
+            'version': 1,
+            'attempts': 0,
+            'updated_at': datetime.utcnow()
+        }],
+        ['client_id', 'initial_salon_id'], ['payload', 'updated_at'],
+        update_values={'version': table.c.version + 1}
+    )
+
+
+def lead_fields(payload: dict, with_initial: bool) -> List[dict]:
+    fields = [
+        {'field_id': 267159, 'values': [{'value': payload['claimed_salon_name']}]},
+        {'field_id': 267161, 'values': [{'value': payload['claimed_salon_id']}]}
+    ]
+    if with_initial:
+        fields = [
+            {'field_id': 267155, 'values': [{'value': payload['initial_salon_name']}]},
+            {'field_id': 267157, 'values': [{'value': payload['initial_salon_id']}]}
+        ] + fields + [
+            {'field_id': 267163, 'values': [{'value': payload['city']}]}
+        ]
+    return fields
+
+
+class AmoCrmOutboxFlusher:
+    """Фоновая отправка очереди синхронизации в AmoCRM пачками.
+
+    Раз в AMOCRM_FLUSH_INTERVAL секунд берет до AMOCRM_BATCH_SIZE записей в аренду,
+    находит или создает контакты одним запросом, загружает сделки контактов
+    фильтрованными запросами и отправляет изменения пачками PATCH/POST /leads.
+    """
+
+    LEASE = 120  # Секунд аренды записей на время отправки
+
+    def __init__(self):
+        self.app = None
+        self._flushed_total = 0
+        self._failed_total = 0
+        self._last_flush_at = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('AMOCRM_FLUSH_INTERVAL', 5)
+        self.batch_size = app.config.get('AMOCRM_BATCH_SIZE', 50)
+        if app.config.get('AMOCRM_SYNC_MODE', 'outbox') == 'outbox' and app.config.get('BACKGROUND_WORKERS', True):
+            threading.Thread(target=self._run, name='amocrm-outbox', daemon=True).start()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    while loop.run_until_complete(self.flush()) == self.batch_size:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Ошибка при отправке очереди AmoCRM: {e}")
+
+    def _claim(self) -> List[AmoCrmOutbox]:
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        is_available = or_(AmoCrmOutbox.locked_until.is_(None), AmoCrmOutbox.locked_until < now)
+        available = select(AmoCrmOutbox.id).where(is_available).order_by(AmoCrmOutbox.updated_at).limit(self.batch_size)
+        if db.engine.dialect.name == 'postgresql':
+            # Записи, которые сейчас захватывает другой процесс, пропускаются
+            available = available.with_for_update(skip_locked=True)
+        # Условие аренды проверяется повторно: запись могли захватить после выполнения подзапроса
+        claimed = db.session.execute(
+            update(AmoCrmOutbox)
+            .where(AmoCrmOutbox.id.in_(available.scalar_subquery()), is_available)
+            .values(locked_until=now + timedelta(seconds=self.LEASE), locked_by=token)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return []
+        return AmoCrmOutbox.query.filter_by(locked_by=token).all()
+
+    async def flush(self) -> int:
+        """Отправляет одну пачку записей и возвращает ее размер."""
+        entries = self._claim()
+        if not entries:
+            return 0
+        snapshot = [
+            (entry.id, entry.version, entry.attempts, entry.client_id, dict(entry.payload)) for entry in entries
+        ]
+        db.session.commit()
+
+        done = set()
+        try:
+            done = await self._send([
+                (entry_id, client_id, payload) for entry_id, _, _, client_id, payload in snapshot
+            ])
+        finally:
+            for entry_id, version, attempts, _, _ in snapshot:
+                if entry_id in done:
+                    # Удаляем, только если запись не изменилась во время отправки
+                    db.session.execute(delete(AmoCrmOutbox).where(
+                        AmoCrmOutbox.id == entry_id, AmoCrmOutbox.version == version
+                    ))
+                    db.session.execute(update(AmoCrmOutbox).where(AmoCrmOutbox.id == entry_id).values(
+                        locked_until=None, locked_by=None, attempts=0
+                    ))
+                else:
+                    db.session.execute(update(AmoCrmOutbox).where(AmoCrmOutbox.id == entry_id).values(
+                        locked_until=datetime.utcnow() + timedelta(seconds=min(2 ** attempts * self.interval, 3600)),
+                        locked_by=None,
+                        attempts=attempts + 1
+                    ))
+            db.session.commit()
+        self._flushed_total += len(done)
+        self._failed_total += len(snapshot) - len(done)
+        self._last_flush_at = time.time()
+        return len(snapshot)
+
+    async def _send(self, entries: List[tuple]) -> set:
+        """Отправляет записи в AmoCRM и возвращает ID успешно отправленных.
+
+        Записи с уже известной сделкой сразу попадают в пачку PATCH; поиск контактов
+        и сделок выполняется только для записей, сделка которых еще не сохранена.
+        """
+        done = set()
+        known, unknown = [], []
+        for entry_id, client_id, payload in entries:
+            lead_id = get_known_amocrm_lead_id(client_id, payload['initial_salon_id'])
+            if lead_id:
+                known.append((entry_id, client_id, payload, lead_id))
+            else:
+                unknown.append((entry_id, client_id, payload))
+
+        if known:
+            updates = [{'id': lead_id, 'custom_fields_values': lead_fields(payload, False)} for _, _, payload, lead_id in known]
+            if await save_amocrm_leads('PATCH', updates) is not None:
+                done.update(entry_id for entry_id, _, _, _ in known)
+            else:
+                # Пачка могла не пройти из-за удаленной в AmoCRM сделки: проверяем сохраненные ID
+                existing = await get_amocrm_leads(sorted({lead_id for _, _, _, lead_id in known}))
+                if existing is not None:
+                    existing_ids = {lead['id'] for lead in existing}
+                    for entry_id, client_id, payload, lead_id in known:
+                        if lead_id not in existing_ids:
+                            forget_amocrm_lead(client_id, payload['initial_salon_id'])
+                            unknown.append((entry_id, client_id, payload))
+
+        if unknown:
+            done.update(await self._discover_and_send(unknown))
+        logging.info(
+            f"Очередь AmoCRM: записей {len(entries)}, по сохраненным сделкам {len(known)}, успешно {len(done)}"
+        )
+        return done
+
+    async def _discover_and_send(self, entries: List[tuple]) -> set:
+        """Находит контакты и сделки для записей без сохраненной сделки и отправляет изменения."""
+        # --- Контакты: находим существующие, недостающие создаем одним запросом ---
+        names: Dict[str, str] = {}
+        for _, _, payload in entries:
+            names[payload['chat_id']] = payload['client_name']
+        contact_ids: Dict[str, int] = {}
+        for chat_id in names:
+            # Номер, новый для бота, может уже быть в AmoCRM: поиск выполняется всегда,
+            # иначе пакетное создание сделало бы дубль контакта
+            contact_id = await get_amocrm_contact_id(chat_id)
+            if contact_id:
+                contact_ids[chat_id] = contact_id
+
+        # --- Сделки: все сделки контактов загружаются пачками и сопоставляются в памяти ---
+        contacts_leads = await get_amocrm_contacts_lead_ids(sorted(set(contact_ids.values())))
+        if contacts_leads is None:
+            return set()
+        for chat_id, contact_id in list(contact_ids.items()):
+            if contact_id not in contacts_leads:
+                # Контакт удален в AmoCRM - создадим его заново
+                forget_amocrm_contact(chat_id)
+                del contact_ids[chat_id]
+
+        missing = {chat_id: name for chat_id, name in names.items() if chat_id not in contact_ids}
+        if missing:
+            created = await create_amocrm_contacts(missing)
+            if created is None:
+                return set()
+            contact_ids.update(created)
+
+        leads = await get_amocrm_leads(sorted({
+            lead_id for lead_ids in contacts_leads.values() for lead_id in lead_ids
+        }))
+        if leads is None:
+            return set()
+        leads_by_id = {lead['id']: lead for lead in leads}
+
+        updates, creates = [], []
+        for entry_id, client_id, payload in entries:
+            contact_id = contact_ids.get(payload['chat_id'])
+            if not contact_id:
+                continue
+            contact_leads = [leads_by_id[lead_id] for lead_id in contacts_leads.get(contact_id, []) if lead_id in leads_by_id]
+            lead_id = find_salon_lead_id(contact_leads, payload['initial_salon_id'])
+            if lead_id:
+                remember_amocrm_lead(client_id, payload['initial_salon_id'], lead_id)
+                updates.append((entry_id, {'id': lead_id, 'custom_fields_values': lead_fields(payload, False)}))
+            else:
+                creates.append((entry_id, client_id, payload, {
+                    'name': 'Сделка из WhatsApp',
+                    'request_id': str(entry_id),
+                    '_embedded': {'contacts': [{'id': contact_id}]},
+                    'custom_fields_values': lead_fields(payload, True)
+                }))
+
+        done = set()
+        if updates and await save_amocrm_leads('PATCH', [lead for _, lead in updates]) is not None:
+            done.update(entry_id for entry_id, _ in updates)
+        if creates:
+            created = await save_amocrm_leads('POST', [lead for _, _, _, lead in creates])
+            if created is not None:
+                created_ids = {str(lead.get('request_id')): lead['id'] for lead in created}
+                for entry_id, client_id, payload, _ in creates:
+                    if str(entry_id) in created_ids:
+                        remember_amocrm_lead(client_id, payload['initial_salon_id'], created_ids[str(entry_id)])
+                done.update(entry_id for entry_id, _, _, _ in creates)
+        logging.info(f"Очередь AmoCRM: найдено сделок {len(updates)}, создано {len(creates)}")
+        return done
+
+    def stats(self) -> dict:
+        """Возвращает размер очереди и счетчики отправки."""
+        pending = db.session.query(AmoCrmOutbox).count()
+        return {
+            'pending': pending,
+            'flushed_total': self._flushed_total,
+            'failed_total': self._failed_total,
+            'last_flush_age': round(time.time() - self._last_flush_at, 1) if self._last_flush_at else None,
+        }
+
+
+amocrm_outbox = AmoCrmOutboxFlusher()
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Optional
+
+
+class BackgroundLoop:
+    """Долгоживущий event loop в отдельном потоке для общих асинхронных клиентов.
+
+    Flask выполняет async-обработчики в собственных короткоживущих циклах, а пулы
+    соединений привязаны к циклу, в котором созданы. Поэтому долгоживущие клиенты
+    (HTTP, Telegram) работают в этом цикле, а вызывающий код ожидает результат из своего.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='background-loop', daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro: Awaitable) -> Future:
+        """Запускает корутину в фоновом цикле и возвращает concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro: Awaitable):
+        """Выполняет корутину в фоновом цикле и дожидается результата из текущего цикла."""
+        if asyncio.get_running_loop() is self._loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+
+background_loop = BackgroundLoop()
@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict
+
+from flask import current_app
+from sqlalchemy import delete, event, func, insert, select, update
+
+from app import db
+from app.models import CounterEvent, Partner, PartnerInfo
+from app.offer_catalog import offer_catalog
+
+# Счетчики салона: в partner_info хранятся клиенты, в partners - все три
+SALON_COUNTER_FIELDS = ('clients_brought', 'clients_received')
+PARTNER_COUNTER_FIELDS = ('clients_brought', 'clients_received', 'partners_invited')
+
+
+def increment_salon_counters(salon_id: str, **deltas: int):
+    """Увеличивает счетчики салона и его партнера.
+
+    В режиме COUNTER_MODE='atomic' счетчики сразу увеличиваются выражением на стороне
+    БД (SET x = x + n), в режиме 'events' изменение только записывается в counter_events,
+    а в partner_info и partners его переносит фоновый агрегатор. Запись выполняется
+    в текущей транзакции обработки сообщения, а каталог предложений изменяется только
+    после ее фиксации.
+    """
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    if current_app.config.get('COUNTER_MODE', 'atomic') == 'events':
+        now = datetime.utcnow()
+        db.session.execute(insert(CounterEvent), [
+            {'salon_id': salon_id, 'field': field, 'delta': delta, 'created_at': now}
+            for field, delta in deltas.items()
+        ])
+    else:
+        apply_counter_deltas({salon_id: deltas})
+    pending = db.session.info.setdefault('catalog_deltas', defaultdict(lambda: defaultdict(int)))
+    for field, delta in deltas.items():
+        pending[salon_id][field] += delta
+
+
+def _adjust_catalog(session):
+    for salon_id, deltas in session.info.pop('catalog_deltas', {}).items():
+        offer_catalog.adjust(salon_id, **deltas)
+
+
+def _discard_catalog_deltas(session):
+    session.info.pop('catalog_deltas', None)
+
+
+def apply_counter_deltas(deltas: Dict[str, Dict[str, int]]):
+    """Прибавляет изменения {ID салона: {счетчик: изменение}} к partner_info и partners."""
+    for salon_id, fields in deltas.items():
+        salon_values = {
+            field: func.coalesce(getattr(PartnerInfo, field), 0) + delta
+            for field, delta in fields.items() if field in SALON_COUNTER_FIELDS and delta
+        }
+        if salon_values:
+            db.session.execute(update(PartnerInfo).where(PartnerInfo.id == salon_id).values(salon_values))
+        partner_values = {
+            field: func.coalesce(getattr(Partner, field), 0) + delta
+            for field, delta in fields.items() if field in PARTNER_COUNTER_FIELDS and delta
+        }
+        if partner_values:
+            db.session.execute(update(Partner).where(Partner.salon_id == salon_id).values(partner_values))
+
+
+class CounterAggregator:
+    """Фоновый перенос событий счетчиков в partner_info и partners.
+
+    Раз в COUNTER_FLUSH_INTERVAL секунд события удаляются из counter_events
+    (DELETE ... RETURNING) и суммируются, после чего каждый салон обновляется
+    одним UPDATE в той же транзакции. Одновременные агрегаторы в разных процессах
+    не учитывают событие дважды: удаленную другим процессом строку DELETE не вернет.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._folded_total = 0
+        self._last_flush_at = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('COUNTER_FLUSH_INTERVAL', 10)
+        if not event.contains(db.session, 'after_commit', _adjust_catalog):
+            event.listen(db.session, 'after_commit', _adjust_catalog)
+            event.listen(db.session, 'after_rollback', _discard_catalog_deltas)
+        if app.config.get('COUNTER_MODE', 'atomic') == 'events' and app.config.get('BACKGROUND_WORKERS', True):
+            threading.Thread(target=self._run, name='counter-aggregator', daemon=True).start()
+
+    def _take_events(self) -> list:
+        if db.engine.dialect.name in ('postgresql', 'sqlite'):
+            return db.session.execute(
+                delete(CounterEvent).returning(CounterEvent.salon_id, CounterEvent.field, CounterEvent.delta)
+            ).all()
+        rows = db.session.execute(
+            select(CounterEvent.id, CounterEvent.salon_id, CounterEvent.field, CounterEvent.delta).with_for_update()
+        ).all()
+        if rows:
+            db.session.execute(delete(CounterEvent).where(CounterEvent.id.in_([row[0] for row in rows])))
+        return [row[1:] for row in rows]
+
+    def flush(self) -> int:
+        """Переносит накопленные события в счетчики и возвращает их число."""
+        events = self._take_events()
+        deltas: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        for salon_id, field, delta in events:
+            deltas[salon_id][field] += delta
+        apply_counter_deltas(deltas)
+        db.session.commit()
+        self._folded_total += len(events)
+        self._last_flush_at = time.time()
+        return len(events)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Ошибка при переносе событий счетчиков: {e}")
+
+    def stats(self) -> dict:
+        """Возвращает число ожидающих событий и счетчики переноса."""
+        return {
+            'pending': db.session.query(func.count(CounterEvent.id)).scalar(),
+            'folded_total': self._folded_total,
+            'last_flush_age': round(time.time() - self._last_flush_at, 1) if self._last_flush_at else None,
+        }
+
+
+counter_aggregator = CounterAggregator()
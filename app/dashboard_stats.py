@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict
+
+from sqlalchemy import delete, distinct, event, func, insert, inspect, select, text, update
+
+from app import db
+from app.models import ClientsData, DashboardStat, DashboardStatEvent, Partner, PartnerInfo
+from app.upsert import ON_CONFLICT_DIALECTS, upsert_rows
+
+# Счетчики строк таблиц, которые поддерживаются при вставке и удалении через ORM
+TRACKED_MODELS = {
+    PartnerInfo: 'salons',
+    Partner: 'partners',
+    ClientsData: 'clients',
+}
+
+
+def claims_stat(day) -> str:
+    """Возвращает имя показателя «получено скидок» за день."""
+    return f'claims:{day.isoformat()}'
+
+
+def increment_stat(connection, name: str, delta: int = 1):
+    """Записывает изменение показателя на delta в журнал в транзакции connection.
+
+    Строка показателя не блокируется: в dashboard_stats изменение переносит фоновый поток.
+    """
+    connection.execute(insert(DashboardStatEvent.__table__).values(name=name, delta=delta, created_at=datetime.utcnow()))
+
+
+def _apply_stat(connection, name: str, delta: int):
+    """Прибавляет delta к показателю, создавая его при отсутствии."""
+    table = DashboardStat.__table__
+    now = datetime.utcnow()
+    dialect_insert = ON_CONFLICT_DIALECTS.get(connection.dialect.name)
+    if dialect_insert is not None:
+        statement = dialect_insert(table).values(name=name, value=delta, updated_at=now)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'value': table.c.value + statement.excluded.value, 'updated_at': statement.excluded.updated_at}
+        ))
+        return
+    updated = connection.execute(
+        update(table).where(table.c.name == name).values(value=table.c.value + delta, updated_at=now)
+    ).rowcount
+    if not updated:
+        connection.execute(insert(table).values(name=name, value=delta, updated_at=now))
+
+
+def _after_insert(mapper, connection, target):
+    increment_stat(connection, TRACKED_MODELS[mapper.class_], 1)
+
+
+def _after_delete(mapper, connection, target):
+    increment_stat(connection, TRACKED_MODELS[mapper.class_], -1)
+
+
+def _after_client_update(mapper, connection, target):
+    history = inspect(target).attrs.discount_claimed.history
+    if history.has_changes() and target.discount_claimed:
+        increment_stat(connection, claims_stat(datetime.utcnow().date()), 1)
+
+
+class DashboardStats:
+    """Предрассчитанные показатели главной страницы админки (таблица dashboard_stats).
+
+    При вставке и удалении салона, партнера или клиента через ORM и при отметке
+    discount_claimed изменение показателя записывается в журнал dashboard_stat_events
+    в той же транзакции, а в dashboard_stats его раз в DASHBOARD_STATS_FOLD_INTERVAL
+    секунд переносит фоновый поток (DELETE ... RETURNING, как у счетчиков салонов),
+    поэтому обработчики не ждут блокировку строк показателей. Главная страница
+    прибавляет еще не перенесенные изменения. Изменения в обход ORM (пакетная
+    синхронизация салонов, каскадное удаление в БД) исправляет фоновый пересчет раз
+    в DASHBOARD_STATS_INTERVAL секунд.
+    """
+
+    # Сколько дней хранить показатели «получено скидок за день»
+    DAILY_RETENTION_DAYS = 90
+
+    def __init__(self):
+        self.app = None
+        self.interval = 600
+        self.fold_interval = 10
+        self._refreshed_at = None
+        self._folded_total = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('DASHBOARD_STATS_INTERVAL', self.interval)
+        self.fold_interval = app.config.get('DASHBOARD_STATS_FOLD_INTERVAL', self.fold_interval)
+        for model in TRACKED_MODELS:
+            if not event.contains(model, 'after_insert', _after_insert):
+                event.listen(model, 'after_insert', _after_insert)
+                event.listen(model, 'after_delete', _after_delete)
+        if not event.contains(ClientsData, 'after_update', _after_client_update):
+            event.listen(ClientsData, 'after_update', _after_client_update)
+        if (self.interval or self.fold_interval) and app.config.get('BACKGROUND_WORKERS', True):
+            threading.Thread(target=self._run, name='dashboard-stats', daemon=True).start()
+
+    def _take_events(self) -> list:
+        table = DashboardStatEvent.__table__
+        if db.engine.dialect.name in ('postgresql', 'sqlite'):
+            return db.session.execute(delete(table).returning(table.c.name, table.c.delta)).all()
+        rows = db.session.execute(select(table.c.id, table.c.name, table.c.delta).with_for_update()).all()
+        if rows:
+            db.session.execute(delete(table).where(table.c.id.in_([row[0] for row in rows])))
+        return [row[1:] for row in rows]
+
+    def _fold(self) -> int:
+        events = self._take_events()
+        deltas: Dict[str, int] = defaultdict(int)
+        for name, delta in events:
+            deltas[name] += delta
+        connection = db.session.connection()
+        for name, delta in deltas.items():
+            if delta:
+                _apply_stat(connection, name, delta)
+        self._folded_total += len(events)
+        return len(events)
+
+    def fold(self) -> int:
+        """Переносит изменения показателей из журнала в dashboard_stats и возвращает их число."""
+        folded = self._fold()
+        db.session.commit()
+        return folded
+
+    def refresh(self):
+        """Пересчитывает показатели по исходным таблицам."""
+        # Журнал переносится в той же транзакции, иначе его изменения добавились бы к пересчитанным итогам.
+        # На PostgreSQL (READ COMMITTED) журнал блокируется от записи до фиксации: иначе строка,
+        # зафиксированная между переносом и подсчетом, вошла бы в COUNT(*), а ее изменение
+        # осталось бы в журнале и было бы учтено второй раз. На SQLite запись и так
+        # последовательна: удаление журнала удерживает блокировку базы до фиксации.
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text(f'LOCK TABLE {DashboardStatEvent.__tablename__} IN EXCLUSIVE MODE'))
+        self._fold()
+        now = datetime.utcnow()
+        values = {
+            'salons': db.session.scalar(select(func.count()).select_from(PartnerInfo)),
+            'partners': db.session.scalar(select(func.count()).select_from(Partner)),
+            'clients': db.session.scalar(select(func.count()).select_from(ClientsData)),
+            'active_cities': db.session.scalar(select(func.count(distinct(PartnerInfo.city_id)))),
+        }
+        upsert_rows(
+            DashboardStat.__table__,
+            [{'name': name, 'value': value, 'updated_at': now} for name, value in values.items()],
+            ['name'], ['value', 'updated_at']
+        )
+        oldest = claims_stat((now - timedelta(days=self.DAILY_RETENTION_DAYS)).date())
+        db.session.execute(delete(DashboardStat).where(DashboardStat.name.like('claims:%'), DashboardStat.name < oldest))
+        db.session.commit()
+        self._refreshed_at = now
+
+    def get(self) -> Dict[str, int]:
+        """Возвращает показатели главной страницы, при первом обращении рассчитывая их."""
+        stats = dict(db.session.query(DashboardStat.name, DashboardStat.value))
+        if 'clients' not in stats:
+            self.refresh()
+            stats = dict(db.session.query(DashboardStat.name, DashboardStat.value))
+        pending = db.session.query(DashboardStatEvent.name, func.sum(DashboardStatEvent.delta)).group_by(DashboardStatEvent.name)
+        for name, delta in pending:
+            stats[name] = stats.get(name, 0) + delta
+        stats['claims_today'] = stats.get(claims_stat(datetime.utcnow().date()), 0)
+        return stats
+
+    def _run(self):
+        next_refresh = time.monotonic() + self.interval
+        while True:
+            time.sleep(min(interval for interval in (self.interval, self.fold_interval) if interval))
+            with self.app.app_context():
+                try:
+                    if self.interval and time.monotonic() >= next_refresh:
+                        next_refresh = time.monotonic() + self.interval
+                        self.refresh()
+                    elif self.fold_interval:
+                        self.fold()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Ошибка при пересчете показателей админки: {e}")
+
+    def stats(self) -> dict:
+        """Возвращает время последнего пересчета показателей и число перенесенных изменений."""
+        return {
+            'interval': self.interval,
+            'fold_interval': self.fold_interval,
+            'pending': db.session.query(func.count(DashboardStatEvent.id)).scalar(),
+            'folded_total': self._folded_total,
+            'refreshed_at': self._refreshed_at.isoformat() if self._refreshed_at else None,
+        }
+
+
+dashboard_stats = DashboardStats()
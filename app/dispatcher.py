@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Awaitable, Callable, List
+
+from sqlalchemy import event
+
+from app import db
+
+
+class PartiallyCommittedError(Exception):
+    """Обработчик завершился ошибкой после промежуточного коммита: часть его изменений уже сохранена.
+
+    Повторная обработка такого сообщения выполнила бы сохраненные изменения второй раз.
+    """
+
+    def __init__(self, error: BaseException):
+        super().__init__(str(error))
+        self.error = error
+
+
+def _mark_committed(session):
+    session.info['handler_committed'] = True
+
+
+class ChatDispatcher:
+    """Распределяет обработку входящих сообщений по последовательным полосам.
+
+    Полоса выбирается по хэшу chat_id, поэтому сообщения одного чата обрабатываются
+    строго по очереди, а сообщения разных чатов - параллельно в разных полосах.
+    Каждая полоса - отдельный поток со своим event loop и контекстом приложения.
+    Обработчик - единица работы: его изменения в БД фиксируются одним коммитом
+    после завершения (или откатываются при ошибке), промежуточные коммиты делаются
+    обработчиком только перед внешними действиями, зависящими от сохраненных данных.
+    Ошибка обработчика после промежуточного коммита возвращается как PartiallyCommittedError.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.lane_count = 0
+        self._lanes: List[queue.Queue] = []
+        self._processed: List[int] = []
+        self._busy: List[bool] = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.lane_count = app.config.get('CHAT_DISPATCHER_LANES', 32)
+        if not event.contains(db.session, 'after_commit', _mark_committed):
+            event.listen(db.session, 'after_commit', _mark_committed)
+
+    def lane_for(self, chat_id: str) -> int:
+        return zlib.crc32(chat_id.encode('utf-8')) % self.lane_count
+
+    def _start(self):
+        with self._lock:
+            if self._lanes:
+                return
+            lanes = [queue.Queue() for _ in range(self.lane_count)]
+            self._processed = [0] * self.lane_count
+            self._busy = [False] * self.lane_count
+            for number, lane in enumerate(lanes):
+                threading.Thread(
+                    target=self._run_lane, args=(number, lane), name=f'chat-lane-{number}', daemon=True
+                ).start()
+            self._lanes = lanes
+            logging.info(f"Диспетчер сообщений запущен: {self.lane_count} полос")
+
+    def submit(self, chat_id: str, handler: Callable[..., Awaitable], *args) -> Future:
+        """Ставит обработчик в полосу чата и возвращает Future с его результатом."""
+        if not self._lanes:
+            self._start()
+        future = Future()
+        self._lanes[self.lane_for(chat_id)].put((handler, args, future))
+        return future
+
+    async def dispatch(self, chat_id: str, handler: Callable[..., Awaitable], *args):
+        """Выполняет обработчик в полосе чата и дожидается результата."""
+        return await asyncio.wrap_future(self.submit(chat_id, handler, *args))
+
+    def _run_lane(self, number: int, lane: queue.Queue):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            handler, args, future = lane.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._busy[number] = True
+            try:
+                with self.app.app_context():
+                    db.session.info.pop('handler_committed', None)
+                    try:
+                        result = loop.run_until_complete(handler(*args))
+                        db.session.commit()
+                    except BaseException as e:
+                        committed = db.session.info.pop('handler_committed', False)
+                        db.session.rollback()
+                        if committed and isinstance(e, Exception):
+                            raise PartiallyCommittedError(e) from e
+                        raise
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._busy[number] = False
+                self._processed[number] += 1
+
+    def stats(self) -> dict:
+        """Возвращает число полос, глубину очередей и признаки перегрузки отдельных полос."""
+        if not self._lanes:
+            return {'lanes': self.lane_count, 'started': False}
+        depths = [lane.qsize() for lane in self._lanes]
+        processed = list(self._processed)
+        total = sum(processed)
+        mean = total / len(processed) if processed else 0
+        hottest = max(range(len(processed)), key=processed.__getitem__) if processed else None
+        return {
+            'lanes': self.lane_count,
+            'started': True,
+            'busy': sum(self._busy),
+            'queued': sum(depths),
+            'depths': depths,
+            'max_depth': max(depths) if depths else 0,
+            'processed': processed,
+            'processed_total': total,
+            'hottest_lane': hottest,
+            'hotspot_ratio': round(processed[hottest] / mean, 2) if mean else 0,
+        }
+
+
+chat_dispatcher = ChatDispatcher()
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import Date, case, delete, func, insert, select, type_coerce
+
+from app import db
+from app.models import City, FunnelDaily, FunnelEvent, FunnelRollupState, PartnerInfo
+from app.upsert import upsert_rows
+
+# Шаги воронки и соответствующие им столбцы funnel_daily
+FUNNEL_STAGES = {
+    'start': 'starts',
+    'offer': 'offers',
+    'accept': 'accepts',
+    'reject': 'rejects',
+    'claim': 'claims',
+}
+FUNNEL_COLUMNS = tuple(FUNNEL_STAGES.values())
+
+
+def record_funnel_event(stage: str, salon_id: str, client_id: Optional[int] = None):
+    """Записывает шаг клиента в воронке в текущей транзакции обработки сообщения."""
+    db.session.execute(insert(FunnelEvent).values(
+        stage=stage, salon_id=salon_id, client_id=client_id, created_at=datetime.utcnow()
+    ))
+
+
+class FunnelRollup:
+    """Перенос событий воронки в дневные итоги по городам и салонам.
+
+    Фоновый поток раз в FUNNEL_ROLLUP_INTERVAL секунд пересчитывает итоги дней,
+    в которые могли попасть новые события: начиная с дня, предшествовавшего прошлому
+    пересчету на FUNNEL_ROLLUP_LAG секунд (funnel_rollup_state.rolled_up_at), и до
+    сегодняшнего. Итоги этих дней заново считаются одним GROUP BY по funnel_events
+    и записываются в funnel_daily целиком, поэтому событие транзакции, зафиксированной
+    позже пересчета (но не позже FUNNEL_ROLLUP_LAG), учитывается следующим пересчетом.
+    События дней до начала этого окна уже учтены окончательно и удаляются. Пересчеты
+    в нескольких процессах выполняются по очереди под блокировкой строки
+    funnel_rollup_state. Первый пересчет обрабатывает все события. Отчеты читают
+    только funnel_daily.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 60
+        self.lag = 60
+        self._counted_total = 0
+        self._deleted_total = 0
+        self._last_run = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('FUNNEL_ROLLUP_INTERVAL', self.interval)
+        self.lag = app.config.get('FUNNEL_ROLLUP_LAG', self.lag)
+        if self.interval and app.config.get('BACKGROUND_WORKERS', True):
+            threading.Thread(target=self._run, name='funnel-rollup', daemon=True).start()
+
+    def rollup(self) -> int:
+        """Пересчитывает итоги дней, в которые могли попасть новые события, и возвращает число учтенных событий."""
+        now = datetime.utcnow()
+        rolled_up_at = db.session.execute(
+            select(FunnelRollupState.rolled_up_at).where(FunnelRollupState.id == 1).with_for_update()
+        ).scalar()
+        day = type_coerce(func.date(FunnelEvent.created_at), Date)
+        city_id = func.coalesce(PartnerInfo.city_id, 0)
+        statement = (
+            select(day, city_id, FunnelEvent.salon_id, *(
+                func.sum(case((FunnelEvent.stage == stage, 1), else_=0)) for stage in FUNNEL_STAGES
+            ))
+            .outerjoin(PartnerInfo, PartnerInfo.id == FunnelEvent.salon_id)
+            .where(FunnelEvent.stage.in_(FUNNEL_STAGES))
+            .group_by(day, city_id, FunnelEvent.salon_id)
+        )
+        since = None
+        if rolled_up_at is not None:
+            since = datetime.combine((rolled_up_at - timedelta(seconds=self.lag)).date(), datetime.min.time())
+            statement = statement.where(FunnelEvent.created_at >= since)
+
+        rows = []
+        count = 0
+        for event_day, event_city_id, salon_id, *counts in db.session.execute(statement):
+            rows.append({'day': event_day, 'city_id': event_city_id, 'salon_id': salon_id, **dict(zip(FUNNEL_COLUMNS, counts))})
+            count += sum(counts)
+        upsert_rows(FunnelDaily.__table__, rows, ['day', 'city_id', 'salon_id'], FUNNEL_COLUMNS)
+        deleted = 0
+        if since is not None:
+            deleted = db.session.execute(delete(FunnelEvent).where(FunnelEvent.created_at < since)).rowcount
+        upsert_rows(FunnelRollupState.__table__, [{'id': 1, 'rolled_up_at': now}], ['id'], ['rolled_up_at'])
+        db.session.commit()
+        self._counted_total += count
+        self._deleted_total += deleted
+        self._last_run = now
+        return count
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    count = self.rollup()
+                    if count:
+                        logging.info(f"Дневные итоги воронки пересчитаны, учтено событий: {count}")
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Ошибка при пересчете итогов воронки: {e}")
+
+    def stats(self) -> dict:
+        """Возвращает время последнего пересчета, число учтенных и удаленных событий."""
+        return {
+            'interval': self.interval,
+            'last_run': self._last_run.isoformat() if self._last_run else None,
+            'counted_total': self._counted_total,
+            'deleted_total': self._deleted_total,
+        }
+
+
+def _totals(columns) -> list:
+    return [func.sum(getattr(FunnelDaily, column)).label(column) for column in columns]
+
+
+def funnel_by_city(since: date) -> List[dict]:
+    """Возвращает итоги воронки по городам с даты since."""
+    rows = db.session.execute(
+        select(FunnelDaily.city_id, City.name, *_totals(FUNNEL_COLUMNS))
+        .outerjoin(City, City.id == FunnelDaily.city_id)
+        .where(FunnelDaily.day >= since)
+        .group_by(FunnelDaily.city_id, City.name)
+        .order_by(func.sum(FunnelDaily.starts).desc())
+    ).all()
+    return [dict(row._mapping) for row in rows]
+
+
+def funnel_by_salon(since: date, city_id: Optional[int] = None, limit: int = 200) -> List[dict]:
+    """Возвращает итоги воронки по салонам с даты since (самые активные салоны первыми)."""
+    statement = (
+        select(FunnelDaily.salon_id, PartnerInfo.name, *_totals(FUNNEL_COLUMNS))
+        .outerjoin(PartnerInfo, PartnerInfo.id == FunnelDaily.salon_id)
+        .where(FunnelDaily.day >= since)
+        .group_by(FunnelDaily.salon_id, PartnerInfo.name)
+        .order_by(func.sum(FunnelDaily.starts).desc(), FunnelDaily.salon_id)
+        .limit(limit)
+    )
+    if city_id is not None:
+        statement = statement.where(FunnelDaily.city_id == city_id)
+    return [dict(row._mapping) for row in db.session.execute(statement).all()]
+
+
+def funnel_by_day(salon_id: str, since: date) -> List[dict]:
+    """Возвращает воронку салона по дням с даты since."""
+    rows = db.session.execute(
+        select(FunnelDaily.day, *_totals(FUNNEL_COLUMNS))
+        .where(FunnelDaily.salon_id == salon_id, FunnelDaily.day >= since)
+        .group_by(FunnelDaily.day)
+        .order_by(FunnelDaily.day.desc())
+    ).all()
+    return [dict(row._mapping) for row in rows]
+
+
+funnel_rollup = FunnelRollup()
@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+from app.background_loop import background_loop
+
+try:
+    import h2  # noqa: F401  HTTP/2 доступен только при установленном пакете h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class HttpClient:
+    """Общий асинхронный HTTP-клиент с пулом keep-alive соединений.
+
+    Используется для отправки сообщений в WHAPI и других внешних интеграций:
+    соединения переиспользуются между запросами (без повторного TCP+TLS рукопожатия),
+    а запросы не занимают потоки стандартного executor.
+    """
+
+    def __init__(self):
+        self.pool_size = 100
+        self.keepalive = 20
+        self.timeout = 10.0
+        self.http2 = HTTP2_AVAILABLE
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats_lock = threading.Lock()
+        self._requests_total = 0
+        self._errors_total = 0
+        self._in_flight = 0
+        self._latency_total = 0.0
+
+    def init_app(self, app):
+        self.pool_size = app.config.get('HTTP_POOL_SIZE', self.pool_size)
+        self.keepalive = app.config.get('HTTP_POOL_KEEPALIVE', self.keepalive)
+        self.timeout = app.config.get('HTTP_TIMEOUT', self.timeout)
+        self.http2 = app.config.get('HTTP2_ENABLED', True) and HTTP2_AVAILABLE
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Вызывается только из фонового цикла, поэтому дополнительная блокировка не нужна
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.keepalive),
+            )
+            logging.info(f"HTTP-клиент создан: пул {self.pool_size}, HTTP/2: {self.http2}")
+        return self._client
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self._get_client().request(method, url, **kwargs)
+
+    async def request(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+        """Выполняет HTTP-запрос через общий пул соединений."""
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        started = time.perf_counter()
+        with self._stats_lock:
+            self._in_flight += 1
+        try:
+            return await background_loop.run(self._request(method, url, **kwargs))
+        except httpx.HTTPError:
+            with self._stats_lock:
+                self._errors_total += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+                self._requests_total += 1
+                self._latency_total += time.perf_counter() - started
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('PATCH', url, **kwargs)
+
+    def stats(self) -> dict:
+        """Возвращает число запросов, ошибок и среднюю задержку."""
+        with self._stats_lock:
+            return {
+                'http2': self.http2,
+                'pool_size': self.pool_size,
+                'in_flight': self._in_flight,
+                'requests_total': self._requests_total,
+                'errors_total': self._errors_total,
+                'avg_latency_ms': round(self._latency_total / self._requests_total * 1000, 2)
+                if self._requests_total else 0,
+            }
+
+
+http_client = HttpClient()
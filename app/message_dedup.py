@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import ProcessedMessage
+from app.upsert import ON_CONFLICT_DIALECTS
+
+
+class MessageDeduplicator:
+    """Защита от повторной обработки сообщений WHAPI по ID сообщения.
+
+    WHAPI повторяет доставку webhook, если обработчик отвечает медленно, поэтому
+    каждое сообщение перед обработкой «занимается» по своему ID. Занятые ID хранятся
+    в LRU в памяти процесса (до MESSAGE_DEDUP_SIZE записей на MESSAGE_DEDUP_TTL секунд),
+    а при MESSAGE_DEDUP_SHARED - еще и в таблице processed_messages, общей для всех
+    процессов: занятие выполняется одним INSERT ... ON CONFLICT по первичному ключу.
+    Если обработка сообщения завершилась ошибкой, ID освобождается, чтобы повторная
+    доставка обработала его заново.
+    """
+
+    # Как часто (в секундах) удалять из таблицы устаревшие ID
+    PURGE_INTERVAL = 600
+
+    def __init__(self):
+        self.ttl = 86400
+        self.max_size = 100000
+        self.shared = False
+        self._seen: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+        self._claimed_total = 0
+        self._duplicates_total = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('MESSAGE_DEDUP_TTL', self.ttl)
+        self.max_size = app.config.get('MESSAGE_DEDUP_SIZE', self.max_size)
+        self.shared = app.config.get('MESSAGE_DEDUP_SHARED', self.shared)
+
+    def _claim_local(self, message_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._seen.get(message_id)
+            if expires_at is not None and expires_at > now:
+                self._seen.move_to_end(message_id)
+                return False
+            self._seen[message_id] = now + self.ttl
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def _claim_shared(self, message_id: str) -> bool:
+        now = datetime.utcnow()
+        expired = now - timedelta(seconds=self.ttl)
+        table = ProcessedMessage.__table__
+        insert = ON_CONFLICT_DIALECTS.get(db.engine.dialect.name)
+        # Занятие выполняется в отдельной транзакции, чтобы его сразу видели другие процессы
+        with db.engine.begin() as connection:
+            if insert is not None:
+                statement = insert(table).values(message_id=message_id, received_at=now)
+                statement = statement.on_conflict_do_update(
+                    index_elements=['message_id'],
+                    set_={'received_at': statement.excluded.received_at},
+                    where=table.c.received_at < expired
+                )
+                claimed = connection.execute(statement).rowcount == 1
+            else:
+                claimed = None
+            if time.monotonic() - self._purged_at > self.PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                connection.execute(delete(table).where(table.c.received_at < expired))
+        if claimed is not None:
+            return claimed
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values(message_id=message_id, received_at=now))
+            return True
+        except IntegrityError:
+            with db.engine.begin() as connection:
+                return connection.execute(
+                    update(table)
+                    .where(table.c.message_id == message_id, table.c.received_at < expired)
+                    .values(received_at=now)
+                ).rowcount == 1
+
+    def claim(self, message_id: str) -> bool:
+        """Занимает ID сообщения. Возвращает False, если сообщение уже обрабатывалось."""
+        if not message_id:
+            return True
+        claimed = self._claim_local(message_id)
+        if claimed and self.shared:
+            try:
+                claimed = self._claim_shared(message_id)
+            except Exception as e:
+                # Недоступность общей таблицы не должна останавливать обработку сообщений
+                logging.error(f"Ошибка при проверке повтора сообщения {message_id}: {e}")
+        if claimed:
+            self._claimed_total += 1
+        else:
+            self._duplicates_total += 1
+            logging.info(f"Сообщение {message_id} уже обрабатывалось, повторная доставка пропущена")
+        return claimed
+
+    def release(self, message_id: str):
+        """Освобождает ID сообщения, обработка которого завершилась ошибкой."""
+        if not message_id:
+            return
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.shared:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(delete(ProcessedMessage.__table__).where(
+                        ProcessedMessage.__table__.c.message_id == message_id
+                    ))
+            except Exception as e:
+                logging.error(f"Ошибка при освобождении ID сообщения {message_id}: {e}")
+
+    def stats(self) -> dict:
+        """Возвращает размер LRU и число принятых и отброшенных сообщений."""
+        return {
+            'shared': self.shared,
+            'size': len(self._seen),
+            'claimed_total': self._claimed_total,
+            'duplicates_total': self._duplicates_total,
+        }
+
+
+message_dedup = MessageDeduplicator()
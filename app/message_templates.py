@@ -0,0 +1,169 @@
+import logging
+import string
+import threading
+import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from flask import current_app
+
+from app import db
+from app.models import MessageTemplate
+
+# Сообщения по умолчанию для шаблонов, которых нет в базе данных
+DEFAULT_TEMPLATES = {
+    'invalid_salon_id': "Неверный формат ID салона. ID должен состоять только из цифр.",
+    'salon_not_found': "Салон с таким ID не найден.",
+    'already_visited': "Вы уже получали скидку в этом салоне.",
+    'welcome_back': "Рады видеть Вас снова!",
+    'data_loading_error': "Ошибка при загрузке данных. Пожалуйста, начните сначала.",
+    'spin_wheel_first': "Чтобы получить скидку, сначала нужно сыграть в колесо фортуны. Напишите 'Да', чтобы начать.",
+    'user_declined': "Хорошо. ",
+    'accept_terms': "Извините, но для участия в акции необходимо принять условия использования сервиса. Без этого мы не можем предоставить вам скидку. Пожалуйста, ознакомьтесь с условиями и дайте согласие, чтобы продолжить.",
+    'no_discounts_available': "Извините, нет доступных скидок.",
+    'spinning_wheel_message': " Запускаю колесо фортуны...",
+    'get_discount_message': "✨ И вам выпадает {discount} в {message_salon_name} ({categories})! 🤩\n\n📞 Контакты: {contacts}",
+    'claim_discount': "Поздравляем! В ближайшее время с Вами свяжется администратор из {message_salon_name}.\n\n Контактные данные: {contacts}",
+    'discount_offer': "✨ И вам выпадает {discount} в {message_salon_name} ({categories})! 🤩\n\nХотите забрать подарок?\n\n1 - Да / 2 - Нет (осталось {attempts_left} попытка)",
+    'general_error': "Произошла ошибка. Пожалуйста, попробуйте позже."
+}
+UNKNOWN_TEMPLATE_MESSAGE = "Произошла ошибка. Попробуйте позже."
+
+_formatter = string.Formatter()
+
+
+class _Values(dict):
+    """Значения для подстановки: отсутствующее поле заменяется пустой строкой.
+
+    Каждое отсутствующее поле записывается в журнал при первой встрече в шаблоне,
+    чтобы опечатка в имени поля не превращалась в пустой текст незаметно, но и не
+    засоряла журнал при каждой отправке.
+    """
+
+    def __init__(self, template: 'CompiledTemplate', values: dict):
+        super().__init__(values)
+        self.template = template
+
+    def __missing__(self, key: str) -> str:
+        if key not in self.template.missing_fields:
+            self.template.missing_fields.add(key)
+            logging.error(
+                f"Для шаблона сообщения '{self.template.name}' не передано поле '{key}', "
+                f"вместо него подставляется пустая строка"
+            )
+        return ''
+
+
+class CompiledTemplate:
+    """Шаблон сообщения, разобранный один раз при загрузке.
+
+    Простые подстановки вида {name} выполняются склейкой готовых кусков, шаблоны
+    со спецификаторами формата или вложенными полями форматируются через str.format.
+    """
+
+    __slots__ = ('name', 'source', 'fields', 'missing_fields', '_parts', '_simple')
+
+    def __init__(self, name: str, source: str):
+        self.name = name
+        self.source = source
+        parts: List[Tuple[str, Optional[str]]] = []
+        fields = set()
+        simple = True
+        for literal, field_name, format_spec, conversion in _formatter.parse(source):
+            if field_name is None:
+                parts.append((literal, None))
+                continue
+            fields.add(field_name.split('.', 1)[0].split('[', 1)[0])
+            if format_spec or conversion or not field_name.isidentifier():
+                simple = False
+            parts.append((literal, field_name))
+        self.fields: FrozenSet[str] = frozenset(fields)
+        self.missing_fields: Set[str] = set()
+        self._parts = parts
+        self._simple = simple
+
+    def render(self, **kwargs) -> str:
+        values = _Values(self, kwargs)
+        if not self._simple:
+            return self.source.format_map(values)
+        return ''.join(
+            literal if field_name is None else literal + str(values[field_name])
+            for literal, field_name in self._parts
+        )
+
+
+class TemplateRegistry:
+    """Хранимый в памяти процесса реестр шаблонов сообщений.
+
+    Все шаблоны загружаются из БД одним запросом и хранятся разобранными. Реестр
+    перезагружается после invalidate() (вызывается при изменении шаблонов в админке)
+    и по истечении MESSAGE_TEMPLATES_TTL секунд, чтобы подхватывать изменения из других процессов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates: Dict[str, CompiledTemplate] = {}
+        self._defaults = {name: CompiledTemplate(name, source) for name, source in DEFAULT_TEMPLATES.items()}
+        self._version = 0
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+
+    def _ttl(self) -> float:
+        return current_app.config.get('MESSAGE_TEMPLATES_TTL', 300)
+
+    def _compile(self, name: str, source: str) -> Optional[CompiledTemplate]:
+        try:
+            template = CompiledTemplate(name, source)
+        except ValueError as e:
+            logging.error(f"Шаблон сообщения '{name}' содержит ошибку и не будет использован: {e}")
+            return None
+        default = self._defaults.get(name)
+        if default is not None and not template.fields <= default.fields:
+            logging.warning(
+                f"Шаблон сообщения '{name}' использует неизвестные поля: "
+                f"{', '.join(sorted(template.fields - default.fields))}"
+            )
+        return template
+
+    def _load(self):
+        templates = {}
+        for name, source in db.session.query(MessageTemplate.name, MessageTemplate.template):
+            template = self._compile(name, source)
+            if template is not None:
+                templates[name] = template
+        self._templates = templates
+        logging.info(f"Шаблоны сообщений загружены: {len(templates)}")
+
+    def _current(self) -> Dict[str, CompiledTemplate]:
+        if self._loaded_version == self._version and time.monotonic() - self._loaded_at < self._ttl():
+            return self._templates
+        with self._lock:
+            version = self._version
+            if self._loaded_version != version or time.monotonic() - self._loaded_at >= self._ttl():
+                self._load()
+                self._loaded_version = version
+                self._loaded_at = time.monotonic()
+            return self._templates
+
+    def get(self, name: str) -> Optional[CompiledTemplate]:
+        """Возвращает шаблон из БД, а при его отсутствии - шаблон по умолчанию."""
+        return self._current().get(name) or self._defaults.get(name)
+
+    def source(self, name: str) -> str:
+        """Возвращает исходный текст шаблона."""
+        template = self.get(name)
+        return template.source if template else UNKNOWN_TEMPLATE_MESSAGE
+
+    def render(self, name: str, **kwargs) -> str:
+        """Подставляет значения в шаблон и возвращает готовое сообщение."""
+        template = self.get(name)
+        if template is None:
+            return UNKNOWN_TEMPLATE_MESSAGE
+        return template.render(**kwargs)
+
+    def invalidate(self):
+        """Помечает реестр устаревшим, чтобы при следующем обращении он был перезагружен из БД."""
+        with self._lock:
+            self._version += 1
+
+
+template_registry = TemplateRegistry()
@@ -1,11 +1,13 @@
+from datetime import datetime
 from app import db
 from sqlalchemy.orm import relationship, backref
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
 salon_categories = db.Table('salon_categories',
-    db.Column('salon_id', db.String(255), db.ForeignKey('partner_info.id')),
-    db.Column('category_id', db.Integer, db.ForeignKey('category.id'))
+    db.Column('salon_id', db.String(255), db.ForeignKey('partner_info.id'), primary_key=True),
+    db.Column('category_id', db.Integer, db.ForeignKey('category.id'), primary_key=True),
+    db.Index('ix_salon_categories_category_id', 'category_id')
 )
 
 class ClientSalonStatus(db.Model):
@@ -14,9 +16,11 @@ class ClientSalonStatus(db.Model):
     client_id = db.Column(db.Integer, db.ForeignKey('clients_data.id'), nullable=False)
     salon_id = db.Column(db.String(255), db.ForeignKey('partner_info.id'), nullable=False)
     status = db.Column(db.String(255), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=True)  # Время последней смены статуса
 
     __table_args__ = (
         db.UniqueConstraint('client_id', 'salon_id', name='unique_client_salon_status'),
+        db.Index('ix_client_salon_status_salon_id', 'salon_id'),
     )
 
     def __repr__(self):
@@ -42,6 +46,26 @@ class ClientsData(db.Model):
     def __repr__(self):
         return f"<ClientsData(chat_id='{self.chat_id}', initial_salon_name='{self.initial_salon_name}', claimed_salon_name='{self.claimed_salon_name}')>"
 
+class ClientExclusion(db.Model):
+    """Предрасчитанные исключения клиента: салоны и маска категорий, с которыми он взаимодействовал."""
+    __tablename__ = 'client_exclusions'
+
+    client_id = db.Column(db.Integer, db.ForeignKey('clients_data.id'), primary_key=True)
+    salon_ids = db.Column(db.JSON, nullable=False, default=list)
+    category_mask = db.Column(db.Text, nullable=False, default='0')  # Битовая маска ID категорий в hex
+    client = relationship('ClientsData', backref=backref('exclusion', uselist=False))
+
+    @property
+    def mask(self) -> int:
+        return int(self.category_mask or '0', 16)
+
+    @mask.setter
+    def mask(self, value: int):
+        self.category_mask = format(value, 'x')
+
+    def __repr__(self):
+        return f"<ClientExclusion(client_id='{self.client_id}', salon_ids='{self.salon_ids}')>"
+
 class PartnerInfo(db.Model):
     __tablename__ = 'partner_info'
 
@@ -69,6 +93,10 @@ class PartnerInfo(db.Model):
         single_parent=True
     )
 
+    __table_args__ = (
+        db.Index('ix_partner_info_city_priority', 'city_id', 'priority'),
+    )
+
     def __repr__(self):
         return f"<PartnerInfo(id='{self.id}', name='{self.name}', categories='{self.categories}', city='{self.city}', linked_partner_id='{self.linked_partner_id}', message_partner_name='{self.message_partner_name}')>"
 
@@ -122,7 +150,7 @@ class Partner(db.Model):
     clients_brought = db.Column(db.Integer, default=0)
     clients_received = db.Column(db.Integer, default=0)
     partners_invited = db.Column(db.Integer, default=0)
-    unique_code = db.Column(db.String(255), nullable=True)
+    unique_code = db.Column(db.String(255), nullable=True, index=True)
     telegram_chat_id = db.Column(db.Integer, nullable=True)
     user = relationship('User', backref='partner', uselist=False)
     invited_partners = relationship("Partner",
@@ -158,4 +186,195 @@ class City(db.Model):
     name = db.Column(db.String(255), nullable=False, unique=True)
 
     def __str__(self):
-        return self.name    
\ No newline at end of file
+        return self.name
+
+class ScheduledMessage(db.Model):
+    """Сообщение WhatsApp, запланированное к отправке в указанное время."""
+    __tablename__ = 'scheduled_messages'
+
+    id = db.Column(db.Integer, primary_key=True)
+    chat_id = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False, index=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Сколько раз сообщение захватывалось для отправки
+
+    def __repr__(self):
+        return f"<ScheduledMessage(chat_id='{self.chat_id}', due_at='{self.due_at}')>"
+
+class AmoCrmOutbox(db.Model):
+    """Ожидающая синхронизация клиента с AmoCRM: контакт и сделка по исходному салону.
+
+    На каждую пару (клиент, исходный салон) хранится одна запись с последним
+    состоянием клиента, поэтому несколько изменений одной сделки схлопываются.
+    """
+    __tablename__ = 'amocrm_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients_data.id'), nullable=False)
+    initial_salon_id = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    locked_by = db.Column(db.String(32), nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'initial_salon_id', name='unique_amocrm_outbox_lead'),
+    )
+
+    def __repr__(self):
+        return f"<AmoCrmOutbox(client_id='{self.client_id}', initial_salon_id='{self.initial_salon_id}', version='{self.version}')>"
+
+class AmoCrmContact(db.Model):
+    """Соответствие номера телефона клиента контакту AmoCRM."""
+    __tablename__ = 'amocrm_contacts'
+
+    chat_id = db.Column(db.String(255), primary_key=True)
+    contact_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<AmoCrmContact(chat_id='{self.chat_id}', contact_id='{self.contact_id}')>"
+
+class AmoCrmLead(db.Model):
+    """Соответствие пары (клиент, исходный салон) сделке AmoCRM."""
+    __tablename__ = 'amocrm_leads'
+
+    client_id = db.Column(db.Integer, db.ForeignKey('clients_data.id'), primary_key=True)
+    initial_salon_id = db.Column(db.String(255), primary_key=True)
+    lead_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<AmoCrmLead(client_id='{self.client_id}', initial_salon_id='{self.initial_salon_id}', lead_id='{self.lead_id}')>"
+
+class SalonSyncState(db.Model):
+    """Хэш строки Google Sheets, из которой салон был загружен последний раз."""
+    __tablename__ = 'salon_sync_state'
+
+    salon_id = db.Column(db.String(255), primary_key=True)
+    row_hash = db.Column(db.String(64), nullable=False)
+    synced_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<SalonSyncState(salon_id='{self.salon_id}', row_hash='{self.row_hash}')>"
+
+class SyncJob(db.Model):
+    """Запуск синхронизации салонов с Google Sheets."""
+    __tablename__ = 'sync_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    trigger = db.Column(db.String(32), nullable=False)  # 'schedule', 'command' или 'admin'
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)  # queued, running, done, failed
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    rows_read = db.Column(db.Integer, nullable=False, default=0)
+    rows_changed = db.Column(db.Integer, nullable=False, default=0)
+    rows_skipped = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+
+    def to_dict(self) -> dict:
+        finished_or_now = self.finished_at or (datetime.utcnow() if self.started_at else None)
+        return {
+            'id': self.id,
+            'trigger': self.trigger,
+            'status': self.status,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration': round((finished_or_now - self.started_at).total_seconds(), 3) if self.started_at else None,
+            'rows_read': self.rows_read,
+            'rows_changed': self.rows_changed,
+            'rows_skipped': self.rows_skipped,
+            'error': self.error,
+        }
+
+    def __repr__(self):
+        return f"<SyncJob(id='{self.id}', trigger='{self.trigger}', status='{self.status}')>"
+
+class CounterEvent(db.Model):
+    """Изменение счетчика салона, ожидающее переноса в partner_info и partners."""
+    __tablename__ = 'counter_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    salon_id = db.Column(db.String(255), nullable=False)
+    field = db.Column(db.String(32), nullable=False)  # clients_brought, clients_received или partners_invited
+    delta = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<CounterEvent(salon_id='{self.salon_id}', field='{self.field}', delta='{self.delta}')>"
+
+class ProcessedMessage(db.Model):
+    """ID сообщения WHAPI, уже принятого в обработку (защита от повторной доставки webhook)."""
+    __tablename__ = 'processed_messages'
+
+    message_id = db.Column(db.String(255), primary_key=True)
+    received_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<ProcessedMessage(message_id='{self.message_id}', received_at='{self.received_at}')>"
+
+class DashboardStat(db.Model):
+    """Предрассчитанный показатель главной страницы админки."""
+    __tablename__ = 'dashboard_stats'
+
+    name = db.Column(db.String(64), primary_key=True)  # salons, partners, clients, active_cities, claims:<дата>
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<DashboardStat(name='{self.name}', value='{self.value}')>"
+
+class DashboardStatEvent(db.Model):
+    """Изменение показателя главной страницы админки, ожидающее переноса в dashboard_stats."""
+    __tablename__ = 'dashboard_stat_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<DashboardStatEvent(name='{self.name}', delta='{self.delta}')>"
+
+class FunnelEvent(db.Model):
+    """Шаг клиента в воронке: start, offer, accept, reject или claim."""
+    __tablename__ = 'funnel_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stage = db.Column(db.String(16), nullable=False)
+    salon_id = db.Column(db.String(255), nullable=False)
+    client_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<FunnelEvent(stage='{self.stage}', salon_id='{self.salon_id}', client_id='{self.client_id}')>"
+
+class FunnelDaily(db.Model):
+    """Воронка салона за день: число событий каждого шага."""
+    __tablename__ = 'funnel_daily'
+
+    day = db.Column(db.Date, primary_key=True)
+    city_id = db.Column(db.Integer, primary_key=True)  # 0 - салон удален или город неизвестен
+    salon_id = db.Column(db.String(255), primary_key=True)
+    starts = db.Column(db.Integer, nullable=False, default=0)
+    offers = db.Column(db.Integer, nullable=False, default=0)
+    accepts = db.Column(db.Integer, nullable=False, default=0)
+    rejects = db.Column(db.Integer, nullable=False, default=0)
+    claims = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_funnel_daily_salon_day', 'salon_id', 'day'),
+    )
+
+    def __repr__(self):
+        return f"<FunnelDaily(day='{self.day}', salon_id='{self.salon_id}', claims='{self.claims}')>"
+
+class FunnelRollupState(db.Model):
+    """Время последнего пересчета дневных итогов воронки."""
+    __tablename__ = 'funnel_rollup_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    rolled_up_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,357 @@
+import logging
+import random
+import threading
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from flask import current_app
+from sqlalchemy import delete, select
+
+from app import db
+from app.models import (
+    PartnerInfo, Partner, DiscountWeightSettings, ClientExclusion, ClientSalonStatus, salon_categories
+)
+
+WeightSettings = namedtuple('WeightSettings', [
+    'ratio_40_80_weight', 'ratio_30_40_weight', 'ratio_below_30_weight', 'partners_invited_weight'
+])
+
+
+def category_mask(category_ids: Iterable[int]) -> int:
+    """Возвращает битовую маску для набора ID категорий."""
+    mask = 0
+    for category_id in category_ids:
+        mask |= 1 << category_id
+    return mask
+
+
+def compute_weight(clients_brought: int, clients_received: int, partners_invited: int,
+                   settings: WeightSettings) -> int:
+    """Вычисляет вес салона по соотношению "привел/получил" и числу приглашенных партнеров."""
+    clients_brought = clients_brought or 0
+    clients_received = clients_received or 0
+    ratio = clients_brought / clients_received if clients_received > 0 else float('inf')
+    if 0.4 <= ratio <= 0.8:
+        weight = settings.ratio_below_30_weight
+    elif 0.3 <= ratio < 0.4:
+        weight = settings.ratio_30_40_weight
+    else:
+        weight = settings.ratio_40_80_weight
+    weight += (partners_invited or 0) * settings.partners_invited_weight
+    return max(weight, 0)
+
+
+def reset_client_exclusions(salon_ids: Iterable[str]):
+    """Удаляет исключения клиентов, взаимодействовавших с салонами, у которых изменились категории.
+
+    Исключения будут заново рассчитаны по статусам салонов при следующем выборе скидки.
+    Выполняется в текущей транзакции.
+    """
+    salon_ids = list(salon_ids)
+    if salon_ids:
+        db.session.execute(delete(ClientExclusion).where(ClientExclusion.client_id.in_(
+            select(ClientSalonStatus.client_id).where(ClientSalonStatus.salon_id.in_(salon_ids))
+        )))
+
+
+class FenwickTree:
+    """Дерево Фенвика над целыми весами: обновление веса и выбор по префиксной сумме за O(log n)."""
+
+    __slots__ = ('_size', '_tree', '_values')
+
+    def __init__(self, weights: List[int]):
+        self._size = len(weights)
+        self._values = list(weights)
+        self._tree = [0] + list(weights)
+        for i in range(1, self._size + 1):
+            parent = i + (i & -i)
+            if parent <= self._size:
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def value(self, index: int) -> int:
+        return self._values[index]
+
+    def prefix(self, index: int) -> int:
+        """Возвращает сумму весов элементов перед index."""
+        total = 0
+        i = index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def total(self) -> int:
+        return self.prefix(self._size)
+
+    def set(self, index: int, weight: int):
+        delta = weight - self._values[index]
+        if not delta:
+            return
+        self._values[index] = weight
+        i = index + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def find(self, target: int) -> int:
+        """Возвращает индекс элемента, в интервал префиксных сумм которого попадает target."""
+        position = 0
+        step = 1 << self._size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= self._size and self._tree[next_position] <= target:
+                position = next_position
+                target -= self._tree[next_position]
+            step >>= 1
+        return position
+
+
+class SalonRecord:
+    """Компактная запись о салоне в каталоге города."""
+
+    __slots__ = ('salon_id', 'city_id', 'category_mask', 'priority', 'linked_id',
+                 'clients_brought', 'clients_received', 'partners_invited', 'index')
+
+    def __init__(self, salon_id, city_id, category_mask, priority, linked_id,
+                 clients_brought, clients_received, partners_invited, index):
+        self.salon_id = salon_id
+        self.city_id = city_id
+        self.category_mask = category_mask
+        self.priority = priority
+        self.linked_id = linked_id
+        self.clients_brought = clients_brought or 0
+        self.clients_received = clients_received or 0
+        self.partners_invited = partners_invited or 0
+        self.index = index
+
+
+class CityCatalog:
+    """Каталог предложений одного города с взвешенным и приоритетным сэмплерами."""
+
+    # Сколько раз выбор по всему дереву повторяется, прежде чем перейти к точному выбору
+    REJECTION_ATTEMPTS = 32
+
+    def __init__(self, city_id: int, records: List[SalonRecord], settings: WeightSettings):
+        self.city_id = city_id
+        self.records = records
+        self.by_id = {record.salon_id: record for record in records}
+        self.settings = settings
+        self.loaded_at = time.monotonic()
+        self.weights = FenwickTree([self._weight(record) for record in records])
+        self.priority = FenwickTree([1 if record.priority else 0 for record in records])
+
+    def _weight(self, record: SalonRecord) -> int:
+        return compute_weight(record.clients_brought, record.clients_received,
+                              record.partners_invited, self.settings)
+
+    def reweight(self, record: SalonRecord):
+        self.weights.set(record.index, self._weight(record))
+
+    def sample(self, tree: FenwickTree, excluded_ids, excluded_mask: int,
+               rng: random.Random) -> Optional[SalonRecord]:
+        """Выбирает запись пропорционально весам в дереве, пропуская исключенные.
+
+        Точка выбирается по всему дереву за O(log n) без выделения памяти и отбрасывается,
+        если попала в исключенный салон (по ID или по категориям маски). Если исключенные
+        салоны перевешивают и REJECTION_ATTEMPTS попыток подряд неудачны, выполняется
+        точный выбор одним проходом по доступным салонам: условное распределение в обоих
+        случаях одно и то же.
+        """
+        total = tree.total()
+        if total <= 0:
+            return None
+        for _ in range(self.REJECTION_ATTEMPTS):
+            record = self.records[tree.find(rng.randrange(total))]
+            if not record.category_mask & excluded_mask and record.salon_id not in excluded_ids:
+                return record
+        return self._sample_exact(tree, excluded_ids, excluded_mask, rng)
+
+    def _sample_exact(self, tree: FenwickTree, excluded_ids, excluded_mask: int,
+                      rng: random.Random) -> Optional[SalonRecord]:
+        available = [
+            record for record in self.records
+            if tree.value(record.index) and not record.category_mask & excluded_mask
+            and record.salon_id not in excluded_ids
+        ]
+        if not available:
+            return None
+        cumulative = list(accumulate(tree.value(record.index) for record in available))
+        return available[bisect_right(cumulative, rng.randrange(cumulative[-1]))]
+
+
+class OfferCatalog:
+    """Хранимый в памяти процесса каталог предложений, разбитый по городам.
+
+    Каталог города загружается при первом обращении и перезагружается по истечении
+    OFFER_CATALOG_TTL секунд, чтобы подхватывать изменения из других процессов.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._cities: Dict[int, CityCatalog] = {}
+        self._salon_city: Dict[str, int] = {}
+        self._rng = random.Random()
+
+    def _ttl(self) -> float:
+        return current_app.config.get('OFFER_CATALOG_TTL', 300)
+
+    def _load_city(self, city_id: int) -> Optional[CityCatalog]:
+        # Если строки настроек или значения в ней нет, используются веса по умолчанию из модели, как в SQL-движке
+        row = db.session.get(DiscountWeightSettings, 1)
+        weights = []
+        for field in WeightSettings._fields:
+            value = getattr(row, field, None)
+            weights.append(value if value is not None else DiscountWeightSettings.__table__.c[field].default.arg)
+        settings = WeightSettings(*weights)
+
+        rows = db.session.query(
+            PartnerInfo.id,
+            PartnerInfo.priority,
+            PartnerInfo.linked_partner_id,
+            PartnerInfo.clients_brought,
+            PartnerInfo.clients_received,
+            Partner.partners_invited
+        ).outerjoin(Partner, Partner.salon_id == PartnerInfo.id).filter(
+            PartnerInfo.city_id == city_id
+        ).order_by(PartnerInfo.id).all()
+
+        masks: Dict[str, int] = {}
+        category_rows = db.session.query(
+            salon_categories.c.salon_id, salon_categories.c.category_id
+        ).join(PartnerInfo, PartnerInfo.id == salon_categories.c.salon_id).filter(
+            PartnerInfo.city_id == city_id
+        )
+        for salon_id, category_id in category_rows:
+            if category_id is not None:
+                masks[salon_id] = masks.get(salon_id, 0) | (1 << category_id)
+
+        records = [
+            SalonRecord(salon_id, city_id, masks.get(salon_id, 0), bool(priority), linked_id,
+                        brought, received, invited, index)
+            for index, (salon_id, priority, linked_id, brought, received, invited) in enumerate(rows)
+        ]
+        catalog = CityCatalog(city_id, records, settings)
+        logging.info(f"Каталог предложений города {city_id} загружен: {len(records)} салонов")
+        return catalog
+
+    def city(self, city_id: int) -> Optional[CityCatalog]:
+        """Возвращает каталог города, при необходимости (пере)загружая его.
+
+        Загрузка из БД выполняется без блокировки, чтобы не задерживать выбор в других городах.
+        """
+        ttl = self._ttl()
+        with self._lock:
+            catalog = self._cities.get(city_id)
+            if catalog is not None and time.monotonic() - catalog.loaded_at < ttl:
+                return catalog
+        loaded = self._load_city(city_id)
+        with self._lock:
+            catalog = self._cities.get(city_id)
+            if catalog is not None and time.monotonic() - catalog.loaded_at < ttl and \
+                    (loaded is None or catalog.loaded_at > loaded.loaded_at):
+                # Другой поток успел загрузить каталог позже
+                return catalog
+            if catalog is not None:
+                for salon_id in catalog.by_id:
+                    self._salon_city.pop(salon_id, None)
+            if loaded is None:
+                self._cities.pop(city_id, None)
+                return None
+            self._cities[city_id] = loaded
+            for salon_id in loaded.by_id:
+                self._salon_city[salon_id] = city_id
+            return loaded
+
+    def lookup(self, salon_id: str) -> Optional[SalonRecord]:
+        """Возвращает запись салона, загружая каталог его города при необходимости."""
+        with self._lock:
+            city_id = self._salon_city.get(salon_id)
+        if city_id is None:
+            city_id = db.session.query(PartnerInfo.city_id).filter(PartnerInfo.id == salon_id).scalar()
+            if city_id is None:
+                return None
+        catalog = self.city(city_id)
+        return catalog.by_id.get(salon_id) if catalog else None
+
+    def category_mask_for(self, salon_ids: Iterable[str]) -> int:
+        """Возвращает объединенную маску категорий для указанных салонов.
+
+        Маска читается из БД, а не из каталога, который может отставать от изменений
+        категорий салонов на OFFER_CATALOG_TTL секунд.
+        """
+        salon_ids = list(salon_ids)
+        if not salon_ids:
+            return 0
+        category_ids = db.session.query(salon_categories.c.category_id).filter(
+            salon_categories.c.salon_id.in_(salon_ids),
+            salon_categories.c.category_id.isnot(None)
+        ).distinct()
+        return category_mask(category_id for category_id, in category_ids)
+
+    def choose(self, initial_salon_id: str, excluded_ids, excluded_mask: int) -> Optional[Tuple[str, bool]]:
+        """Выбирает салон для клиента по тем же правилам, что и get_random_discount.
+
+        Возвращает кортеж (ID салона, признак приоритетного салона) или None.
+        Каталоги загружаются без блокировки, под блокировкой выполняется только выбор.
+        """
+        user_salon = self.lookup(initial_salon_id)
+        if user_salon is None:
+            logging.error(f"Салон {initial_salon_id} не найден в каталоге предложений")
+            return None
+        catalog = self.city(user_salon.city_id)
+        if catalog is None:
+            return None
+
+        # --- Приоритетный салон в городе клиента ---
+        with self._lock:
+            record = catalog.sample(catalog.priority, excluded_ids, excluded_mask, self._rng)
+        if record is not None:
+            return record.salon_id, True
+
+        # --- Связанный салон ---
+        if user_salon.linked_id and user_salon.linked_id not in excluded_ids:
+            linked = self.lookup(user_salon.linked_id)
+            if linked is not None and not linked.category_mask & excluded_mask:
+                return linked.salon_id, False
+
+        # --- Взвешенный выбор среди доступных салонов ---
+        with self._lock:
+            record = catalog.sample(catalog.weights, excluded_ids, excluded_mask, self._rng)
+        if record is not None:
+            return record.salon_id, False
+        return None
+
+    def adjust(self, salon_id: str, clients_brought: int = 0, clients_received: int = 0,
+               partners_invited: int = 0):
+        """Применяет изменение счетчиков салона к загруженному каталогу за O(log n)."""
+        with self._lock:
+            city_id = self._salon_city.get(salon_id)
+            catalog = self._cities.get(city_id) if city_id is not None else None
+            record = catalog.by_id.get(salon_id) if catalog else None
+            if record is None:
+                return
+            record.clients_brought += clients_brought
+            record.clients_received += clients_received
+            record.partners_invited += partners_invited
+            catalog.reweight(record)
+
+    def invalidate(self, city_id: Optional[int] = None):
+        """Сбрасывает каталог города (или все каталоги), чтобы он был перезагружен из БД."""
+        with self._lock:
+            if city_id is None:
+                self._cities.clear()
+                self._salon_city.clear()
+                return
+            catalog = self._cities.pop(city_id, None)
+            if catalog is not None:
+                for salon_id in catalog.by_id:
+                    self._salon_city.pop(salon_id, None)
+
+
+offer_catalog = OfferCatalog()
@@ -1,18 +1,21 @@
-import asyncio
 import random
 import io
 import string
 import os
+from datetime import datetime, timedelta
 
 from flask import render_template, redirect, url_for, flash, request, send_file
 from app.partner import bp
 from app.partner.forms import RegistrationForm, LoginForm, EditSalonForm
-from app.models import Partner, PartnerInfo, User, PartnerInvitation, Category, City, MessageTemplate
+from app.models import Partner, PartnerInfo, User, PartnerInvitation, Category, City
 from app import db
 from werkzeug.security import generate_password_hash
 from flask_login import login_user, logout_user, login_required, current_user
 from app.qr_code import generate_qr_code
-from app.routes import get_template_or_default
+from app.message_templates import template_registry
+from app.offer_catalog import offer_catalog
+from app.counters import increment_salon_counters
+from app.funnel import funnel_by_day
 
 # --- Функция для экранирования фигурных скобок ---
 def escape_handlebars_braces(text):
@@ -102,7 +105,7 @@ def register():
             inviting_partner = Partner.query.filter_by(user_id=ref_id).first()
             if inviting_partner:
                 new_partner_info.invited_by = inviting_partner.id
-                inviting_partner.partners_invited += 1
+                increment_salon_counters(inviting_partner.salon_id, partners_invited=1)
 
                 # Создаем запись в таблице partner_invitations
                 new_invitation = PartnerInvitation(inviting_partner_id=inviting_partner.id, invited_partner_id=new_partner.id)
@@ -155,6 +158,7 @@ def dashboard():
 
             try:
                 db.session.commit()
+                offer_catalog.invalidate()
             except Exception as e:
                 db.session.rollback()
                 print(f"Ошибка при сохранении данных: {e}")
@@ -169,7 +173,7 @@ def dashboard():
     # --- Получаем образцы сообщений ---
     sample_messages = {}
     for template_name in ['get_discount_message', 'discount_offer']:
-        sample_messages[template_name] = asyncio.run(get_template_or_default(
+        sample_messages[template_name] = template_registry.render(
             template_name,
             discount=partner_info.discount,
             salon_name=partner_info.name,
@@ -177,14 +181,18 @@ def dashboard():
             message_salon_name=partner_info.message_partner_name,
             categories=", ".join([category.name for category in partner_info.categories]),
             attempts_left=1 
-        ))
+        )
 
     # --- Получаем шаблоны сообщений из базы данных ---
-    get_discount_message_template = escape_handlebars_braces(MessageTemplate.query.filter_by(name='get_discount_message').first().template).replace('\n', '\\n')
-    discount_offer_template = escape_handlebars_braces(MessageTemplate.query.filter_by(name='discount_offer').first().template).replace('\n', '\\n')
+    get_discount_message_template = escape_handlebars_braces(template_registry.source('get_discount_message')).replace('\n', '\\n')
+    discount_offer_template = escape_handlebars_braces(template_registry.source('discount_offer')).replace('\n', '\\n')
+
+    # --- Воронка салона за последние 30 дней ---
+    funnel_days = funnel_by_day(partner.salon_id, datetime.utcnow().date() - timedelta(days=29))
 
     return render_template('partner/dashboard.html',
                            partner=partner,
+                           funnel_days=funnel_days,
                            salon=partner_info,
                            edit_form=edit_form,
                            PartnerInfo=PartnerInfo,
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+
+class TokenBucketLimiter:
+    """Ограничитель частоты по алгоритму «ведро токенов» с отдельным ведром на каждый ключ.
+
+    Ведро вмещает до {prefix}_BURST токенов и пополняется со скоростью {prefix}_LIMIT
+    токенов в секунду; каждое действие расходует один токен. Проверка выполняется
+    в памяти процесса без обращения к БД. Ведра хранятся в LRU: при переполнении
+    удаляются ведра давно не использовавшихся ключей, поэтому память ограничена.
+    Лимит 0 отключает ограничение.
+    """
+
+    # Размер LRU ведер, после которого удаляются ведра давно не использовавшихся ключей
+    PRUNE_SIZE = 10000
+
+    def __init__(self, config_prefix: str, rate: float = 0, burst: float = 1):
+        self.config_prefix = config_prefix
+        self.rate = rate
+        self.burst = burst
+        self._buckets: 'OrderedDict[str, List[float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._allowed_total = 0
+        self._dropped_total = 0
+
+    def init_app(self, app):
+        self.configure(
+            app.config.get(f'{self.config_prefix}_LIMIT', self.rate),
+            app.config.get(f'{self.config_prefix}_BURST', self.burst)
+        )
+
+    def configure(self, rate: float, burst: float):
+        with self._lock:
+            self.rate = rate
+            self.burst = max(burst, 1)
+            self._buckets.clear()
+
+    def _bucket(self, key: str, now: float) -> List[float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.PRUNE_SIZE:
+                self._prune(now)
+            bucket = self._buckets[key] = [self.burst, now]
+            return bucket
+        self._buckets.move_to_end(key)
+        tokens, updated = bucket
+        bucket[0] = min(self.burst, tokens + (now - updated) * self.rate)
+        bucket[1] = now
+        return bucket
+
+    def _prune(self, now: float):
+        # Сначала удаляются заполнившиеся ведра из начала LRU: их удаление не меняет лимит
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst:
+                break
+            self._buckets.popitem(last=False)
+        while len(self._buckets) >= self.PRUNE_SIZE:
+            self._buckets.popitem(last=False)
+
+    def allow(self, key: str = '') -> bool:
+        """Расходует токен ключа. Возвращает False, если токенов нет и действие нужно отклонить."""
+        if not self.rate:
+            return True
+        with self._lock:
+            bucket = self._bucket(key, time.monotonic())
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self._allowed_total += 1
+                return True
+            self._dropped_total += 1
+            return False
+
+    def reserve(self, key: str = '') -> float:
+        """Расходует токен ключа, даже если его еще нет, и возвращает, сколько секунд нужно подождать."""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            bucket = self._bucket(key, time.monotonic())
+            bucket[0] -= 1
+            self._allowed_total += 1
+            return 0.0 if bucket[0] >= 0 else -bucket[0] / self.rate
+
+    def stats(self) -> dict:
+        """Возвращает настройки лимита и число пропущенных и отклоненных действий."""
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'keys': len(self._buckets),
+            'allowed_total': self._allowed_total,
+            'dropped_total': self._dropped_total,
+        }
+
+
+# Защита от флуда: ограничение числа входящих сообщений одного чата
+chat_rate_limiter = TokenBucketLimiter('CHAT_RATE', rate=0.5, burst=5)
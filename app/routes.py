@@ -1,21 +1,28 @@
 import asyncio
 import logging
 import time
+from typing import Dict, List, Optional, Tuple
 
-from flask import request, jsonify, Blueprint
+from flask import request, jsonify, Blueprint, current_app
 from app import db
-from app.models import ClientsData, PartnerInfo, ClientSalonStatus, MessageTemplate, Category, City, Partner
+from app.models import ClientsData, PartnerInfo, ClientSalonStatus, Category, City, Partner
 from app.services import (
     update_salons_data,
     send_message,
-    create_amocrm_contact,
-    create_or_update_amocrm_lead,
-    get_amocrm_contact_id,
     set_salon_status,
     get_salon_status,
     send_telegram_notification
 )
 from app.utils import get_random_discount
+from app.counters import increment_salon_counters
+from app.funnel import record_funnel_event
+from app.message_templates import template_registry
+from app.message_dedup import message_dedup
+from app.rate_limit import chat_rate_limiter
+from app.spool import webhook_spool
+from app.dispatcher import PartiallyCommittedError, chat_dispatcher
+from app.scheduler import message_scheduler
+from app.amocrm_outbox import sync_amocrm_client
 import os
 
 bp = Blueprint('routes', __name__)
@@ -24,38 +31,115 @@ bp = Blueprint('routes', __name__)
 @bp.route('/webhook', methods=['POST'])
 async def webhook():
     """Обрабатывает входящие webhook-запросы от WhatsApp."""
-    data = request.json
+    data = request.get_json(silent=True)
     logging.info(f"Received data: {data}")
 
-    event_type = data.get('event', {}).get('type')
+    if not isinstance(data, dict):
+        logging.error("Webhook received invalid JSON")
+        return jsonify({"status": "error", "message": "Invalid data"}), 400
+
+    if webhook_spool.enabled:
+        # Быстрое подтверждение: сохраняем запрос в очередь, обработку выполнят фоновые воркеры.
+        # Пачка сообщений делится по чатам, чтобы ошибка в одном чате не повторяла обработку других
+        messages = data.get('messages') or []
+        if data.get('event', {}).get('type') != 'messages' or not isinstance(messages, list) or not messages:
+            entry_ids = [webhook_spool.append(data)]
+        else:
+            entry_ids = [
+                webhook_spool.append({**data, 'messages': chat_messages}, chat_key=chat_id or None)
+                for chat_id, chat_messages in group_messages_by_chat(messages).items()
+            ]
+        return jsonify({"status": "accepted", "ids": entry_ids}), 200
+
+    body, status = await process_webhook(data)
+    return jsonify(body), status
 
-    if event_type == 'messages':
-        message_data = data.get('messages', [])[0]
-        chat_id = message_data.get('chat_id', '').replace('@s.whatsapp.net', '')
-        message_body = message_data.get('text', {}).get('body', '').lower()
 
+async def process_webhook(data: dict) -> Tuple[dict, int]:
+    """Обрабатывает тело webhook-запроса и возвращает ответ и HTTP-статус.
+
+    Обрабатываются все сообщения пачки: сообщения одного чата - строго по очереди,
+    разных чатов - параллельно. В ответе возвращается результат по каждому сообщению.
+    Сообщение, обработка которого упала до первого коммита, освобождается для повторной
+    доставки (ответ 500). Если часть изменений уже зафиксирована, сообщение остается
+    занятым и получает статус failed: повтор выполнил бы зафиксированные шаги второй раз.
+    """
+    event_type = data.get('event', {}).get('type')
+    if event_type != 'messages':
+        return {"status": "ok"}, 200
+
+    messages = data.get('messages')
+    if not isinstance(messages, list) or not messages:
+        logging.error("Missing messages in received data")
+        return {"status": "error", "message": "Invalid data"}, 400
+
+    results = [None] * len(messages)
+    futures = []
+    for index, message_data in enumerate(messages):
+        chat_id = get_chat_id(message_data) if isinstance(message_data, dict) else ''
+        message_body = message_data.get('text', {}).get('body', '').lower() if chat_id else ''
+        result = {"id": message_data.get('id') if isinstance(message_data, dict) else None, "chat_id": chat_id}
+        results[index] = result
         if not chat_id or not message_body:
             logging.error("Missing phone number or message in received data")
-            return jsonify({"status": "error", "message": "Invalid data"}), 400
+            result.update(status="invalid", message="Invalid data")
+            continue
+        if not message_dedup.claim(result["id"]):
+            result.update(status="duplicate")
+            continue
+        # Полоса диспетчера выполняет сообщения чата в порядке постановки, поэтому
+        # все сообщения ставятся сразу, а порядок внутри чата сохраняется
+        futures.append((result, chat_dispatcher.submit(chat_id, handle_incoming_message, chat_id, message_body, message_data)))
+
+    outcomes = await asyncio.gather(*(asyncio.wrap_future(future) for _, future in futures), return_exceptions=True)
+    for (result, _), outcome in zip(futures, outcomes):
+        if isinstance(outcome, PartiallyCommittedError):
+            logging.error(f"Error handling incoming message after commit, redelivery skipped: {outcome}")
+            result.update(status="failed", message=str(outcome))
+        elif isinstance(outcome, BaseException):
+            logging.error(f"Error handling incoming message: {outcome}")
+            result.update(status="error", message=str(outcome))
+            message_dedup.release(result["id"])
+        else:
+            result.update(status="ok")
+
+    statuses = {result["status"] for result in results}
+    if "error" in statuses:
+        errors = [result["message"] for result in results if result["status"] == "error"]
+        return {"status": "error", "message": "; ".join(errors), "results": results}, 500
+    if statuses == {"invalid"}:
+        return {"status": "error", "message": "Invalid data", "results": results}, 400
+    return {"status": "ok", "results": results}, 200
+
 
-        try:
-            await handle_incoming_message(chat_id, message_body, message_data)
-        except Exception as e:
-            logging.error(f"Error handling incoming message: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 500
+def get_chat_id(message_data: dict) -> str:
+    """Возвращает номер телефона отправителя из данных сообщения WHAPI."""
+    return (message_data.get('chat_id') or '').replace('@s.whatsapp.net', '')
 
-    return jsonify({"status": "ok"}), 200
+
+def group_messages_by_chat(messages: List[dict]) -> Dict[str, List[dict]]:
+    """Группирует сообщения пачки по чатам, сохраняя порядок сообщений внутри чата."""
+    chats: Dict[str, List[dict]] = {}
+    for message_data in messages:
+        chat_id = get_chat_id(message_data) if isinstance(message_data, dict) else ''
+        chats.setdefault(chat_id, []).append(message_data)
+    return chats
 
 
 async def handle_incoming_message(chat_id: str, message_body: str, message_data: dict):
     """Обрабатывает входящее сообщение от пользователя."""
     start_time = time.time()
-    logging.info(f"Обработка сообщения для номера телефона: {chat_id}, сообщение: {message_body}")
-
     if message_data.get('from_me', False):
         logging.info("Пропускаем обработку сообщения, отправленного ботом")
         return
 
+    # Защита от флуда: сообщения сверх лимита чата отклоняются до любых обращений к БД и API
+    if not chat_rate_limiter.allow(chat_id):
+        logging.warning(f"Сообщение от {chat_id} отклонено: превышен лимит частоты сообщений")
+        return
+
+    logging.info(f"Обработка сообщения для номера телефона: {chat_id}, сообщение: {message_body}")
+
     if chat_id == os.environ.get("BOT_CHAT_ID"):
         logging.info("Пропускаем отправку сообщения самому себе")
         return
@@ -67,8 +151,8 @@ async def handle_incoming_message(chat_id: str, message_body: str, message_data:
     elif message_body_lower in ['да', '1', '2', 'нет'] or message_body.isdigit():
         await handle_user_response(chat_id, message_body_lower)
     elif message_body_lower == 'update data':
-        await update_salons_data()
-        await send_message(chat_id, "Данные успешно обновлены")
+        job_id = await update_salons_data()
+        await send_message(chat_id, f"Обновление данных запущено (ID {job_id})")
     else:
         logging.info("Сообщение не относится к логике бота и будет проигнорировано")
 
@@ -111,7 +195,6 @@ async def handle_start_command(chat_id: str, message_body: str, message_data: di
         )
         db.session.add(client_data)
         db.session.flush()
-        await set_salon_status(client_data.id, partner_id, 'visited') 
 
         # Отправка приветственного сообщения из шаблона
         start_message = await get_template_or_default('start_message')
@@ -134,16 +217,13 @@ async def handle_start_command(chat_id: str, message_body: str, message_data: di
     #  Если статус уже был установлен (claimed или rejected), не меняем его
     if existing_salon_status not in ('claimed', 'rejected'):
         await set_salon_status(client_data.id, partner_id, 'visited')
+    record_funnel_event('start', partner_id, client_data.id)
 
-    partner.clients_brought += 1
-    db.session.commit()
+    increment_salon_counters(partner.id, clients_brought=1)
     logging.info(f"Данные сохранены в базе данных: {client_data}")
 
-    # Создаем контакт в AmoCRM
-    contact_id = await create_amocrm_contact(client_data)
-    if contact_id:
-        # Создаем сделку в AmoCRM
-        await create_or_update_amocrm_lead(client_data, contact_id)
+    # Создаем контакт и сделку в AmoCRM
+    await sync_amocrm_client(client_data)
 
     await handle_discount_request(chat_id, client_data)
 
@@ -161,11 +241,13 @@ async def handle_user_response(chat_id: str, message_body: str):
         # Обрабатываем ответы "1" и "2" только если салон не приоритетный
         if client_data.chosen_salon_id:
             if message_body == '1':
+                if not client_data.discount_claimed:
+                    record_funnel_event('accept', client_data.chosen_salon_id, client_data.id)
                 await handle_claim_discount(chat_id, client_data)
             else:
                 await set_salon_status(client_data.id, client_data.chosen_salon_id, 'rejected')
+                record_funnel_event('reject', client_data.chosen_salon_id, client_data.id)
                 client_data.attempts_left -= 1
-                db.session.commit()
 
                 if client_data.attempts_left > 0:
                     await handle_discount_request(chat_id, client_data)
@@ -185,6 +267,8 @@ async def handle_discount_request(chat_id: str, client_data: ClientsData):
     if client_data.attempts_left > 0:
         await send_spinning_wheel_message(chat_id)
         discount_message = await get_discount_message(client_data)
+        # Выбранный салон сохраняется до того, как клиент увидит предложение
+        db.session.commit()
         await send_message(chat_id, discount_message)
     else:
         await handle_no_attempts_left(chat_id, client_data)
@@ -203,9 +287,12 @@ async def handle_no_attempts_left(chat_id: str, client_data: ClientsData):
     # Сохраняем выбранный салон и устанавливаем статус 'claimed'
     client_data.chosen_salon_id = chosen_salon.id
     client_data.chosen_salon_name = chosen_salon.name
+    record_funnel_event('offer', chosen_salon.id, client_data.id)
     await set_salon_status(client_data.id, chosen_salon.id, 'claimed')
+    record_funnel_event('claim', chosen_salon.id, client_data.id)
     client_data.discount_claimed = True
-    chosen_salon.clients_received += 1
+    increment_salon_counters(chosen_salon.id, clients_received=1)
+    # Получение скидки сохраняется до того, как клиент увидит сообщение о ней
     db.session.commit()
 
     # Отправка сообщения о результате из шаблона
@@ -214,14 +301,13 @@ async def handle_no_attempts_left(chat_id: str, client_data: ClientsData):
         discount=chosen_salon.discount,
         salon_name=chosen_salon.name,
         contacts=chosen_salon.contacts,
+        message_salon_name=chosen_salon.message_partner_name,
         categories=", ".join([category.name for category in chosen_salon.categories])
     )
     await send_message(chat_id, get_discount_message)
 
     # Обновляем сделку в AmoCRM
-    contact_id = await get_amocrm_contact_id(client_data.chat_id)
-    if contact_id:
-        await create_or_update_amocrm_lead(client_data, contact_id)
+    await sync_amocrm_client(client_data)
 
 
 async def handle_claim_discount(chat_id: str, client_data: ClientsData):
@@ -231,11 +317,14 @@ async def handle_claim_discount(chat_id: str, client_data: ClientsData):
         if chosen_salon:
             #  Изменение client_salon_status
             await set_salon_status(client_data.id, chosen_salon.id, 'claimed')
+            if not client_data.discount_claimed:
+                record_funnel_event('claim', chosen_salon.id, client_data.id)
 
             client_data.discount_claimed = True
             client_data.claimed_salon_name = chosen_salon.name
             client_data.claimed_salon_id = chosen_salon.id
-            chosen_salon.clients_received += 1
+            increment_salon_counters(chosen_salon.id, clients_received=1)
+            # Получение скидки сохраняется до поздравления клиента и оповещений партнеров
             db.session.commit()
 
             # Отправка сообщения с поздравлением из шаблона
@@ -248,20 +337,17 @@ async def handle_claim_discount(chat_id: str, client_data: ClientsData):
             await send_message(chat_id, claim_discount_message)
 
             # Обновляем сделку в AmoCRM
-            contact_id = await get_amocrm_contact_id(client_data.chat_id)
-            if contact_id:
-                await create_or_update_amocrm_lead(client_data, contact_id)
+            await sync_amocrm_client(client_data)
 
             # Отправка оповещения партнеру о полученном клиенте
-            partner_chat_id = chosen_salon.owner.telegram_chat_id
+            partner_chat_id = get_partner_telegram_chat_id(chosen_salon.id)
             if partner_chat_id:
                 message = f"🎉 Новый клиент! 🎉\n\n{client_data.client_name} ({client_data.chat_id}) воспользовался(ась) вашей скидкой."
                 await send_telegram_notification(partner_chat_id, message)
 
             # Отправка оповещения партнеру, который привел клиента, о привлеченном клиенте
-            initial_salon = PartnerInfo.query.get(client_data.initial_salon_id)
-            if initial_salon and initial_salon.owner and initial_salon.owner.telegram_chat_id:
-                inviting_partner_chat_id = initial_salon.owner.telegram_chat_id
+            inviting_partner_chat_id = get_partner_telegram_chat_id(client_data.initial_salon_id)
+            if inviting_partner_chat_id:
                 message = f"🎉 Вы привели нового клиента! 🎉\n\n{client_data.client_name} ({client_data.chat_id}) воспользовался(ась) скидкой в салоне {chosen_salon.name}."
                 await send_telegram_notification(inviting_partner_chat_id, message)
 
@@ -273,13 +359,24 @@ async def handle_claim_discount(chat_id: str, client_data: ClientsData):
         await send_message(chat_id, await get_template_or_default('general_error'))
 
 
+def get_partner_telegram_chat_id(salon_id: str) -> Optional[int]:
+    """Возвращает Telegram-чат партнера салона, если партнер подключил бота."""
+    return db.session.query(Partner.telegram_chat_id).filter(Partner.salon_id == salon_id).scalar()
+
+
 async def send_spinning_wheel_message(chat_id: str):
     """Отправляет сообщение "Запускаю колесо фортуны...".
+
+    Следующие сообщения чата откладываются на время вращения колеса планировщиком,
+    поэтому обработчик не ждет и сразу освобождается.
     """
     # Отправка сообщения о запуске колеса фортуны из шаблона
     spinning_wheel_message = await get_template_or_default('spinning_wheel_message')
     await send_message(chat_id, spinning_wheel_message)
-    await asyncio.sleep(3)
+    if message_scheduler.running:
+        message_scheduler.hold(chat_id, current_app.config.get('SPINNING_WHEEL_DELAY', 3))
+    else:
+        await asyncio.sleep(current_app.config.get('SPINNING_WHEEL_DELAY', 3))
 
 
 async def get_discount_message(client_data: ClientsData) -> str:
@@ -291,7 +388,7 @@ async def get_discount_message(client_data: ClientsData) -> str:
     chosen_salon, is_priority = discount_data
     client_data.chosen_salon_id = chosen_salon.id
     client_data.chosen_salon_name = chosen_salon.name
-    db.session.commit()
+    record_funnel_event('offer', chosen_salon.id, client_data.id)
 
     # Формируем строку с категориями
     categories_str = ", ".join([category.name for category in chosen_salon.categories])
@@ -324,25 +421,4 @@ async def get_template_or_default(template_name: str, **kwargs) -> str:
     """Возвращает шаблон сообщения из базы данных или сообщение по умолчанию,
        если шаблон не найден.
     """
-    template = MessageTemplate.query.filter_by(name=template_name).first()
-    if template:
-
-        return template.template.format(**kwargs) 
-    else:
-        # Вернуть сообщение по умолчанию для данного шаблона
-        return {
-            'invalid_salon_id': "Неверный формат ID салона. ID должен состоять только из цифр.",
-            'salon_not_found': "Салон с таким ID не найден.",
-            'already_visited': "Вы уже получали скидку в этом салоне.",
-            'welcome_back': "Рады видеть Вас снова!",
-            'data_loading_error': "Ошибка при загрузке данных. Пожалуйста, начните сначала.",
-            'spin_wheel_first': "Чтобы получить скидку, сначала нужно сыграть в колесо фортуны. Напишите 'Да', чтобы начать.",
-            'user_declined': "Хорошо. ",
-            'accept_terms': "Извините, но для участия в акции необходимо принять условия использования сервиса. Без этого мы не можем предоставить вам скидку. Пожалуйста, ознакомьтесь с условиями и дайте согласие, чтобы продолжить.",
-            'no_discounts_available': "Извините, нет доступных скидок.",
-            'spinning_wheel_message': " Запускаю колесо фортуны...",
-            'get_discount_message': "✨ И вам выпадает {discount} в {message_salon_name} ({categories})! 🤩\n\n📞 Контакты: {contacts}",
-            'claim_discount': "Поздравляем! В ближайшее время с Вами свяжется администратор из {message_salon_name}.\n\n Контактные данные: {contacts}",
-            'discount_offer': "✨ И вам выпадает {discount} в {message_salon_name} ({categories})! 🤩\n\nХотите забрать подарок?\n\n1 - Да / 2 - Нет (осталось {attempts_left} попытка)",
-            'general_error': "Произошла ошибка. Пожалуйста, попробуйте позже."
-        }.get(template_name, "Произошла ошибка. Попробуйте позже.")
\ No newline at end of file
+    return template_registry.render(template_name, **kwargs)
\ No newline at end of file
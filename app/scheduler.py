@@ -0,0 +1,237 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, event, or_, select, update
+
+from app import db
+from app.models import ScheduledMessage
+from app.whatsapp_sender import whatsapp_sender
+
+
+class MessageScheduler:
+    """Планировщик отложенной отправки сообщений WhatsApp.
+
+    Отложенные сообщения сохраняются в таблицу scheduled_messages и доставляются
+    фоновым потоком по куче сроков отправки (в срок сообщение передается в очередь
+    отправки WhatsApp), поэтому обработчик не ждет задержку, а перезапуск процесса
+    не теряет запланированные сообщения. Сообщение сохраняется в транзакции обработчика
+    и попадает в кучу только после ее фиксации. Перед отправкой
+    сообщение захватывается в аренду, чтобы несколько процессов не отправили его дважды.
+    Строка удаляется, когда очередь WhatsApp закончила с сообщением (отправила его или
+    отказалась от него); если процесс остановился раньше, сообщение будет отправлено снова
+    после окончания аренды, но не больше MAX_ATTEMPTS раз.
+    """
+
+    LEASE = 60  # Секунд аренды сообщения сверх срока ожидания в очереди отправки WhatsApp
+    RECOVERY_GRACE = 30  # Через сколько секунд после срока чужие сообщения считаются брошенными
+    MAX_ATTEMPTS = 3  # Сколько раз сообщение захватывается для отправки, прежде чем будет удалено
+
+    def __init__(self):
+        self.app = None
+        self.running = False
+        self._heap: List[Tuple[float, int, str, str]] = []
+        self._known = set()
+        self._holds: Dict[str, float] = {}
+        self._pending: Dict[str, int] = {}
+        self._last_due: Dict[str, float] = {}
+        self._finished: List[int] = []
+        self._condition = threading.Condition()
+        self._sent_total = 0
+
+    def init_app(self, app):
+        self.app = app
+        if not event.contains(db.session, 'after_commit', self._after_commit):
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+        if app.config.get('DELAYED_SENDS_ENABLED', True) and app.config.get('BACKGROUND_WORKERS', True):
+            self.running = True
+            threading.Thread(target=self._run, name='message-scheduler', daemon=True).start()
+
+    def hold(self, chat_id: str, delay: float):
+        """Откладывает все последующие сообщения чата минимум на delay секунд."""
+        with self._condition:
+            self._holds[chat_id] = max(self._holds.get(chat_id, 0), time.time() + delay)
+
+    def held_until(self, chat_id: str) -> Optional[float]:
+        """Возвращает время, раньше которого сообщения чата отправлять нельзя, или None."""
+        with self._condition:
+            now = time.time()
+            held = self._holds.get(chat_id)
+            if held is not None and held <= now:
+                del self._holds[chat_id]
+                held = None
+            if self._pending.get(chat_id):
+                # Не обгоняем уже запланированные сообщения чата
+                held = max(held or now, self._last_due[chat_id])
+            return held
+
+    def schedule(self, chat_id: str, message: str, due: float) -> int:
+        """Сохраняет сообщение для отправки в момент due (unix time) и возвращает его ID.
+
+        Сообщение записывается в текущей транзакции и будет отправлено после ее фиксации.
+        """
+        scheduled = ScheduledMessage(
+            chat_id=chat_id, body=message, due_at=datetime.fromtimestamp(due, timezone.utc).replace(tzinfo=None)
+        )
+        db.session.add(scheduled)
+        db.session.flush()
+        # Следующие сообщения чата не должны обогнать это еще до фиксации транзакции
+        self._reserve(chat_id, due)
+        db.session.info.setdefault('scheduled_messages', []).append((due, scheduled.id, chat_id, message))
+        return scheduled.id
+
+    def _after_commit(self, session):
+        for due, message_id, chat_id, message in session.info.pop('scheduled_messages', []):
+            self._push(due, message_id, chat_id, message, reserved=True)
+
+    def _after_rollback(self, session):
+        for _, _, chat_id, _ in session.info.pop('scheduled_messages', []):
+            with self._condition:
+                self._release(chat_id)
+
+    def _reserve(self, chat_id: str, due: float):
+        with self._condition:
+            self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+            self._last_due[chat_id] = max(self._last_due.get(chat_id, 0), due)
+
+    def _release(self, chat_id: str):
+        self._pending[chat_id] -= 1
+        if not self._pending[chat_id]:
+            del self._pending[chat_id]
+            del self._last_due[chat_id]
+
+    def _push(self, due: float, message_id: int, chat_id: str, message: str, reserved: bool = False):
+        with self._condition:
+            if message_id in self._known:
+                if reserved:
+                    self._release(chat_id)
+                return
+            if not reserved:
+                self._reserve(chat_id, due)
+            self._known.add(message_id)
+            heapq.heappush(self._heap, (due, message_id, chat_id, message))
+            self._condition.notify()
+
+    def _done(self, message_id: int, chat_id: str):
+        with self._condition:
+            self._known.discard(message_id)
+            self._release(chat_id)
+
+    def _recover(self, grace: Optional[float] = None):
+        """Загружает из БД неотправленные сообщения.
+
+        При grace=None загружаются все сообщения (запуск процесса), иначе - только те,
+        срок которых истек более grace секунд назад (брошенные другим процессом).
+        """
+        now = datetime.utcnow()
+        available = or_(ScheduledMessage.locked_until.is_(None), ScheduledMessage.locked_until < now)
+        statement = select(
+            ScheduledMessage.id, ScheduledMessage.chat_id, ScheduledMessage.body, ScheduledMessage.due_at
+        ).where(available, ScheduledMessage.attempts < self.MAX_ATTEMPTS).order_by(ScheduledMessage.due_at, ScheduledMessage.id)
+        if grace is not None:
+            statement = statement.where(ScheduledMessage.due_at <= now - timedelta(seconds=grace))
+        try:
+            # Сообщения, которые столько раз захватывались и не были отправлены, больше не повторяются
+            abandoned = db.session.execute(
+                delete(ScheduledMessage).where(available, ScheduledMessage.attempts >= self.MAX_ATTEMPTS)
+            ).rowcount
+            db.session.commit()
+            if abandoned:
+                logging.error(f"Удалено отложенных сообщений, не отправленных за {self.MAX_ATTEMPTS} попытки: {abandoned}")
+            rows = db.session.execute(statement).all()
+        except Exception as e:
+            logging.error(f"Ошибка при загрузке отложенных сообщений: {e}")
+            rows = []
+        db.session.rollback()
+        for message_id, chat_id, body, due_at in rows:
+            self._push((due_at - datetime(1970, 1, 1)).total_seconds(), message_id, chat_id, body)
+        if rows:
+            logging.info(f"Восстановлено отложенных сообщений: {len(rows)}")
+
+    def _claim(self, message_id: int) -> bool:
+        now = datetime.utcnow()
+        # Аренда держится, пока сообщение может ждать в очереди отправки WhatsApp
+        lease = self.LEASE + whatsapp_sender.message_ttl
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                update(ScheduledMessage)
+                .where(
+                    ScheduledMessage.id == message_id,
+                    ScheduledMessage.attempts < self.MAX_ATTEMPTS,
+                    or_(ScheduledMessage.locked_until.is_(None), ScheduledMessage.locked_until < now)
+                )
+                .values(locked_until=now + timedelta(seconds=lease), attempts=ScheduledMessage.attempts + 1)
+            )
+            return result.rowcount == 1
+
+    def _deliver(self, message_id: int, chat_id: str, message: str):
+        from app.services import post_message  # Импортируем здесь, чтобы избежать циклического импорта
+
+        try:
+            if not self._claim(message_id):
+                return
+            post_message(chat_id, message, on_done=lambda delivered: self._sent(message_id, delivered))
+        except Exception as e:
+            logging.error(f"Ошибка при отправке отложенного сообщения {message_id}: {e}")
+        finally:
+            self._done(message_id, chat_id)
+
+    def _sent(self, message_id: int, delivered: bool):
+        # Вызывается в цикле очереди WhatsApp, поэтому строку удаляет поток планировщика.
+        # Сообщение, от которого очередь отказалась, тоже удаляется: повтор отправил бы его с опозданием
+        if not delivered:
+            logging.error(f"Отложенное сообщение {message_id} не отправлено и удалено")
+        with self._condition:
+            if delivered:
+                self._sent_total += 1
+            self._finished.append(message_id)
+            self._condition.notify()
+
+    def _forget(self, message_ids: List[int]):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(delete(ScheduledMessage).where(ScheduledMessage.id.in_(message_ids)))
+        except Exception as e:
+            logging.error(f"Ошибка при удалении обработанных отложенных сообщений: {e}")
+            time.sleep(1)  # Не повторяем удаление без паузы, пока БД недоступна
+            with self._condition:
+                self._finished.extend(message_ids)
+
+    def _run(self):
+        with self.app.app_context():
+            self._recover()
+            next_recovery = time.monotonic() + self.RECOVERY_GRACE
+            # Сообщения, которые не удалось передать в очередь отправки, остаются в БД и будут восстановлены
+            while True:
+                with self._condition:
+                    timeout = self._heap[0][0] - time.time() if self._heap else self.RECOVERY_GRACE
+                    if timeout > 0 and not self._finished:
+                        self._condition.wait(min(timeout, self.RECOVERY_GRACE))
+                    due = []
+                    while self._heap and self._heap[0][0] <= time.time():
+                        due.append(heapq.heappop(self._heap))
+                    finished, self._finished = self._finished, []
+                if finished:
+                    self._forget(finished)
+                for _, message_id, chat_id, message in due:
+                    self._deliver(message_id, chat_id, message)
+                if time.monotonic() >= next_recovery:
+                    self._recover(grace=self.RECOVERY_GRACE)
+                    next_recovery = time.monotonic() + self.RECOVERY_GRACE
+
+    def stats(self) -> dict:
+        """Возвращает число ожидающих отправки сообщений и задержку ближайшего."""
+        with self._condition:
+            return {
+                'running': self.running,
+                'pending': len(self._heap),
+                'next_due_in': round(self._heap[0][0] - time.time(), 3) if self._heap else None,
+                'sent_total': self._sent_total,
+            }
+
+
+message_scheduler = MessageScheduler()
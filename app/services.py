@@ -1,100 +1,52 @@
 import asyncio
 import logging
 import os
-import requests
-from typing import List, Optional, Tuple
+import httpx
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
 
-from app import db, service
-from app.models import PartnerInfo, ClientsData, ClientSalonStatus, Category, Partner
-import telegram
+from sqlalchemy import delete
 
+from app import db
+from app.models import (
+    PartnerInfo, ClientsData, ClientSalonStatus, ClientExclusion, Category, Partner, AmoCrmContact, AmoCrmLead
+)
+from app.offer_catalog import offer_catalog
+from app.sheets_sync import sheets_sync
+from app.upsert import upsert_rows
+from app.scheduler import message_scheduler
+from app.http_client import http_client
+from app.telegram_notifier import telegram_notifier
+from app.whatsapp_sender import whatsapp_sender
 
-async def get_salons_data() -> Optional[List[PartnerInfo]]:
-    """Загружает данные о салонах из Google Sheets."""
-    try:
-        sheet = service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=os.environ.get("SHEET_ID"), range='A2:J').execute()  # Изменено количество столбцов
-        values = result.get('values', [])
 
-        if not values:
-            logging.error('Не удалось найти данные в таблице.')
-            return None
+async def update_salons_data(trigger: str = 'command') -> int:
+    """Запускает фоновое обновление данных о салонах из Google Sheets и возвращает ID запуска."""
+    return sheets_sync.trigger(trigger)
 
-        salons: List[PartnerInfo] = []
-        for row in values:
-            if len(row) == 10:
-                category, name, discount, city, contacts, salon_id, priority, linked_salon_id, message_salon_name, partner_type = row
-                salon_info = PartnerInfo(
-                    id=salon_id,
-                    partner_type=partner_type.strip().lower(),
-                    categories=[
-                        db.session.query(Category).filter(Category.name == c.strip()).first()
-                        for c in category.split(' • ')
-                    ],
-                    name=name,
-                    discount=discount,
-                    city=city,
-                    contacts=contacts,
-                    priority=(priority.strip().lower() == 'да'),
-                    linked_partner_id=linked_salon_id if linked_salon_id.strip().lower() != 'нет' else None,
-                    message_partner_name=message_salon_name
-                )
-                salons.append(salon_info)
-
-        return salons
-    except Exception as e:
-        logging.error(f"Ошибка при загрузке данных из Google Sheets: {e}")
-        return None
 
+async def send_message(chat_id: str, message: str):
+    """Отправляет сообщение пользователю через WhatsApp API.
+
+    Сообщение ставится в очередь отправки и не ожидает ответа WHAPI. Если для чата
+    действует задержка (например, крутится колесо фортуны), сообщение передается
+    планировщику и будет поставлено в очередь после ее окончания.
+    """
+    held_until = message_scheduler.held_until(chat_id)
+    if held_until is not None:
+        message_id = message_scheduler.schedule(chat_id, message, held_until)
+        logging.info(f"Сообщение для номера {chat_id} запланировано к отправке, ID: {message_id}")
+        return
+    post_message(chat_id, message)
 
-async def save_salons_data_to_db(salons: List[PartnerInfo]):
-    """Сохраняет данные о салонах в базу данных."""
-    for salon in salons:
-        existing_salon = db.session.get(PartnerInfo, salon.id)
-        if not existing_salon:
-            db.session.add(salon)
-        else:
-            existing_salon.category = salon.category
-            existing_salon.name = salon.name
-            existing_salon.discount = salon.discount
-            existing_salon.city = salon.city
-            existing_salon.contacts = salon.contacts
-            existing_salon.priority = salon.priority
-            existing_salon.linked_salon_id = salon.linked_salon_id
-    db.session.commit()
-
-
-async def update_salons_data():
-    """Обновляет данные о салонах из Google Sheets."""
-    new_salons = await get_salons_data()
-    if new_salons:
-        await save_salons_data_to_db(new_salons)
-        logging.info("Данные о салонах успешно обновлены.")
-    else:
-        logging.error("Не удалось обновить данные о салонах.")
 
+def post_message(chat_id: str, message: str, on_done: Optional[Callable[[bool], None]] = None):
+    """Ставит сообщение в очередь отправки WHAPI без учета задержек чата.
 
-async def send_message(chat_id: str, message: str) -> Optional[dict]:
-    """Отправляет сообщение пользователю через WhatsApp API."""
+    on_done(delivered) вызывается, когда очередь отправки закончила с сообщением.
+    """
     logging.info(f"Отправка сообщения на номер {chat_id}: {message}")
-    data = {
-        'to': chat_id,
-        'body': message
-    }
-    headers = {
-        'Authorization': f'Bearer {os.environ.get("WHAPI_API_KEY")}',
-        'Content-Type': 'application/json'
-    }
-    try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: requests.post(os.environ.get("WHAPI_BASE_URL"), json=data, headers=headers)
-        )
-        response.raise_for_status()
-        logging.info(f"Ответ от WHAPI: {response.status_code} {response.text}")
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Ошибка при отправке сообщения: {e}")
-        return None
+    whatsapp_sender.enqueue(chat_id, message, on_done)
 
 
 async def create_amocrm_contact(client_data: ClientsData) -> Optional[int]:
@@ -106,76 +58,153 @@ async def create_amocrm_contact(client_data: ClientsData) -> Optional[int]:
         logging.info(f"Контакт с номером {client_data.chat_id} уже существует в AmoCRM, ID: {existing_contact_id}")
         return existing_contact_id
 
-    url = f'https://{os.environ.get("AMOCRM_SUBDOMAIN")}.amocrm.ru/api/v4/contacts'
-    headers = {
-        'Authorization': f'Bearer {os.environ.get("AMOCRM_API_KEY")}',
-        'Content-Type': 'application/json'
-    }
-    contact_data = {
-        'name': client_data.client_name,
-        'custom_fields_values': [
-            {'field_id': 265455, 'values': [{'value': client_data.chat_id}]}
-        ]
-    }
+    contact_ids = await create_amocrm_contacts({client_data.chat_id: client_data.client_name})
+    return contact_ids.get(client_data.chat_id) if contact_ids else None
+
+
+async def create_amocrm_contacts(contacts: Dict[str, str]) -> Optional[Dict[str, int]]:
+    """Создает контакты в AmoCRM одним запросом.
+
+    Принимает словарь {номер телефона: имя} и возвращает {номер телефона: ID контакта}.
+    """
+    contacts_data = [
+        {
+            'name': name,
+            'request_id': chat_id,
+            'custom_fields_values': [
+                {'field_id': 265455, 'values': [{'value': chat_id}]}
+            ]
+        }
+        for chat_id, name in contacts.items()
+    ]
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: requests.post(url, headers=headers, json=[contact_data])
-        )
+        response = await http_client.post(amocrm_url('contacts'), headers=amocrm_headers(), json=contacts_data)
         response.raise_for_status()
-        response_data = response.json()
-        contact_id = response_data['_embedded']['contacts'][0]['id']
-        logging.info(f"Контакт успешно создан в AmoCRM, ID: {contact_id}")
-        return contact_id
-    except requests.exceptions.RequestException as e:
+        contact_ids = {
+            contact['request_id']: contact['id']
+            for contact in response.json()['_embedded']['contacts']
+        }
+        for chat_id, contact_id in contact_ids.items():
+            remember_amocrm_contact(chat_id, contact_id)
+        logging.info(f"Контакты успешно созданы в AmoCRM, ID: {list(contact_ids.values())}")
+        return contact_ids
+    except (httpx.HTTPError, ValueError, KeyError) as e:
         logging.error(f"Ошибка при создании контакта в AmoCRM: {e}")
         return None
 
 
-async def create_or_update_amocrm_lead(client_data: ClientsData, contact_id: int):
-    """Создает или обновляет сделку в AmoCRM, привязанную к контакту."""
-    url = f'https://{os.environ.get("AMOCRM_SUBDOMAIN")}.amocrm.ru/api/v4/leads'
-    headers = {
+def amocrm_url(path: str) -> str:
+    """Возвращает полный URL метода API AmoCRM v4."""
+    return f'https://{os.environ.get("AMOCRM_SUBDOMAIN")}.amocrm.ru/api/v4/{path}'
+
+
+def amocrm_headers() -> dict:
+    return {
         'Authorization': f'Bearer {os.environ.get("AMOCRM_API_KEY")}',
         'Content-Type': 'application/json'
     }
 
-    # Получаем список сделок, привязанных к контакту
-    contact_leads_url = f'https://{os.environ.get("AMOCRM_SUBDOMAIN")}.amocrm.ru/api/v4/contacts/{contact_id}/links'
-    contact_leads_payload = {"to": "leads"}
-    contact_leads_response = await asyncio.get_event_loop().run_in_executor(
-        None, lambda: requests.get(contact_leads_url, headers=headers, json=contact_leads_payload)
+
+AMOCRM_PAGE_LIMIT = 250  # Максимальный размер страницы в API AmoCRM
+
+
+async def get_amocrm_contact_lead_ids(contact_id: int) -> Optional[List[int]]:
+    """Возвращает ID сделок, привязанных к контакту, или None при ошибке."""
+    response = await http_client.get(
+        amocrm_url(f'contacts/{contact_id}/links'),
+        headers=amocrm_headers(),
+        params={'filter[to_entity_type]': 'leads'}
     )
+    if response.status_code == 204:
+        return []
+    if response.status_code != 200:
+        logging.error(f"Ошибка при получении списка сделок контакта: {response.status_code} {response.text}")
+        return None
+    return [
+        link['to_entity_id'] for link in response.json()['_embedded']['links']
+        if link.get('to_entity_type', 'leads') == 'leads'
+    ]
 
-    if contact_leads_response.status_code == 200:
-        contact_leads_data = contact_leads_response.json()
-        lead_id = None
-        for lead in contact_leads_data["_embedded"]["links"]:
-            # Ищем сделку, относящуюся к текущему салону (по полю ID Салона)
-            lead_url = f'https://{os.environ.get("AMOCRM_SUBDOMAIN")}.amocrm.ru/api/v4/leads/{lead["to_entity_id"]}'
-            lead_response = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: requests.get(lead_url, headers=headers)
-            )
-            if lead_response.status_code == 200:
-                lead_data = lead_response.json()
-                for field in lead_data.get("custom_fields_values", []):
-                    if field["field_id"] == 267157 and field["values"][0]["value"] == client_data.initial_salon_id:
-                        lead_id = lead["to_entity_id"]
-                        break
-            if lead_id:  # Если нашли сделку, выходим из цикла
+
+async def get_amocrm_leads(lead_ids: List[int]) -> Optional[List[dict]]:
+    """Загружает сделки по списку ID фильтрованными постраничными запросами.
+
+    Вместо запроса на каждую сделку ID передаются фильтром filter[id][] пачками
+    по AMOCRM_PAGE_LIMIT, поэтому число запросов не зависит от числа сделок контакта.
+    """
+    leads = []
+    for offset in range(0, len(lead_ids), AMOCRM_PAGE_LIMIT):
+        chunk = lead_ids[offset:offset + AMOCRM_PAGE_LIMIT]
+        page = 1
+        while True:
+            params = [('filter[id][]', lead_id) for lead_id in chunk]
+            params += [('limit', AMOCRM_PAGE_LIMIT), ('page', page)]
+            response = await http_client.get(amocrm_url('leads'), headers=amocrm_headers(), params=params)
+            if response.status_code == 204:
                 break
+            if response.status_code != 200:
+                logging.error(f"Ошибка при получении сделок из AmoCRM: {response.status_code} {response.text}")
+                return None
+            data = response.json()
+            leads.extend(data['_embedded']['leads'])
+            if 'next' not in data.get('_links', {}):
+                break
+            page += 1
+    return leads
+
+
+def find_salon_lead_id(leads: List[dict], salon_id: str) -> Optional[int]:
+    """Находит среди сделок ту, что относится к салону (по полю ID Салона)."""
+    for lead in leads:
+        for field in lead.get('custom_fields_values') or []:
+            if field['field_id'] == 267157 and field['values'][0]['value'] == salon_id:
+                return lead['id']
+    return None
+
+
+async def create_or_update_amocrm_lead(client_data: ClientsData, contact_id: int):
+    """Создает или обновляет сделку в AmoCRM, привязанную к контакту.
+
+    Сначала используется сохраненный ID сделки клиента; если AmoCRM его не знает,
+    соответствие удаляется и сделка ищется среди сделок контакта заново.
+    """
+    url = amocrm_url('leads')
+    headers = amocrm_headers()
+    update_data = {
+        'custom_fields_values': [
+            {'field_id': 267159, 'values': [{'value': client_data.claimed_salon_name}]},
+            {'field_id': 267161, 'values': [{'value': client_data.claimed_salon_id}]}
+        ]
+    }
+
+    try:
+        lead_id = get_known_amocrm_lead_id(client_data.id, client_data.initial_salon_id)
+        if lead_id:
+            response = await http_client.patch(f'{url}/{lead_id}', headers=headers, json=update_data)
+            if response.status_code == 200 or response.status_code == 204:
+                logging.info(f"Сделка успешно обновлена в AmoCRM, ID: {lead_id}")
+                return
+            if response.status_code not in (400, 404):
+                logging.error(f"Ошибка при обновлении сделки в AmoCRM: {response.status_code} {response.text}")
+                return
+            logging.warning(f"Сделка {lead_id} не найдена в AmoCRM, ищем заново")
+            forget_amocrm_lead(client_data.id, client_data.initial_salon_id)
+
+        # Получаем сделки контакта одним фильтрованным запросом и ищем нужную в памяти
+        lead_ids = await get_amocrm_contact_lead_ids(contact_id)
+        if lead_ids is None:
+            # Контакт мог быть удален в AmoCRM - при следующей синхронизации найдем его заново
+            forget_amocrm_contact(client_data.chat_id)
+            return
+        leads = await get_amocrm_leads(lead_ids) if lead_ids else []
+        if leads is None:
+            return
+        lead_id = find_salon_lead_id(leads, client_data.initial_salon_id)
 
         if lead_id:
             # Обновляем существующую сделку
-            update_url = f'{url}/{lead_id}'
-            lead_data = {
-                'custom_fields_values': [
-                    {'field_id': 267159, 'values': [{'value': client_data.claimed_salon_name}]},
-                    {'field_id': 267161, 'values': [{'value': client_data.claimed_salon_id}]}
-                ]
-            }
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: requests.patch(update_url, headers=headers, json=lead_data)
-            )
+            remember_amocrm_lead(client_data.id, client_data.initial_salon_id, lead_id)
+            response = await http_client.patch(f'{url}/{lead_id}', headers=headers, json=update_data)
             if response.status_code == 200 or response.status_code == 204:
                 logging.info(f"Сделка успешно обновлена в AmoCRM, ID: {lead_id}")
             else:
@@ -195,61 +224,185 @@ async def create_or_update_amocrm_lead(client_data: ClientsData, contact_id: int
                     {'field_id': 267163, 'values': [{'value': client_data.city}]}
                 ]
             }
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: requests.post(url, headers=headers, json=[lead_data])
-            )
-            if response.status_code == 200 or response.status_code == 204:
-                logging.info(f"Сделка успешно создана и привязана к контакту в AmoCRM")
+            response = await http_client.post(url, headers=headers, json=[lead_data])
+            if response.status_code == 200:
+                lead_id = response.json()['_embedded']['leads'][0]['id']
+                remember_amocrm_lead(client_data.id, client_data.initial_salon_id, lead_id)
+                logging.info(f"Сделка успешно создана и привязана к контакту в AmoCRM, ID: {lead_id}")
             else:
                 logging.error(f"Ошибка при создании сделки в AmoCRM: {response.status_code} {response.text}")
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logging.error(f"Ошибка при работе со сделками AmoCRM: {e}")
+
+
+def get_known_amocrm_contact_id(chat_id: str) -> Optional[int]:
+    """Возвращает сохраненный ID контакта AmoCRM для номера телефона."""
+    return db.session.query(AmoCrmContact.contact_id).filter(AmoCrmContact.chat_id == chat_id).scalar()
+
+
+def get_known_amocrm_lead_id(client_id: int, initial_salon_id: str) -> Optional[int]:
+    """Возвращает сохраненный ID сделки AmoCRM для клиента и исходного салона."""
+    return db.session.query(AmoCrmLead.lead_id).filter(
+        AmoCrmLead.client_id == client_id, AmoCrmLead.initial_salon_id == initial_salon_id
+    ).scalar()
+
+
+def _replace_identity(model, key: dict, values: dict):
+    """Перезаписывает (или при пустых values удаляет) строку соответствия в текущей транзакции.
+
+    Запись выполняется через INSERT ... ON CONFLICT, поэтому одновременное сохранение
+    того же соответствия другим процессом не приводит к ошибке.
+    """
+    if values:
+        upsert_rows(model.__table__, [{**key, **values}], list(key), list(values))
     else:
-        logging.error(f"Ошибка при получении списка сделок контакта: {contact_leads_response.status_code} {contact_leads_response.text}")
+        db.session.execute(delete(model).where(*(getattr(model, column) == value for column, value in key.items())))
+
+
+def remember_amocrm_contact(chat_id: str, contact_id: int):
+    _replace_identity(AmoCrmContact, {'chat_id': chat_id}, {'contact_id': contact_id})
+
 
+def forget_amocrm_contact(chat_id: str):
+    _replace_identity(AmoCrmContact, {'chat_id': chat_id}, {})
+
+
+def remember_amocrm_lead(client_id: int, initial_salon_id: str, lead_id: int):
+    _replace_identity(AmoCrmLead, {'client_id': client_id, 'initial_salon_id': initial_salon_id}, {'lead_id': lead_id})
+
+
+def forget_amocrm_lead(client_id: int, initial_salon_id: str):
+    _replace_identity(AmoCrmLead, {'client_id': client_id, 'initial_salon_id': initial_salon_id}, {})
 
 
 async def get_amocrm_contact_id(phone_number: str) -> Optional[int]:
-    """Получает ID контакта из AmoCRM по номеру телефона."""
-    url = f'https://{os.environ.get("AMOCRM_SUBDOMAIN")}.amocrm.ru/api/v4/contacts?query={phone_number}'
-    headers = {
-        'Authorization': f'Bearer {os.environ.get("AMOCRM_API_KEY")}'
-    }
+    """Получает ID контакта из AmoCRM по номеру телефона.
+
+    Сначала проверяется сохраненное соответствие, поиск в AmoCRM выполняется только для новых номеров.
+    """
+    contact_id = get_known_amocrm_contact_id(phone_number)
+    if contact_id:
+        return contact_id
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: requests.get(url, headers=headers)
+        response = await http_client.get(
+            amocrm_url('contacts'), headers=amocrm_headers(), params={'query': phone_number}
         )
         response.raise_for_status()
+        if response.status_code == 204:
+            return None
         data = response.json()
         if data['_embedded']['contacts']:
-            return data['_embedded']['contacts'][0]['id']
+            contact_id = data['_embedded']['contacts'][0]['id']
+            remember_amocrm_contact(phone_number, contact_id)
+            return contact_id
         else:
             return None
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
         logging.error(f"Ошибка при получении ID контакта из AmoCRM: {e}")
         return None
-        
+
+
+async def get_amocrm_contacts_lead_ids(contact_ids: List[int]) -> Optional[Dict[int, List[int]]]:
+    """Возвращает ID сделок для нескольких контактов постраничными запросами с with=leads.
+
+    Контакты, которых нет в AmoCRM, в результат не попадают.
+    """
+    result = {}
+    for offset in range(0, len(contact_ids), AMOCRM_PAGE_LIMIT):
+        chunk = contact_ids[offset:offset + AMOCRM_PAGE_LIMIT]
+        page = 1
+        while True:
+            params = [('filter[id][]', contact_id) for contact_id in chunk]
+            params += [('with', 'leads'), ('limit', AMOCRM_PAGE_LIMIT), ('page', page)]
+            response = await http_client.get(amocrm_url('contacts'), headers=amocrm_headers(), params=params)
+            if response.status_code == 204:
+                break
+            if response.status_code != 200:
+                logging.error(f"Ошибка при получении контактов из AmoCRM: {response.status_code} {response.text}")
+                return None
+            data = response.json()
+            for contact in data['_embedded']['contacts']:
+                result[contact['id']] = [lead['id'] for lead in contact.get('_embedded', {}).get('leads', [])]
+            if 'next' not in data.get('_links', {}):
+                break
+            page += 1
+    return result
+
+
+async def save_amocrm_leads(method: str, leads: List[dict]) -> Optional[List[dict]]:
+    """Создает (POST) или обновляет (PATCH) пачку сделок одним запросом."""
+    try:
+        response = await http_client.request(method, amocrm_url('leads'), headers=amocrm_headers(), json=leads)
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка при сохранении сделок в AmoCRM: {e}")
+        return None
+    if response.status_code not in (200, 204):
+        logging.error(f"Ошибка при сохранении сделок в AmoCRM: {response.status_code} {response.text}")
+        return None
+    return response.json()['_embedded']['leads'] if response.status_code == 200 else []
+
+
 async def set_salon_status(client_id: int, salon_id: str, status: str):
     """Устанавливает статус салона для клиента."""
-    existing_status = ClientSalonStatus.query.filter_by(client_id=client_id, salon_id=salon_id).first()
-    if existing_status:
-        existing_status.status = status
-    else:
-        new_status = ClientSalonStatus(client_id=client_id, salon_id=salon_id, status=status)
-        db.session.add(new_status)
-    db.session.commit()
+    await set_salon_statuses(client_id, {salon_id: status})
+
+async def set_salon_statuses(client_id: int, statuses: Dict[str, str]):
+    """Устанавливает статусы нескольких салонов для клиента одним запросом.
+
+    Запись выполняется как INSERT ... ON CONFLICT (client_id, salon_id) DO UPDATE,
+    поэтому одновременные сообщения клиента не конфликтуют на unique_client_salon_status.
+    Изменения фиксируются вместе с остальными изменениями обработки сообщения.
+    """
+    if not statuses:
+        return
+    now = datetime.utcnow()
+    upsert_rows(
+        ClientSalonStatus.__table__,
+        [
+            {'client_id': client_id, 'salon_id': salon_id, 'status': status, 'updated_at': now}
+            for salon_id, status in statuses.items()
+        ],
+        ['client_id', 'salon_id'], ['status', 'updated_at']
+    )
+    add_client_exclusions(client_id, list(statuses))
+
+def get_client_exclusion(client_id: int, for_update: bool = False) -> ClientExclusion:
+    """Возвращает исключения клиента, при отсутствии рассчитывая их по статусам салонов.
+
+    С for_update строка исключений блокируется до конца транзакции (SELECT ... FOR UPDATE)
+    и перечитывается из БД, чтобы одновременные сообщения клиента не затирали изменения
+    друг друга.
+    """
+    exclusion = db.session.get(ClientExclusion, client_id, with_for_update=for_update, populate_existing=for_update)
+    if exclusion is None:
+        salon_ids = sorted({
+            salon_id for salon_id, in db.session.query(ClientSalonStatus.salon_id).filter(
+                ClientSalonStatus.client_id == client_id
+            )
+        })
+        # Строку могут одновременно рассчитать несколько обработчиков, сохраняется первая
+        upsert_rows(ClientExclusion.__table__, [{
+            'client_id': client_id,
+            'salon_ids': salon_ids,
+            'category_mask': format(offer_catalog.category_mask_for(salon_ids), 'x')
+        }], ['client_id'])
+        exclusion = db.session.get(ClientExclusion, client_id, with_for_update=for_update, populate_existing=True)
+    return exclusion
+
+def add_client_exclusions(client_id: int, salon_ids: List[str]):
+    """Добавляет салоны и их категории в исключения клиента."""
+    exclusion = get_client_exclusion(client_id, for_update=True)
+    new_salon_ids = [salon_id for salon_id in dict.fromkeys(salon_ids) if salon_id not in exclusion.salon_ids]
+    if new_salon_ids:
+        exclusion.salon_ids = exclusion.salon_ids + new_salon_ids
+        exclusion.mask = exclusion.mask | offer_catalog.category_mask_for(new_salon_ids)
 
 async def get_salon_status(client_id: int, salon_id: str) -> Optional[str]:
     """Возвращает статус салона для клиента."""
-    status = ClientSalonStatus.query.filter_by(client_id=client_id, salon_id=salon_id).first()
-    return status.status if status else None     
+    return db.session.query(ClientSalonStatus.status).filter_by(client_id=client_id, salon_id=salon_id).scalar()
 
 async def send_telegram_notification(chat_id: int, message: str) -> Optional[bool]:
-    """Отправляет сообщение в Telegram."""
+    """Ставит сообщение в очередь отправки в Telegram, не дожидаясь доставки."""
     logging.info(f"Отправка сообщения в Telegram на ID чата {chat_id}: {message}")
-    bot = telegram.Bot(token=os.environ.get("TELEGRAM_BOT_TOKEN"))
-    try:
-        await bot.send_message(chat_id=chat_id, text=message)
-        logging.info("Сообщение успешно отправлено в Telegram.")
-        return True
-    except telegram.error.TelegramError as e:
-        logging.error(f"Ошибка при отправке сообщения в Telegram: {e}")
-        return False
\ No newline at end of file
+    telegram_notifier.notify(chat_id, message)
+    return True
\ No newline at end of file
@@ -0,0 +1,294 @@
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import delete, event, func, update
+
+from app import db, service
+from app.models import Category, City, PartnerInfo, SalonSyncState, SyncJob, salon_categories
+from app.offer_catalog import offer_catalog, reset_client_exclusions
+from app.upsert import upsert_rows
+
+# Столбцы таблицы салонов (A:J) в порядке следования
+SHEET_COLUMNS = (
+    'category', 'name', 'discount', 'city', 'contacts', 'salon_id',
+    'priority', 'linked_salon_id', 'message_salon_name', 'partner_type'
+)
+# Поля салона, которые задаются таблицей; счетчики и владелец при синхронизации не меняются
+SHEET_FIELDS = (
+    'partner_type', 'name', 'discount', 'city_id', 'contacts',
+    'priority', 'linked_partner_id', 'message_partner_name'
+)
+SALON_ID_COLUMN = SHEET_COLUMNS.index('salon_id')
+CATEGORY_SEPARATOR = '•'
+
+
+def row_hash(row: List[str]) -> str:
+    """Возвращает хэш содержимого строки таблицы."""
+    return hashlib.sha256('\x1f'.join(cell.strip() for cell in row).encode('utf-8')).hexdigest()
+
+
+class SalonSheetSync:
+    """Применяет строки таблицы салонов к БД, записывая только изменившиеся строки.
+
+    Категории и города сопоставляются по предзагруженным словарям, для каждой строки
+    хранится хэш (salon_sync_state), и строки с неизменным хэшем пропускаются.
+    Изменившиеся салоны записываются одним пакетным upsert, их категории - одним
+    удалением и одной пакетной вставкой. Строки со ссылками на неизвестные город или
+    категорию хэш не получают и будут применены заново при следующей синхронизации.
+    Строки можно передавать частями (apply вызывается для каждой порции).
+    """
+
+    def __init__(self):
+        self.categories: Dict[str, int] = {
+            name.strip().lower(): category_id for category_id, name in db.session.query(Category.id, Category.name)
+        }
+        self.cities: Dict[str, int] = {
+            name.strip().lower(): city_id for city_id, name in db.session.query(City.id, City.name)
+        }
+        self.hashes: Dict[str, str] = dict(db.session.query(SalonSyncState.salon_id, SalonSyncState.row_hash))
+        self.rows_read = 0
+        self.rows_changed = 0
+        self.rows_skipped = 0
+
+    def parse_row(self, row: List[str]) -> Optional[Tuple[dict, List[int], bool]]:
+        """Разбирает строку таблицы в (поля салона, ID категорий, все ссылки найдены)."""
+        if len(row) != len(SHEET_COLUMNS):
+            return None
+        cells = dict(zip(SHEET_COLUMNS, (cell.strip() for cell in row)))
+        if not cells['salon_id']:
+            return None
+        city_id = self.cities.get(cells['city'].lower())
+        if city_id is None:
+            logging.warning(f"Салон {cells['salon_id']}: город '{cells['city']}' не найден, строка пропущена")
+            return None
+
+        resolved = True
+        category_ids = []
+        for name in cells['category'].split(CATEGORY_SEPARATOR):
+            name = name.strip()
+            if not name:
+                continue
+            category_id = self.categories.get(name.lower())
+            if category_id is None:
+                logging.warning(f"Салон {cells['salon_id']}: категория '{name}' не найдена")
+                resolved = False
+            elif category_id not in category_ids:
+                category_ids.append(category_id)
+
+        linked_salon_id = cells['linked_salon_id']
+        values = {
+            'id': cells['salon_id'],
+            'partner_type': cells['partner_type'].lower(),
+            'name': cells['name'],
+            'discount': cells['discount'],
+            'city_id': city_id,
+            'contacts': cells['contacts'],
+            'priority': cells['priority'].lower() == 'да',
+            'linked_partner_id': linked_salon_id if linked_salon_id and linked_salon_id.lower() != 'нет' else None,
+            'message_partner_name': cells['message_salon_name'],
+        }
+        return values, category_ids, resolved
+
+    def apply(self, rows: Iterable[List[str]]) -> int:
+        """Применяет порцию строк таблицы и возвращает число измененных салонов."""
+        salons: Dict[str, dict] = {}
+        salon_category_ids: Dict[str, List[int]] = {}
+        states: Dict[str, str] = {}
+        for row in rows:
+            self.rows_read += 1
+            digest = row_hash(row)
+            salon_id = row[SALON_ID_COLUMN].strip() if len(row) == len(SHEET_COLUMNS) else ''
+            if salon_id and self.hashes.get(salon_id) == digest:
+                continue
+            parsed = self.parse_row(row)
+            if parsed is None:
+                self.rows_skipped += 1
+                continue
+            values, category_ids, resolved = parsed
+            salons[salon_id] = values
+            salon_category_ids[salon_id] = category_ids
+            if resolved:
+                states[salon_id] = digest
+            else:
+                states.pop(salon_id, None)
+
+        if not salons:
+            return 0
+
+        now = datetime.utcnow()
+        upsert_rows(PartnerInfo.__table__, list(salons.values()), ['id'], SHEET_FIELDS)
+        current_category_ids: Dict[str, set] = {}
+        for salon_id, category_id in db.session.query(salon_categories.c.salon_id, salon_categories.c.category_id).filter(
+            salon_categories.c.salon_id.in_(list(salons))
+        ):
+            current_category_ids.setdefault(salon_id, set()).add(category_id)
+        # Исключения клиентов хранят маску категорий салонов, поэтому при смене категорий их пересчитываем
+        reset_client_exclusions(
+            salon_id for salon_id, category_ids in salon_category_ids.items()
+            if set(category_ids) != current_category_ids.get(salon_id, set())
+        )
+        db.session.execute(delete(salon_categories).where(salon_categories.c.salon_id.in_(list(salons))))
+        pairs = [
+            {'salon_id': salon_id, 'category_id': category_id}
+            for salon_id, category_ids in salon_category_ids.items() for category_id in category_ids
+        ]
+        if pairs:
+            db.session.execute(salon_categories.insert(), pairs)
+        upsert_rows(
+            SalonSyncState.__table__,
+            [{'salon_id': salon_id, 'row_hash': digest, 'synced_at': now} for salon_id, digest in states.items()],
+            ['salon_id'], ['row_hash', 'synced_at']
+        )
+        db.session.commit()
+
+        self.hashes.update(states)
+        self.rows_changed += len(salons)
+        return len(salons)
+
+
+class SheetsSyncRunner:
+    """Фоновая синхронизация салонов с Google Sheets.
+
+    Запуски создаются командой 'update data', из админки или по расписанию
+    (SHEETS_SYNC_INTERVAL секунд) и записываются в таблицу sync_jobs, поэтому
+    запросивший только получает ID запуска, а выполняет его фоновый поток любого
+    веб-процесса. Таблица читается страницами по SHEETS_SYNC_PAGE_ROWS строк,
+    по SHEETS_SYNC_PAGES_PER_REQUEST страниц на один запрос batchGet, и каждая
+    страница сразу применяется к БД, поэтому в памяти хранится не больше одной пачки.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._wakeup = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('SHEETS_SYNC_INTERVAL', 0)
+        self.page_rows = app.config.get('SHEETS_SYNC_PAGE_ROWS', 1000)
+        self.pages_per_request = app.config.get('SHEETS_SYNC_PAGES_PER_REQUEST', 5)
+        self.timeout = app.config.get('SHEETS_SYNC_TIMEOUT', 1800)
+        if not event.contains(db.session, 'after_commit', self._after_commit):
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+        if app.config.get('BACKGROUND_WORKERS', True):
+            threading.Thread(target=self._run, name='sheets-sync', daemon=True).start()
+
+    def trigger(self, trigger: str) -> int:
+        """Ставит синхронизацию в очередь текущей транзакции и возвращает ID запуска.
+
+        Если синхронизация уже ожидает или выполняется, новый запуск не создается.
+        Фиксирует транзакцию вызывающий код, фоновый поток будится после фиксации.
+        """
+        job = SyncJob.query.filter(SyncJob.status.in_(('queued', 'running'))).order_by(SyncJob.id).first()
+        if job is None:
+            job = SyncJob(trigger=trigger, status='queued', created_at=datetime.utcnow())
+            db.session.add(job)
+            db.session.flush()
+            db.session.info['sheets_sync_queued'] = True
+            logging.info(f"Синхронизация с Google Sheets поставлена в очередь, ID: {job.id}")
+        else:
+            self._wakeup.set()
+        return job.id
+
+    def _after_commit(self, session):
+        if session.info.pop('sheets_sync_queued', False):
+            self._wakeup.set()
+
+    def _after_rollback(self, session):
+        session.info.pop('sheets_sync_queued', None)
+
+    def _claim(self) -> Optional[int]:
+        now = datetime.utcnow()
+        # Запуски, прерванные вместе с процессом, считаются неудачными
+        db.session.execute(
+            update(SyncJob)
+            .where(SyncJob.status == 'running', SyncJob.started_at < now - timedelta(seconds=self.timeout))
+            .values(status='failed', finished_at=now, error='Превышено время выполнения')
+        )
+        db.session.commit()
+        job_id = db.session.query(SyncJob.id).filter(SyncJob.status == 'queued').order_by(SyncJob.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        claimed = db.session.execute(
+            update(SyncJob).where(SyncJob.id == job_id, SyncJob.status == 'queued').values(status='running', started_at=now)
+        ).rowcount
+        db.session.commit()
+        return job_id if claimed == 1 else None
+
+    def _schedule(self):
+        if not self.interval:
+            return
+        last_created = db.session.query(func.max(SyncJob.created_at)).scalar()
+        if last_created is None or datetime.utcnow() - last_created >= timedelta(seconds=self.interval):
+            self.trigger('schedule')
+
+    def read_pages(self) -> Iterator[List[List[str]]]:
+        """Читает строки таблицы страницами, по несколько страниц за один запрос batchGet."""
+        sheet = service.spreadsheets()
+        first_row = 2
+        while True:
+            ranges = [
+                f'A{start}:J{start + self.page_rows - 1}'
+                for start in range(first_row, first_row + self.page_rows * self.pages_per_request, self.page_rows)
+            ]
+            result = sheet.values().batchGet(spreadsheetId=os.environ.get("SHEET_ID"), ranges=ranges).execute()
+            for value_range in result.get('valueRanges', []):
+                values = value_range.get('values', [])
+                if not values:
+                    return
+                yield values
+            first_row += self.page_rows * self.pages_per_request
+
+    def run_job(self, job_id: int):
+        """Выполняет синхронизацию, сохраняя прогресс запуска после каждой страницы."""
+        job = db.session.get(SyncJob, job_id)
+        try:
+            sync = SalonSheetSync()
+            for rows in self.read_pages():
+                sync.apply(rows)
+                job.rows_read, job.rows_changed, job.rows_skipped = sync.rows_read, sync.rows_changed, sync.rows_skipped
+                db.session.commit()
+            if not sync.rows_read:
+                raise ValueError('Не удалось найти данные в таблице.')
+            job.status = 'done'
+            logging.info(
+                f"Данные о салонах успешно обновлены: строк {sync.rows_read}, изменено {sync.rows_changed}, "
+                f"пропущено {sync.rows_skipped}"
+            )
+            if sync.rows_changed:
+                offer_catalog.invalidate()
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(SyncJob, job_id)
+            job.status = 'failed'
+            job.error = str(e)
+            logging.error(f"Ошибка при загрузке данных из Google Sheets: {e}")
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(60)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self._schedule()
+                    job_id = self._claim()
+                    while job_id is not None:
+                        self.run_job(job_id)
+                        job_id = self._claim()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.error(f"Ошибка фоновой синхронизации с Google Sheets: {e}")
+
+    def stats(self) -> dict:
+        """Возвращает состояние последнего запуска синхронизации."""
+        job = SyncJob.query.order_by(SyncJob.id.desc()).first()
+        return {'interval': self.interval, 'last_job': job.to_dict() if job else None}
+
+
+sheets_sync = SheetsSyncRunner()
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Tuple
+
+
+class WebhookSpool:
+    """Долговременная очередь входящих webhook-запросов в файле SQLite (режим WAL).
+
+    Webhook только записывает полученный JSON в очередь и сразу отвечает WHAPI,
+    а пул фоновых воркеров разбирает очередь и запускает обычные обработчики.
+    Необработанные записи переживают перезапуск: захват записи - это аренда
+    на WEBHOOK_SPOOL_LEASE секунд, по истечении которой запись снова доступна.
+    Записи одного чата захватываются строго по очереди (даже из разных процессов):
+    следующая запись чата доступна только после подтверждения предыдущей.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.path = None
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._drained = deque(maxlen=10000)
+        self._drained_total = 0
+        self._failed_total = 0
+        self._stats_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('WEBHOOK_SPOOL_ENABLED', False)
+        if not self.enabled:
+            return
+        self.path = app.config['WEBHOOK_SPOOL_PATH']
+        self.lease = app.config.get('WEBHOOK_SPOOL_LEASE', 300)
+        self.max_attempts = app.config.get('WEBHOOK_SPOOL_MAX_ATTEMPTS', 5)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS webhook_spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                chat_key TEXT,
+                received_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                locked_until REAL NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ix_webhook_spool_pending ON webhook_spool (failed, locked_until, id);
+        """)
+        columns = {row[1] for row in self._connection().execute('PRAGMA table_info(webhook_spool)')}
+        if 'chat_key' not in columns:
+            self._connection().execute('ALTER TABLE webhook_spool ADD COLUMN chat_key TEXT')
+        self._connection().execute(
+            'CREATE INDEX IF NOT EXISTS ix_webhook_spool_chat ON webhook_spool (chat_key, id)'
+        )
+        if app.config.get('BACKGROUND_WORKERS', True):
+            self.start(app.config.get('WEBHOOK_SPOOL_WORKERS', 4))
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+        return connection
+
+    def append(self, payload: dict, chat_key: Optional[str] = None) -> int:
+        """Записывает webhook в очередь и возвращает ID записи.
+
+        chat_key задает чат, в порядке которого должны обрабатываться записи.
+        """
+        cursor = self._connection().execute(
+            'INSERT INTO webhook_spool (payload, chat_key, received_at) VALUES (?, ?, ?)',
+            (json.dumps(payload, ensure_ascii=False), chat_key, time.time())
+        )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def claim(self, limit: int) -> List[Tuple[int, dict, int]]:
+        """Захватывает до limit самых старых доступных записей в аренду.
+
+        Захватываются только первые необработанные записи каждого чата.
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, payload, attempts FROM webhook_spool AS s '
+                'WHERE failed = 0 AND locked_until < ? AND NOT EXISTS ('
+                '    SELECT 1 FROM webhook_spool AS o '
+                '    WHERE o.chat_key = s.chat_key AND o.id < s.id AND o.failed = 0'
+                ') ORDER BY id LIMIT ?',
+                (now, limit)
+            ).fetchall()
+            if rows:
+                connection.executemany(
+                    'UPDATE webhook_spool SET locked_until = ? WHERE id = ?',
+                    [(now + self.lease, row[0]) for row in rows]
+                )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return [(entry_id, json.loads(payload), attempts) for entry_id, payload, attempts in rows]
+
+    def ack(self, entry_id: int):
+        """Удаляет успешно обработанную запись."""
+        self._connection().execute('DELETE FROM webhook_spool WHERE id = ?', (entry_id,))
+        self._wakeup.set()  # Следующая запись этого чата стала доступна
+        with self._stats_lock:
+            self._drained_total += 1
+            self._drained.append(time.time())
+
+    def fail(self, entry_id: int, attempts: int, error: str, payload: Optional[dict] = None):
+        """Откладывает запись для повторной обработки или помечает ее как неудачную.
+
+        payload заменяет сохраненный запрос: повтор обрабатывает только его.
+        """
+        attempts += 1
+        failed = 1 if attempts >= self.max_attempts else 0
+        retry_at = time.time() + min(2 ** attempts, 300)
+        self._connection().execute(
+            'UPDATE webhook_spool SET payload = COALESCE(?, payload), attempts = ?, failed = ?, locked_until = ?, '
+            'last_error = ? WHERE id = ?',
+            (json.dumps(payload, ensure_ascii=False) if payload is not None else None,
+             attempts, failed, retry_at, error, entry_id)
+        )
+        with self._stats_lock:
+            self._failed_total += 1
+        if failed:
+            logging.error(f"Запись очереди webhook {entry_id} не обработана после {attempts} попыток: {error}")
+
+    def stats(self) -> dict:
+        """Возвращает глубину очереди, скорость разбора и возраст самой старой записи."""
+        if not self.enabled:
+            return {'enabled': False}
+        depth, oldest = self._connection().execute(
+            'SELECT COUNT(*), MIN(received_at) FROM webhook_spool WHERE failed = 0'
+        ).fetchone()
+        failed, = self._connection().execute(
+            'SELECT COUNT(*) FROM webhook_spool WHERE failed = 1'
+        ).fetchone()
+        now = time.time()
+        with self._stats_lock:
+            drained_last_minute = sum(1 for drained_at in self._drained if now - drained_at <= 60)
+            drained_total = self._drained_total
+            failed_total = self._failed_total
+        return {
+            'enabled': True,
+            'depth': depth,
+            'failed': failed,
+            'oldest_age': round(now - oldest, 3) if oldest else 0,
+            'drain_rate_per_minute': drained_last_minute,
+            'drained_total': drained_total,
+            'failures_total': failed_total,
+            'workers': len(self._threads) - 1 if self._threads else 0,
+        }
+
+    def start(self, workers: int):
+        """Запускает поток выборки записей и пул воркеров."""
+        if self._threads:
+            return
+        tasks = queue.Queue(maxsize=workers * 2)
+        feeder = threading.Thread(target=self._feed, args=(tasks,), name='webhook-spool-feeder', daemon=True)
+        self._threads.append(feeder)
+        for number in range(workers):
+            self._threads.append(threading.Thread(
+                target=self._work, args=(tasks,), name=f'webhook-spool-worker-{number}', daemon=True
+            ))
+        for thread in self._threads:
+            thread.start()
+        logging.info(f"Очередь webhook запущена: {self.path}, воркеров: {workers}")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _feed(self, tasks: queue.Queue):
+        while not self._stop.is_set():
+            free = tasks.maxsize - tasks.qsize()
+            entries = self.claim(free) if free > 0 else []
+            for entry in entries:
+                tasks.put(entry)
+            if not entries:
+                self._wakeup.wait(0.5)
+                self._wakeup.clear()
+
+    @staticmethod
+    def _retry_payload(payload: dict, body: dict) -> Optional[dict]:
+        # Повторяются только сообщения, обработка которых упала до первого коммита: обработанные
+        # и частично зафиксированные (failed) сообщения повтор выполнил бы второй раз
+        results = body.get('results')
+        messages = payload.get('messages')
+        if not isinstance(results, list) or not isinstance(messages, list) or len(results) != len(messages):
+            return None
+        return {**payload, 'messages': [
+            message for message, result in zip(messages, results) if result.get('status') == 'error'
+        ]}
+
+    def _work(self, tasks: queue.Queue):
+        from app.routes import process_webhook  # Импортируем здесь, чтобы избежать циклического импорта
+
+        while not self._stop.is_set():
+            entry_id, payload, attempts = tasks.get()
+            try:
+                with self.app.app_context():
+                    body, status = asyncio.run(process_webhook(payload))
+                if status >= 500:
+                    self.fail(entry_id, attempts, body.get('message', ''), self._retry_payload(payload, body))
+                else:
+                    self.ack(entry_id)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке записи очереди webhook {entry_id}: {e}")
+                self.fail(entry_id, attempts, str(e))
+            finally:
+                tasks.task_done()
+
+
+webhook_spool = WebhookSpool()
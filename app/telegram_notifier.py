@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Deque, Dict, List, Optional, Tuple
+
+import telegram
+from telegram.request import HTTPXRequest
+
+from app.background_loop import background_loop
+
+
+class TelegramNotifier:
+    """Очередь уведомлений партнерам в Telegram с учетом лимитов Bot API.
+
+    Уведомления отправляются одним долгоживущим клиентом telegram.Bot с пулом соединений
+    в фоновом цикле, поэтому обработчик сообщения только ставит уведомление в очередь.
+    Отправка ограничена глобально (TELEGRAM_RATE_LIMIT сообщений в секунду) и по чатам
+    (не чаще раза в TELEGRAM_CHAT_INTERVAL секунд), порядок уведомлений одного чата
+    сохраняется. Ответ 429 откладывает чат на retry_after секунд, сетевые ошибки
+    повторяются с экспоненциальной задержкой до TELEGRAM_MAX_ATTEMPTS попыток.
+    Очередь хранится в памяти процесса и при перезапуске теряется.
+    """
+
+    def __init__(self):
+        self.rate_limit = 30
+        self.chat_interval = 1.0
+        self.max_attempts = 5
+        self.pool_size = 8
+        self._bot: Optional[telegram.Bot] = None
+        self._chats: Dict[int, Deque[Tuple[str, float, int]]] = {}
+        self._ready: List[Tuple[float, int, int]] = []
+        self._sequence = 0
+        self._queued = 0
+        self._in_flight = set()
+        self._next_allowed: Dict[int, float] = {}
+        self._global_next = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._sent_total = 0
+        self._failed_total = 0
+        self._retried_total = 0
+        self._wait_total = 0.0
+        self._send_latency_total = 0.0
+
+    def init_app(self, app):
+        self.rate_limit = app.config.get('TELEGRAM_RATE_LIMIT', self.rate_limit)
+        self.chat_interval = app.config.get('TELEGRAM_CHAT_INTERVAL', self.chat_interval)
+        self.max_attempts = app.config.get('TELEGRAM_MAX_ATTEMPTS', self.max_attempts)
+        self.pool_size = app.config.get('TELEGRAM_POOL_SIZE', self.pool_size)
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            background_loop.submit(self._run())
+
+    def notify(self, chat_id: int, message: str):
+        """Ставит уведомление в очередь. Можно вызывать из любого потока и цикла."""
+        if not self._started:
+            self._start()
+        background_loop.loop.call_soon_threadsafe(self._enqueue, chat_id, message, time.monotonic())
+
+    # --- Все методы ниже выполняются только в фоновом цикле ---
+
+    def _get_bot(self) -> telegram.Bot:
+        if self._bot is None:
+            self._bot = telegram.Bot(
+                token=os.environ.get("TELEGRAM_BOT_TOKEN"),
+                request=HTTPXRequest(connection_pool_size=self.pool_size)
+            )
+        return self._bot
+
+    def _push_ready(self, chat_id: int, ready_at: float):
+        self._sequence += 1
+        heapq.heappush(self._ready, (ready_at, self._sequence, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _enqueue(self, chat_id: int, message: str, queued_at: float, attempts: int = 0, front: bool = False):
+        pending = self._chats.setdefault(chat_id, deque())
+        self._queued += 1
+        if front:
+            pending.appendleft((message, queued_at, attempts))
+        else:
+            pending.append((message, queued_at, attempts))
+        if (front or len(pending) == 1) and chat_id not in self._in_flight:
+            self._push_ready(chat_id, max(time.monotonic(), self._next_allowed.get(chat_id, 0)))
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        logging.info(f"Очередь уведомлений Telegram запущена: до {self.rate_limit} сообщений в секунду")
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._ready[0][0] - time.monotonic()
+            if delay > 0:
+                # Ждем срока ближайшего чата или появления нового уведомления
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Глобальный лимит: равномерно не чаще rate_limit отправок в секунду
+            now = time.monotonic()
+            if self._global_next > now:
+                await asyncio.sleep(self._global_next - now)
+            self._global_next = max(time.monotonic(), self._global_next) + 1 / self.rate_limit
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            if len(self._next_allowed) > 10000:
+                self._next_allowed = {
+                    key: allowed for key, allowed in self._next_allowed.items() if allowed > now
+                }
+            pending = self._chats.get(chat_id)
+            if not pending:
+                continue
+            message, queued_at, attempts = pending.popleft()
+            self._queued -= 1
+            self._in_flight.add(chat_id)
+            asyncio.get_running_loop().create_task(self._send(chat_id, message, queued_at, attempts))
+
+    async def _send(self, chat_id: int, message: str, queued_at: float, attempts: int):
+        started = time.monotonic()
+        retry_in = None
+        try:
+            await self._get_bot().send_message(chat_id=chat_id, text=message)
+            self._sent_total += 1
+            self._wait_total += started - queued_at
+            self._send_latency_total += time.monotonic() - started
+            logging.info(f"Уведомление отправлено в Telegram на ID чата {chat_id}")
+        except telegram.error.RetryAfter as e:
+            retry_in = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logging.warning(f"Лимит Telegram для чата {chat_id}, повтор через {retry_in} с")
+        except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+            if attempts + 1 < self.max_attempts:
+                retry_in = min(2 ** attempts, 60) * (1 + random.random())
+                logging.warning(f"Ошибка сети при отправке в Telegram ({e}), повтор через {retry_in:.1f} с")
+            else:
+                self._failed_total += 1
+                logging.error(f"Уведомление в Telegram на ID чата {chat_id} не отправлено после {attempts + 1} попыток: {e}")
+        except telegram.error.TelegramError as e:
+            self._failed_total += 1
+            logging.error(f"Ошибка при отправке сообщения в Telegram: {e}")
+        finally:
+            self._in_flight.discard(chat_id)
+            next_allowed = time.monotonic() + self.chat_interval
+            if retry_in is not None:
+                self._retried_total += 1
+                next_allowed = max(next_allowed, time.monotonic() + retry_in)
+                self._next_allowed[chat_id] = next_allowed
+                self._enqueue(chat_id, message, queued_at, attempts + 1, front=True)
+                return
+            self._next_allowed[chat_id] = next_allowed
+            pending = self._chats.get(chat_id)
+            if pending:
+                self._push_ready(chat_id, next_allowed)
+            else:
+                self._chats.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        """Возвращает глубину очереди, число отправок и средние задержки."""
+        sent = self._sent_total
+        return {
+            'started': self._started,
+            'queued': self._queued,
+            'in_flight': len(self._in_flight),
+            'sent_total': sent,
+            'failed_total': self._failed_total,
+            'retried_total': self._retried_total,
+            'avg_queue_wait': round(self._wait_total / sent, 3) if sent else None,
+            'avg_send_latency': round(self._send_latency_total / sent, 3) if sent else None,
+        }
+
+
+telegram_notifier = TelegramNotifier()
@@ -0,0 +1,63 @@
+from typing import Iterable, List, Optional, Sequence
+
+from sqlalchemy import Table, and_, bindparam, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+
+# Диалекты, поддерживающие INSERT ... ON CONFLICT
+ON_CONFLICT_DIALECTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def upsert_rows(table: Table, rows: List[dict], key_columns: Sequence[str], update_columns: Iterable[str] = (),
+                update_values: Optional[dict] = None):
+    """Вставляет строки таблицы, а для уже существующих ключей обновляет update_columns.
+
+    update_values задает выражения для обновления существующих строк по их текущим
+    значениям, например {'version': table.c.version + 1}. В PostgreSQL и SQLite выполняется одним INSERT ... ON CONFLICT, в остальных БД -
+    одним запросом существующих ключей и пакетными UPDATE и INSERT. Выполняется
+    в текущей сессии, фиксацию транзакции выполняет вызывающий код.
+    """
+    if not rows:
+        return
+    update_columns = list(update_columns)
+    update_values = dict(update_values or {})
+    insert = ON_CONFLICT_DIALECTS.get(db.engine.dialect.name)
+    if insert is not None:
+        statement = insert(table)
+        if update_columns or update_values:
+            statement = statement.on_conflict_do_update(
+                index_elements=list(key_columns),
+                set_={**{column: statement.excluded[column] for column in update_columns}, **update_values}
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=list(key_columns))
+        db.session.execute(statement, rows)
+        return
+
+    keys = [table.c[column] for column in key_columns]
+    existing = set(db.session.execute(
+        select(*keys).where(tuple_(*keys).in_([tuple(row[column] for column in key_columns) for row in rows]))
+    ).all())
+    new_rows, changed_rows = [], []
+    for row in rows:
+        key = tuple(row[column] for column in key_columns)
+        (changed_rows if key in existing else new_rows).append(row)
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+    if changed_rows and (update_columns or update_values):
+        db.session.execute(
+            update(table)
+            .where(and_(*(table.c[column] == bindparam(f'key_{column}') for column in key_columns)))
+            .values({**{column: bindparam(f'value_{column}') for column in update_columns}, **update_values}),
+            [
+                {
+                    **{f'key_{column}': row[column] for column in key_columns},
+                    **{f'value_{column}': row[column] for column in update_columns}
+                }
+                for row in changed_rows
+            ]
+        )
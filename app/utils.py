@@ -3,10 +3,128 @@ import logging
 import random
 from typing import Optional, Tuple
 
-from app.models import Partner, PartnerInfo, ClientsData, DiscountWeightSettings, Category
+from flask import current_app
+from sqlalchemy import and_, case, exists, func, or_, select
+
+from app import db
+from app.models import Partner, PartnerInfo, ClientsData, ClientSalonStatus, DiscountWeightSettings, Category, salon_categories
+from app.offer_catalog import offer_catalog
+from app.services import get_client_exclusion
 
 
 async def get_random_discount(client_data: ClientsData) -> Optional[Tuple[PartnerInfo, bool]]:
+    """
+    Возвращает случайную скидку движком, выбранным в DISCOUNT_ENGINE.
+    """
+    engine = current_app.config.get('DISCOUNT_ENGINE', 'catalog')
+    if engine == 'query':
+        return await get_random_discount_query(client_data)
+    if engine == 'sql':
+        if db.engine.dialect.name == 'postgresql':
+            return await get_random_discount_sql(client_data)
+        logging.warning(f"Движок 'sql' не поддерживает {db.engine.dialect.name}, используется каталог предложений")
+    return await get_random_discount_catalog(client_data)
+
+
+async def get_random_discount_sql(client_data: ClientsData) -> Optional[Tuple[PartnerInfo, bool]]:
+    """
+    Выбирает скидку одним SQL-запросом (PostgreSQL).
+
+    Исключения (салоны и их категории, с которыми взаимодействовал клиент) считаются
+    через анти-джойны, вес салона - выражением по настройкам весов, а взвешенный
+    случайный выбор - сортировкой по экспоненциальному ключу -ln(U)/вес с LIMIT 1.
+    Порядок уровней: приоритетный салон города, связанный салон, остальные салоны города.
+    """
+    excluded_salons = select(ClientSalonStatus.salon_id).where(
+        ClientSalonStatus.client_id == client_data.id
+    )
+    excluded_categories = select(salon_categories.c.category_id).where(
+        salon_categories.c.salon_id.in_(excluded_salons)
+    )
+    user_city_id = select(PartnerInfo.city_id).where(
+        PartnerInfo.id == client_data.initial_salon_id
+    ).scalar_subquery()
+    user_linked_id = select(PartnerInfo.linked_partner_id).where(
+        PartnerInfo.id == client_data.initial_salon_id
+    ).scalar_subquery()
+
+    # Если строки настроек нет, используются веса по умолчанию из модели
+    settings = {
+        column.name: func.coalesce(column, column.default.arg)
+        for column in DiscountWeightSettings.__table__.c if column.default is not None
+    }
+    brought = func.coalesce(PartnerInfo.clients_brought, 0)
+    received = func.coalesce(PartnerInfo.clients_received, 0)
+    weight = case(
+        (and_(received > 0, brought >= received * 0.4, brought <= received * 0.8),
+         settings['ratio_below_30_weight']),
+        (and_(received > 0, brought >= received * 0.3, brought < received * 0.4),
+         settings['ratio_30_40_weight']),
+        else_=settings['ratio_40_80_weight']
+    ) + func.coalesce(Partner.partners_invited, 0) * settings['partners_invited_weight']
+
+    tier = case(
+        (and_(PartnerInfo.priority == True, PartnerInfo.city_id == user_city_id), 0),
+        (PartnerInfo.id == user_linked_id, 1),
+        else_=2
+    )
+    sort_key = case(
+        (tier < 2, func.random()),
+        else_=-func.ln(1 - func.random()) / func.nullif(weight, 0)
+    )
+
+    statement = (
+        select(PartnerInfo, tier)
+        .outerjoin(DiscountWeightSettings, DiscountWeightSettings.id == 1)
+        .outerjoin(Partner, Partner.salon_id == PartnerInfo.id)
+        .where(
+            or_(PartnerInfo.city_id == user_city_id, PartnerInfo.id == user_linked_id),
+            PartnerInfo.id.not_in(excluded_salons),
+            ~exists().where(
+                salon_categories.c.salon_id == PartnerInfo.id,
+                salon_categories.c.category_id.in_(excluded_categories)
+            ),
+            or_(tier < 2, weight > 0)
+        )
+        .order_by(tier, sort_key)
+        .limit(1)
+    )
+    row = db.session.execute(statement).first()
+    if not row:
+        logging.error(f"Не удалось найти доступные салоны для клиента {client_data.chat_id}, кроме взаимодействовавших с клиентом салонов")
+        return None
+
+    chosen_salon, chosen_tier = row
+    logging.info(f"Выбран салон SQL-запросом: {chosen_salon.name} (уровень {chosen_tier})")
+    return chosen_salon, chosen_tier == 0
+
+
+async def get_random_discount_catalog(client_data: ClientsData) -> Optional[Tuple[PartnerInfo, bool]]:
+    """
+    Выбирает скидку по каталогу предложений в памяти процесса.
+    Правила те же, что и в get_random_discount_query, но без запросов на каждый салон:
+    исключения клиента берутся из предрасчитанной записи ClientExclusion.
+    """
+    exclusion = get_client_exclusion(client_data.id)
+    excluded_salon_ids = frozenset(exclusion.salon_ids)
+    excluded_category_mask = exclusion.mask
+
+    choice = offer_catalog.choose(client_data.initial_salon_id, excluded_salon_ids, excluded_category_mask)
+    if not choice:
+        logging.error(f"Не удалось найти доступные салоны для клиента {client_data.chat_id}, кроме взаимодействовавших с клиентом салонов")
+        return None
+
+    salon_id, is_priority = choice
+    chosen_salon = db.session.get(PartnerInfo, salon_id)
+    if not chosen_salon:
+        # Салон удален после загрузки каталога
+        offer_catalog.invalidate()
+        return None
+    logging.info(f"Выбран салон из каталога предложений: {chosen_salon.name}")
+    return chosen_salon, is_priority
+
+
+async def get_random_discount_query(client_data: ClientsData) -> Optional[Tuple[PartnerInfo, bool]]:
     """
     Возвращает случайную скидку, исключая:
      - категорию салона пользователя,
@@ -0,0 +1,262 @@
+import asyncio
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+
+from app.background_loop import background_loop
+from app.http_client import http_client
+from app.rate_limit import TokenBucketLimiter
+
+
+class WhatsAppSender:
+    """Очередь исходящих сообщений WhatsApp (WHAPI).
+
+    Обработчики только ставят сообщение в очередь, отправку выполняет фоновый цикл.
+    Сообщения одного чата отправляются строго по очереди (одно сообщение чата в полете),
+    разных чатов - параллельно, но не чаще WHAPI_RATE_LIMIT сообщений в секунду на все
+    чаты. Ответы 429 и 5xx и сетевые ошибки повторяются с экспоненциальной задержкой
+    со случайным разбросом до WHAPI_MAX_ATTEMPTS попыток, остальные ошибки 4xx не
+    повторяются. После WHAPI_BREAKER_THRESHOLD ошибок подряд размыкается
+    предохранитель: WHAPI_BREAKER_TIMEOUT секунд запросы не выполняются, затем
+    отправляется одно пробное сообщение. Сообщения, прождавшие в очереди дольше
+    WHAPI_MESSAGE_TTL секунд, не отправляются. Очередь хранится в памяти процесса;
+    кто хранит сообщение в БД, передает on_done и удаляет его, когда очередь закончила с ним.
+    """
+
+    def __init__(self):
+        self.max_attempts = 5
+        self.breaker_threshold = 5
+        self.breaker_timeout = 30.0
+        self.message_ttl = 600.0
+        self.limiter = TokenBucketLimiter('WHAPI_RATE', rate=10, burst=10)
+        self._chats: Dict[str, Deque[Tuple[str, float, int, Optional[Callable[[bool], None]]]]] = {}
+        self._ready: List[Tuple[float, int, str]] = []
+        self._sequence = 0
+        self._queued = 0
+        self._in_flight = set()
+        self._next_allowed: Dict[str, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._breaker_open_until = 0.0
+        self._probe_in_flight = False
+        self._sent_total = 0
+        self._failed_total = 0
+        self._retried_total = 0
+        self._expired_total = 0
+        self._breaker_opened_total = 0
+        self._wait_total = 0.0
+
+    def init_app(self, app):
+        self.max_attempts = app.config.get('WHAPI_MAX_ATTEMPTS', self.max_attempts)
+        self.breaker_threshold = app.config.get('WHAPI_BREAKER_THRESHOLD', self.breaker_threshold)
+        self.breaker_timeout = app.config.get('WHAPI_BREAKER_TIMEOUT', self.breaker_timeout)
+        self.message_ttl = app.config.get('WHAPI_MESSAGE_TTL', self.message_ttl)
+        self.limiter.init_app(app)
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            background_loop.submit(self._run())
+
+    def enqueue(self, chat_id: str, message: str, on_done: Optional[Callable[[bool], None]] = None):
+        """Ставит сообщение в очередь отправки. Можно вызывать из любого потока и цикла.
+
+        on_done вызывается в фоновом цикле, когда очередь закончила с сообщением: с True,
+        если WHAPI его принял, и с False, если оно отклонено, не отправлено за
+        WHAPI_MAX_ATTEMPTS попыток или прождало в очереди дольше WHAPI_MESSAGE_TTL.
+        """
+        if not self._started:
+            self._start()
+        background_loop.loop.call_soon_threadsafe(self._enqueue, chat_id, message, time.monotonic(), 0, on_done)
+
+    @property
+    def breaker_state(self) -> str:
+        if self._consecutive_failures < self.breaker_threshold:
+            return 'closed'
+        return 'open' if time.monotonic() < self._breaker_open_until else 'half_open'
+
+    # --- Все методы ниже выполняются только в фоновом цикле ---
+
+    def _push_ready(self, chat_id: str, ready_at: float):
+        self._sequence += 1
+        heapq.heappush(self._ready, (ready_at, self._sequence, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _enqueue(self, chat_id: str, message: str, queued_at: float, attempts: int = 0,
+                 on_done: Optional[Callable[[bool], None]] = None, front: bool = False):
+        pending = self._chats.setdefault(chat_id, deque())
+        self._queued += 1
+        if front:
+            pending.appendleft((message, queued_at, attempts, on_done))
+        else:
+            pending.append((message, queued_at, attempts, on_done))
+        if (front or len(pending) == 1) and chat_id not in self._in_flight:
+            self._push_ready(chat_id, max(time.monotonic(), self._next_allowed.get(chat_id, 0)))
+
+    async def _wait(self, delay: float):
+        # Ждем срока или появления нового сообщения
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        logging.info(f"Очередь отправки WhatsApp запущена: до {self.limiter.rate} сообщений в секунду")
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._ready[0][0] - time.monotonic()
+            if delay > 0:
+                await self._wait(delay)
+                continue
+
+            state = self.breaker_state
+            if state == 'open':
+                await self._wait(self._breaker_open_until - time.monotonic())
+                continue
+            if state == 'half_open' and self._probe_in_flight:
+                # Пока пробное сообщение в полете, остальные ждут его результата
+                await self._wait(1)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            pending = self._chats.get(chat_id)
+            if not pending:
+                continue
+            message, queued_at, attempts, on_done = pending.popleft()
+            self._queued -= 1
+            if time.monotonic() - queued_at > self.message_ttl:
+                self._expired_total += 1
+                logging.error(f"Сообщение для номера {chat_id} не отправлено: истек срок ожидания в очереди")
+                self._complete(chat_id, on_done, False)
+                self._finish(chat_id, time.monotonic())
+                continue
+            # Чат занят уже на время ожидания лимита: новые сообщения чата встанут в его очередь,
+            # а не получат вторую запись в куче готовых
+            self._in_flight.add(chat_id)
+            probe = state == 'half_open'
+            if probe:
+                self._probe_in_flight = True
+            # Глобальный лимит WHAPI на все чаты
+            wait = self.limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            asyncio.get_running_loop().create_task(self._send(chat_id, message, queued_at, attempts, on_done, probe))
+
+    def _finish(self, chat_id: str, next_allowed: float):
+        pending = self._chats.get(chat_id)
+        if pending:
+            self._push_ready(chat_id, next_allowed)
+        else:
+            self._chats.pop(chat_id, None)
+            self._next_allowed.pop(chat_id, None)
+
+    def _record_failure(self):
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.breaker_threshold:
+            if self._breaker_open_until <= time.monotonic():
+                self._breaker_opened_total += 1
+                logging.error(
+                    f"WHAPI недоступен ({self._consecutive_failures} ошибок подряд), "
+                    f"отправка приостановлена на {self.breaker_timeout} с"
+                )
+            self._breaker_open_until = time.monotonic() + self.breaker_timeout
+
+    def _complete(self, chat_id: str, on_done: Optional[Callable[[bool], None]], delivered: bool):
+        if on_done is None:
+            return
+        try:
+            on_done(delivered)
+        except Exception as e:
+            logging.error(f"Ошибка при завершении отправки сообщения для номера {chat_id}: {e}")
+
+    async def _send(self, chat_id: str, message: str, queued_at: float, attempts: int,
+                    on_done: Optional[Callable[[bool], None]], probe: bool):
+        started = time.monotonic()
+        retry_in = None
+        delivered = False
+        try:
+            response = await http_client.post(
+                os.environ.get("WHAPI_BASE_URL"),
+                json={'to': chat_id, 'body': message},
+                headers={
+                    'Authorization': f'Bearer {os.environ.get("WHAPI_API_KEY")}',
+                    'Content-Type': 'application/json'
+                }
+            )
+            if response.status_code == 429:
+                retry_after = response.headers.get('Retry-After', '')
+                retry_in = float(retry_after) if retry_after.isdigit() else min(2 ** attempts, 60) * (1 + random.random())
+                logging.warning(f"Лимит WHAPI для номера {chat_id}, повтор через {retry_in:.1f} с")
+            else:
+                response.raise_for_status()
+                self._consecutive_failures = 0
+                self._sent_total += 1
+                self._wait_total += started - queued_at
+                delivered = True
+                logging.info(f"Ответ от WHAPI: {response.status_code} {response.text}")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code >= 500:
+                self._record_failure()
+                retry_in = min(2 ** attempts, 60) * (1 + random.random())
+            else:
+                # Повтор не поможет: сообщение отклонено окончательно
+                self._failed_total += 1
+            logging.error(f"Ошибка при отправке сообщения: {e}")
+        except httpx.HTTPError as e:
+            self._record_failure()
+            retry_in = min(2 ** attempts, 60) * (1 + random.random())
+            logging.error(f"Ошибка при отправке сообщения: {e}")
+        finally:
+            if probe:
+                self._probe_in_flight = False
+            self._in_flight.discard(chat_id)
+            now = time.monotonic()
+            if retry_in is not None and attempts + 1 >= self.max_attempts:
+                self._failed_total += 1
+                logging.error(f"Сообщение для номера {chat_id} не отправлено после {attempts + 1} попыток")
+                retry_in = None
+            if retry_in is not None:
+                self._retried_total += 1
+                self._next_allowed[chat_id] = now + retry_in
+                self._enqueue(chat_id, message, queued_at, attempts + 1, on_done, front=True)
+            else:
+                self._complete(chat_id, on_done, delivered)
+                self._finish(chat_id, now)
+
+    def stats(self) -> dict:
+        """Возвращает глубину очереди, число отправок и повторов и состояние предохранителя."""
+        sent = self._sent_total
+        return {
+            'started': self._started,
+            'queued': self._queued,
+            'in_flight': len(self._in_flight),
+            'sent_total': sent,
+            'failed_total': self._failed_total,
+            'retried_total': self._retried_total,
+            'expired_total': self._expired_total,
+            'breaker_state': self.breaker_state,
+            'breaker_opened_total': self._breaker_opened_total,
+            'consecutive_failures': self._consecutive_failures,
+            'avg_queue_wait': round(self._wait_total / sent, 3) if sent else None,
+            'rate_limiter': self.limiter.stats(),
+        }
+
+
+whatsapp_sender = WhatsAppSender()
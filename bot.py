@@ -9,8 +9,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     from app.models import Partner # Импортируем модель Partner здесь
     from app import db, create_app # Импортируем db и create_app здесь
+    from config import Config
 
-    app = create_app()
+    class BotConfig(Config):
+        BACKGROUND_WORKERS = False  # Фоновые воркеры работают только в веб-процессе
+
+    app = create_app(BotConfig)
     app.app_context().push()
 
     chat_id = update.message.chat_id
@@ -7,4 +7,90 @@ load_dotenv(os.path.join(basedir, '.env'))
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Выбор скидок: 'catalog' - каталог предложений в памяти, 'sql' - один SQL-запрос (PostgreSQL),
+    # 'query' - запросы к БД на каждый выбор
+    DISCOUNT_ENGINE = os.environ.get('DISCOUNT_ENGINE', 'catalog')
+    OFFER_CATALOG_TTL = int(os.environ.get('OFFER_CATALOG_TTL', 300))
+    # Время жизни реестра шаблонов сообщений в памяти процесса (секунды)
+    MESSAGE_TEMPLATES_TTL = int(os.environ.get('MESSAGE_TEMPLATES_TTL', 300))
+
+
+    # Фоновые воркеры (очереди, планировщики) запускаются только в веб-процессе
+    BACKGROUND_WORKERS = os.environ.get('BACKGROUND_WORKERS', '1') == '1'
+
+    # Быстрое подтверждение webhook с сохранением запросов в локальную очередь
+    WEBHOOK_SPOOL_ENABLED = os.environ.get('WEBHOOK_SPOOL_ENABLED', '0') == '1'
+    WEBHOOK_SPOOL_PATH = os.environ.get('WEBHOOK_SPOOL_PATH', os.path.join(basedir, 'spool', 'webhook_spool.db'))
+    WEBHOOK_SPOOL_WORKERS = int(os.environ.get('WEBHOOK_SPOOL_WORKERS', 4))
+    WEBHOOK_SPOOL_LEASE = int(os.environ.get('WEBHOOK_SPOOL_LEASE', 300))
+    WEBHOOK_SPOOL_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_SPOOL_MAX_ATTEMPTS', 5))
+
+    # Число последовательных полос диспетчера сообщений (порядок внутри чата, параллельность между чатами)
+    CHAT_DISPATCHER_LANES = int(os.environ.get('CHAT_DISPATCHER_LANES', 32))
+
+    # Отложенная отправка сообщений (пауза "колеса фортуны") без блокировки обработчика
+    DELAYED_SENDS_ENABLED = os.environ.get('DELAYED_SENDS_ENABLED', '1') == '1'
+    SPINNING_WHEEL_DELAY = float(os.environ.get('SPINNING_WHEEL_DELAY', 3))
+
+    # Общий пул HTTP-соединений для WHAPI и других внешних интеграций
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 100))
+    HTTP_POOL_KEEPALIVE = int(os.environ.get('HTTP_POOL_KEEPALIVE', 20))
+    HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+    HTTP2_ENABLED = os.environ.get('HTTP2_ENABLED', '1') == '1'
+
+    # Уведомления в Telegram: глобальный лимит (сообщений в секунду) и интервал между сообщениями в один чат
+    TELEGRAM_RATE_LIMIT = float(os.environ.get('TELEGRAM_RATE_LIMIT', 30))
+    TELEGRAM_CHAT_INTERVAL = float(os.environ.get('TELEGRAM_CHAT_INTERVAL', 1))
+    TELEGRAM_MAX_ATTEMPTS = int(os.environ.get('TELEGRAM_MAX_ATTEMPTS', 5))
+    TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 8))
+
+    # Синхронизация с AmoCRM: 'outbox' - очередь с пакетной отправкой, 'inline' - сразу в обработчике
+    AMOCRM_SYNC_MODE = os.environ.get('AMOCRM_SYNC_MODE', 'outbox')
+    AMOCRM_FLUSH_INTERVAL = float(os.environ.get('AMOCRM_FLUSH_INTERVAL', 5))
+    AMOCRM_BATCH_SIZE = int(os.environ.get('AMOCRM_BATCH_SIZE', 50))
+
+    # Фоновая синхронизация салонов с Google Sheets: интервал запуска по расписанию (0 - только по команде),
+    # размер страницы чтения и число страниц в одном запросе batchGet
+    SHEETS_SYNC_INTERVAL = int(os.environ.get('SHEETS_SYNC_INTERVAL', 0))
+    SHEETS_SYNC_PAGE_ROWS = int(os.environ.get('SHEETS_SYNC_PAGE_ROWS', 1000))
+    SHEETS_SYNC_PAGES_PER_REQUEST = int(os.environ.get('SHEETS_SYNC_PAGES_PER_REQUEST', 5))
+    SHEETS_SYNC_TIMEOUT = int(os.environ.get('SHEETS_SYNC_TIMEOUT', 1800))
+
+    # Счетчики салонов: 'atomic' - атомарное увеличение в БД, 'events' - журнал событий
+    # с периодическим переносом в счетчики (без блокировки строк популярных салонов)
+    COUNTER_MODE = os.environ.get('COUNTER_MODE', 'atomic')
+    COUNTER_FLUSH_INTERVAL = float(os.environ.get('COUNTER_FLUSH_INTERVAL', 10))
+
+    # Защита от повторной доставки webhook: сколько секунд и сколько ID сообщений помнить,
+    # и хранить ли ID в общей таблице processed_messages (для нескольких процессов)
+    MESSAGE_DEDUP_TTL = int(os.environ.get('MESSAGE_DEDUP_TTL', 86400))
+    MESSAGE_DEDUP_SIZE = int(os.environ.get('MESSAGE_DEDUP_SIZE', 100000))
+    MESSAGE_DEDUP_SHARED = os.environ.get('MESSAGE_DEDUP_SHARED', '0') == '1'
+
+    # Защита от флуда: сообщений в секунду на один чат (0 - без ограничения) и допустимая серия подряд
+    CHAT_RATE_LIMIT = float(os.environ.get('CHAT_RATE_LIMIT', 0.5))
+    CHAT_RATE_BURST = float(os.environ.get('CHAT_RATE_BURST', 5))
+
+    # Очередь отправки WhatsApp: лимит тарифа WHAPI (сообщений в секунду) и допустимая серия,
+    # число попыток, предохранитель (ошибок подряд и секунд паузы) и срок ожидания сообщения в очереди
+    WHAPI_RATE_LIMIT = float(os.environ.get('WHAPI_RATE_LIMIT', 10))
+    WHAPI_RATE_BURST = float(os.environ.get('WHAPI_RATE_BURST', 10))
+    WHAPI_MAX_ATTEMPTS = int(os.environ.get('WHAPI_MAX_ATTEMPTS', 5))
+    WHAPI_BREAKER_THRESHOLD = int(os.environ.get('WHAPI_BREAKER_THRESHOLD', 5))
+    WHAPI_BREAKER_TIMEOUT = float(os.environ.get('WHAPI_BREAKER_TIMEOUT', 30))
+    WHAPI_MESSAGE_TTL = float(os.environ.get('WHAPI_MESSAGE_TTL', 600))
+
+    # Число строк на странице списков админки
+    ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+
+    # Интервал (в секундах) полного пересчета показателей главной страницы админки (0 - не пересчитывать)
+    # и интервал переноса изменений показателей из журнала dashboard_stat_events
+    DASHBOARD_STATS_INTERVAL = int(os.environ.get('DASHBOARD_STATS_INTERVAL', 600))
+    DASHBOARD_STATS_FOLD_INTERVAL = float(os.environ.get('DASHBOARD_STATS_FOLD_INTERVAL', 10))
+
+    # Дневные итоги воронки: интервал пересчета (0 - не пересчитывать) и наибольшая задержка
+    # фиксации транзакции с событием, которую учитывает пересчет (секунды)
+    FUNNEL_ROLLUP_INTERVAL = int(os.environ.get('FUNNEL_ROLLUP_INTERVAL', 60))
+    FUNNEL_ROLLUP_LAG = int(os.environ.get('FUNNEL_ROLLUP_LAG', 60))
\ No newline at end of file
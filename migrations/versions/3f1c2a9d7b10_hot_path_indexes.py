@@ -0,0 +1,75 @@
+"""Индексы для частых запросов
+
+Revision ID: 3f1c2a9d7b10
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# (таблица, имя индекса, столбцы)
+INDEXES = [
+    ('partner_info', 'ix_partner_info_city_priority', ['city_id', 'priority']),
+    ('partners', 'ix_partners_unique_code', ['unique_code']),
+    ('salon_categories', 'ix_salon_categories_category_id', ['category_id']),
+    ('client_salon_status', 'ix_client_salon_status_salon_id', ['salon_id']),
+]
+
+
+def existing_indexes(inspector, table):
+    names = {index['name'] for index in inspector.get_indexes(table)}
+    names.update(constraint['name'] for constraint in inspector.get_unique_constraints(table))
+    primary_key = inspector.get_pk_constraint(table)
+    if primary_key.get('name'):
+        names.add(primary_key['name'])
+    return names
+
+
+def add_salon_categories_primary_key(bind):
+    # Связи салона с категорией получают составной первичный ключ, как в модели.
+    # До этого связи могли повторяться и содержать NULL: оставляем по одной полной связи
+    op.execute('DELETE FROM salon_categories WHERE salon_id IS NULL OR category_id IS NULL')
+    if bind.dialect.name == 'postgresql':
+        op.execute(
+            'DELETE FROM salon_categories a USING salon_categories b '
+            'WHERE a.ctid < b.ctid AND a.salon_id = b.salon_id AND a.category_id = b.category_id'
+        )
+    elif bind.dialect.name == 'sqlite':
+        op.execute(
+            'DELETE FROM salon_categories WHERE rowid NOT IN ('
+            'SELECT MIN(rowid) FROM salon_categories GROUP BY salon_id, category_id)'
+        )
+    with op.batch_alter_table('salon_categories') as batch_op:
+        batch_op.alter_column('salon_id', existing_type=sa.String(length=255), nullable=False)
+        batch_op.alter_column('category_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('salon_categories_pkey', ['salon_id', 'category_id'])
+
+
+def upgrade():
+    # На новой базе таблиц еще нет: их вместе с индексами создаст db.create_all()
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if inspector.has_table('salon_categories') and not inspector.get_pk_constraint('salon_categories').get('constrained_columns'):
+        add_salon_categories_primary_key(bind)
+        inspector = sa.inspect(bind)
+    for table, name, columns in INDEXES:
+        if inspector.has_table(table) and name not in existing_indexes(inspector, table):
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    # Составной первичный ключ salon_categories остается: он соответствует модели
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    for table, name, columns in reversed(INDEXES):
+        if inspector.has_table(table) and name in {index['name'] for index in inspector.get_indexes(table)}:
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,34 @@
+"""Время смены статуса салона для клиента
+
+Revision ID: 8b2d4e6f1a35
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d4e6f1a35'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+def has_column(inspector, table, column):
+    return any(existing['name'] == column for existing in inspector.get_columns(table))
+
+
+def upgrade():
+    # На новой базе таблицы еще нет: ее вместе со столбцом создаст db.create_all()
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table('client_salon_status') and not has_column(inspector, 'client_salon_status', 'updated_at'):
+        op.add_column('client_salon_status', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table('client_salon_status') and has_column(inspector, 'client_salon_status', 'updated_at'):
+        with op.batch_alter_table('client_salon_status') as batch_op:
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,36 @@
+"""Число захватов отложенного сообщения для отправки
+
+Revision ID: c4e1a7d2b9f0
+Revises: 8b2d4e6f1a35
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e1a7d2b9f0'
+down_revision = '8b2d4e6f1a35'
+branch_labels = None
+depends_on = None
+
+
+def has_column(inspector, table, column):
+    return any(existing['name'] == column for existing in inspector.get_columns(table))
+
+
+def upgrade():
+    # На новой базе таблицы еще нет: ее вместе со столбцом создаст db.create_all()
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table('scheduled_messages') and not has_column(inspector, 'scheduled_messages', 'attempts'):
+        op.add_column(
+            'scheduled_messages', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0')
+        )
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table('scheduled_messages') and has_column(inspector, 'scheduled_messages', 'attempts'):
+        with op.batch_alter_table('scheduled_messages') as batch_op:
+            batch_op.drop_column('attempts')
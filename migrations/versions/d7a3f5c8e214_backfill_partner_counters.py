@@ -0,0 +1,45 @@
+"""Выравнивание счетчиков партнера и салона
+
+До атомарных приращений клиентов, приведенных партнером, считал только partners,
+а полученных салоном - только partner_info; вторые копии обновлялись лишь при
+сохранении партнера в админке. Теперь оба счетчика увеличиваются в обеих таблицах,
+поэтому копии один раз выравниваются по тем значениям, которые велись раньше.
+
+Revision ID: d7a3f5c8e214
+Revises: c4e1a7d2b9f0
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3f5c8e214'
+down_revision = 'c4e1a7d2b9f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # На новой базе таблиц еще нет: их создаст db.create_all(), и выравнивать нечего
+    inspector = sa.inspect(op.get_bind())
+    if not (inspector.has_table('partners') and inspector.has_table('partner_info')):
+        return
+    op.execute(
+        "UPDATE partners SET clients_received = ("
+        "SELECT COALESCE(partner_info.clients_received, 0) FROM partner_info "
+        "WHERE partner_info.id = partners.salon_id) "
+        "WHERE EXISTS (SELECT 1 FROM partner_info WHERE partner_info.id = partners.salon_id)"
+    )
+    op.execute(
+        "UPDATE partner_info SET clients_brought = ("
+        "SELECT COALESCE(partners.clients_brought, 0) FROM partners "
+        "WHERE partners.salon_id = partner_info.id) "
+        "WHERE EXISTS (SELECT 1 FROM partners WHERE partners.salon_id = partner_info.id)"
+    )
+
+
+def downgrade():
+    # Прежние расхождения счетчиков не восстанавливаются
+    pass
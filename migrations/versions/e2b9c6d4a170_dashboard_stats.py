@@ -0,0 +1,42 @@
+"""Предрассчитанные показатели главной страницы админки и журнал их изменений
+
+Revision ID: e2b9c6d4a170
+Revises: d7a3f5c8e214
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b9c6d4a170'
+down_revision = 'd7a3f5c8e214'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('dashboard_stats'):
+        op.create_table(
+            'dashboard_stats',
+            sa.Column('name', sa.String(length=64), primary_key=True),
+            sa.Column('value', sa.BigInteger(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+        )
+    if not inspector.has_table('dashboard_stat_events'):
+        op.create_table(
+            'dashboard_stat_events',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('name', sa.String(length=64), nullable=False),
+            sa.Column('delta', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+        )
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in ('dashboard_stat_events', 'dashboard_stats'):
+        if inspector.has_table(table):
+            op.drop_table(table)
@@ -0,0 +1,56 @@
+"""События воронки и их дневные итоги
+
+Revision ID: f5d8a2c1e736
+Revises: e2b9c6d4a170
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5d8a2c1e736'
+down_revision = 'e2b9c6d4a170'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('funnel_events'):
+        op.create_table(
+            'funnel_events',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('stage', sa.String(length=16), nullable=False),
+            sa.Column('salon_id', sa.String(length=255), nullable=False),
+            sa.Column('client_id', sa.Integer(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+        )
+        op.create_index('ix_funnel_events_created_at', 'funnel_events', ['created_at'])
+    if not inspector.has_table('funnel_daily'):
+        op.create_table(
+            'funnel_daily',
+            sa.Column('day', sa.Date(), primary_key=True),
+            sa.Column('city_id', sa.Integer(), primary_key=True),
+            sa.Column('salon_id', sa.String(length=255), primary_key=True),
+            sa.Column('starts', sa.Integer(), nullable=False),
+            sa.Column('offers', sa.Integer(), nullable=False),
+            sa.Column('accepts', sa.Integer(), nullable=False),
+            sa.Column('rejects', sa.Integer(), nullable=False),
+            sa.Column('claims', sa.Integer(), nullable=False),
+        )
+        op.create_index('ix_funnel_daily_salon_day', 'funnel_daily', ['salon_id', 'day'])
+    if not inspector.has_table('funnel_rollup_state'):
+        op.create_table(
+            'funnel_rollup_state',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('rolled_up_at', sa.DateTime(), nullable=True),
+        )
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in ('funnel_rollup_state', 'funnel_daily', 'funnel_events'):
+        if inspector.has_table(table):
+            op.drop_table(table)
@@ -0,0 +1,31 @@
+import json
+import os
+import sys
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    # Клиент Google Sheets создается при импорте app, поэтому без ключа сервисного аккаунта
+    # тесты не запустятся. Для тестов достаточно одноразового ключа: к API они не обращаются.
+    if os.environ.get('SERVICE_ACCOUNT_FILE'):
+        return
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    path = os.path.join(str(config.rootpath), '.pytest_cache', 'service_account.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({
+            'type': 'service_account',
+            'project_id': 'sarafan-tests',
+            'private_key_id': 'tests',
+            'private_key': private_key.decode('ascii'),
+            'client_email': 'tests@sarafan-tests.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': 'https://oauth2.googleapis.com/token',
+        }, file)
+    os.environ['SERVICE_ACCOUNT_FILE'] = path
@@ -0,0 +1,84 @@
+"""Сэмплер каталога предложений: исключенные салоны не выбираются, остальные - пропорционально весам."""
+import random
+from collections import Counter
+
+from app.offer_catalog import CityCatalog, FenwickTree, SalonRecord, WeightSettings, category_mask
+
+# Вес салона без полученных клиентов: 1 + число приглашенных партнеров
+SETTINGS = WeightSettings(ratio_40_80_weight=1, ratio_30_40_weight=0, ratio_below_30_weight=0, partners_invited_weight=1)
+
+
+def build_catalog(salons: int = 12) -> CityCatalog:
+    records = [
+        SalonRecord(f's{number}', 1, category_mask([number % 4 + 1]), number % 5 == 0, None, 0, 0, number % 3, number)
+        for number in range(salons)
+    ]
+    return CityCatalog(1, records, SETTINGS)
+
+
+def draw(catalog: CityCatalog, tree: FenwickTree, excluded_ids, excluded_mask: int, draws: int) -> Counter:
+    rng = random.Random(42)
+    counts = Counter()
+    for _ in range(draws):
+        record = catalog.sample(tree, excluded_ids, excluded_mask, rng)
+        counts[record.salon_id if record else None] += 1
+    return counts
+
+
+def expected_shares(catalog: CityCatalog, tree: FenwickTree, excluded_ids, excluded_mask: int) -> dict:
+    weights = {
+        record.salon_id: tree.value(record.index) for record in catalog.records
+        if not record.category_mask & excluded_mask and record.salon_id not in excluded_ids
+    }
+    total = sum(weights.values())
+    return {salon_id: weight / total for salon_id, weight in weights.items() if weight}
+
+
+def assert_distribution(counts: Counter, shares: dict, draws: int):
+    assert set(counts) == set(shares)
+    for salon_id, share in shares.items():
+        assert abs(counts[salon_id] / draws - share) < 0.01, salon_id
+
+
+def test_fenwick_prefix_and_find():
+    tree = FenwickTree([3, 0, 2, 5])
+    assert [tree.prefix(index) for index in range(5)] == [0, 3, 3, 5, 10]
+    assert [tree.find(target) for target in range(10)] == [0, 0, 0, 2, 2, 3, 3, 3, 3, 3]
+    tree.set(1, 4)
+    assert tree.total() == 14 and tree.find(3) == 1
+
+
+def test_sample_skips_excluded_salons_and_categories():
+    catalog = build_catalog()
+    excluded_ids = frozenset({'s2', 's7'})
+    excluded_mask = category_mask([1])
+    draws = 60000
+    counts = draw(catalog, catalog.weights, excluded_ids, excluded_mask, draws)
+    assert not set(counts) & {'s0', 's4', 's8', 's2', 's7'}
+    assert_distribution(counts, expected_shares(catalog, catalog.weights, excluded_ids, excluded_mask), draws)
+
+
+def test_exact_fallback_when_exclusions_outweigh():
+    # Доступен один легкий салон: отбор почти всегда неудачен и выбор уходит в точный путь
+    catalog = build_catalog(40)
+    excluded_mask = category_mask([1, 2, 3])
+    catalog.weights.set(3, 1)
+    for record in catalog.records:
+        if record.category_mask & category_mask([4]) and record.index != 3:
+            catalog.weights.set(record.index, 0)
+    counts = draw(catalog, catalog.weights, frozenset(), excluded_mask, 2000)
+    assert counts == Counter({'s3': 2000})
+
+
+def test_sample_returns_none_when_everything_is_excluded():
+    catalog = build_catalog()
+    excluded_mask = category_mask([1, 2, 3, 4])
+    assert draw(catalog, catalog.weights, frozenset(), excluded_mask, 50) == Counter({None: 50})
+    assert draw(catalog, catalog.priority, frozenset({'s0', 's5', 's10'}), 0, 50) == Counter({None: 50})
+
+
+def test_priority_sampling_is_uniform_over_available_priority_salons():
+    catalog = build_catalog()
+    draws = 30000
+    counts = draw(catalog, catalog.priority, frozenset({'s5'}), 0, draws)
+    assert_distribution(counts, {'s0': 0.5, 's10': 0.5}, draws)
@@ -0,0 +1,68 @@
+"""Очередь отправки WhatsApp: в полете не больше одного сообщения чата, порядок сохраняется."""
+import asyncio
+import time
+
+import httpx
+
+from app.rate_limit import TokenBucketLimiter
+from app.whatsapp_sender import WhatsAppSender
+
+
+def run_sender(monkeypatch, scenario, rate: float = 20):
+    """Запускает цикл отправки с подменным WHAPI и возвращает тела сообщений в порядке отправки."""
+    sender = WhatsAppSender()
+    sender.limiter = TokenBucketLimiter('TEST_WHAPI_RATE', rate=rate, burst=1)
+    sent = []
+    in_flight = {}
+    overlaps = []
+
+    async def post(url, json, headers):
+        chat_id = json['to']
+        in_flight[chat_id] = in_flight.get(chat_id, 0) + 1
+        if in_flight[chat_id] > 1:
+            overlaps.append(json['body'])
+        await asyncio.sleep(0.02)
+        in_flight[chat_id] -= 1
+        sent.append(json['body'])
+        return httpx.Response(200, request=httpx.Request('POST', 'http://whapi.test'))
+
+    monkeypatch.setattr('app.whatsapp_sender.http_client.post', post)
+
+    async def main():
+        runner = asyncio.get_running_loop().create_task(sender._run())
+        await asyncio.sleep(0)
+        await scenario(sender)
+        for _ in range(200):
+            if not sender._queued and not sender._in_flight:
+                break
+            await asyncio.sleep(0.01)
+        runner.cancel()
+
+    asyncio.run(main())
+    assert not overlaps, f'Одновременно в полете несколько сообщений одного чата: {overlaps}'
+    return sent
+
+
+def test_message_enqueued_during_rate_limit_wait(monkeypatch):
+    async def scenario(sender):
+        # Первое сообщение расходует токен, второе ждет лимита, третье приходит во время ожидания
+        sender._enqueue('b', 'b1', time.monotonic())
+        sender._enqueue('a', 'a1', time.monotonic())
+        await asyncio.sleep(0.01)
+        sender._enqueue('a', 'a2', time.monotonic())
+
+    sent = run_sender(monkeypatch, scenario)
+    assert sent.index('a1') < sent.index('a2')
+    assert sorted(sent) == ['a1', 'a2', 'b1']
+
+
+def test_chat_messages_keep_order(monkeypatch):
+    async def scenario(sender):
+        for number in range(5):
+            sender._enqueue('a', f'a{number}', time.monotonic())
+            sender._enqueue('b', f'b{number}', time.monotonic())
+            await asyncio.sleep(0.005)
+
+    sent = run_sender(monkeypatch, scenario, rate=200)
+    assert [body for body in sent if body.startswith('a')] == [f'a{number}' for number in range(5)]
+    assert [body for body in sent if body.startswith('b')] == [f'b{number}' for number in range(5)]